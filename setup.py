@@ -19,5 +19,5 @@ setup(
     author_email='disturbyte@gmail.com',
     url='http://github.com/disturbyte/zenqueue',
     packages=find_packages(),
-    install_requires=['simplejson', 'URLObject'],
+    install_requires=['simplejson'],
 )
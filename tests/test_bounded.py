@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from zenqueue.queue import Queue
+
+
+def wait_until(condition, timeout=5, sleep=time.sleep):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting')
+        sleep(0.001)
+
+
+class BoundedQueueTest(unittest.TestCase):
+    
+    # A full queue refuses pushes once their timeout runs out, and wakes
+    # waiting producers as soon as something is pulled.
+    
+    def test_full(self):
+        queue = Queue(mode='sync', maxsize=2)
+        queue.push_many('a', 'b')
+        start = time.time()
+        self.assertRaises(queue.Full, queue.push, 'c', timeout=0.1)
+        self.assertTrue(time.time() - start >= 0.09)
+        self.assertRaises(queue.Full, queue.push, 'c', timeout=0)
+        self.assertEqual(queue.space_waiters, 0)
+        self.assertEqual(len(queue), 2)
+    
+    def test_maxbytes(self):
+        queue = Queue(mode='sync', maxbytes=10)
+        queue.push('12345678')
+        self.assertRaises(queue.Full, queue.push, '12345', timeout=0)
+        queue.push('12')
+        self.assertEqual(queue.pull(), '12345678')
+        queue.push('12345')
+        self.assertEqual(queue.bytes, 7)
+    
+    def test_requeue_forced(self):
+        # Nacked items go back in even if the queue has filled up since.
+        queue = Queue(mode='sync', maxsize=1)
+        queue.push('a')
+        lease_id, value = queue.pull(lease=5)
+        queue.push('b')
+        self.assertTrue(queue.nack(lease_id))
+        self.assertEqual(queue.size, 2)
+        self.assertEqual(queue.pull_many(None, timeout=0), ['a', 'b'])
+    
+    def test_sync_wakeup(self):
+        queue = Queue(mode='sync', maxsize=1)
+        queue.push('a')
+        results = []
+        def push():
+            try:
+                queue.push('b', timeout=5)
+                results.append(None)
+            except Exception, exc:
+                results.append(exc)
+        thread = threading.Thread(target=push)
+        thread.start()
+        wait_until(lambda: queue.space_waiters == 1)
+        self.assertEqual(queue.pull(), 'a')
+        thread.join()
+        self.assertEqual(results, [None])
+        self.assertEqual(queue.pull(timeout=0), 'b')
+    
+    def test_freed_before_waiting(self):
+        # Space freed up after a producer finds the queue full, but before it
+        # starts waiting, must still wake it.
+        queue = Queue(mode='sync', maxsize=1)
+        queue.push('a')
+        pulled = []
+        class Semaphore(queue.semaphore_class):
+            def acquire(self, *args, **kwargs):
+                if not pulled:
+                    pulled.append(queue.pull())
+                return super(Semaphore, self).acquire(*args, **kwargs)
+        queue.semaphore_class = Semaphore
+        queue.space = Semaphore(initial=0)
+        queue.push('b', timeout=1)
+        self.assertEqual(pulled, ['a'])
+        self.assertEqual(queue.pull(timeout=0), 'b')
+    
+    def test_async_wakeup(self):
+        from eventlet import api
+        queue = Queue(mode='async', maxsize=1)
+        queue.push('a')
+        results = []
+        def push():
+            try:
+                queue.push('b', timeout=5)
+                results.append(None)
+            except Exception, exc:
+                results.append(exc)
+        api.spawn(push)
+        api.sleep(0)
+        self.assertEqual(queue.space_waiters, 1)
+        self.assertEqual(queue.pull(), 'a')
+        wait_until(lambda: results, sleep=api.sleep)
+        self.assertEqual(results, [None])
+        self.assertEqual(queue.pull(timeout=0), 'b')
+    
+    def test_contended(self):
+        # Producers and consumers racing over a queue with room for one item
+        # must neither lose a wakeup (a producer timing out while the queue
+        # sits empty) nor overfill it.
+        queue = Queue(mode='sync', maxsize=1)
+        count, producers = 200, 4
+        errors, pulled, sizes = [], [], []
+        def produce(n):
+            try:
+                for i in xrange(count):
+                    queue.push((n, i), timeout=5)
+            except Exception, exc:
+                errors.append(exc)
+        def consume():
+            for i in xrange(count * producers):
+                sizes.append(queue.size)
+                pulled.append(queue.pull(timeout=5))
+        threads = [threading.Thread(target=produce, args=(n,))
+                   for n in xrange(producers)]
+        threads.append(threading.Thread(target=consume))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(pulled), count * producers)
+        self.assertEqual(queue.size, 0)
+        self.assertTrue(max(sizes) <= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
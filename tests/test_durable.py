@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from zenqueue import log
+from zenqueue.queue.durable import DurableQueue
+
+
+log.silence()
+
+
+class DurableRedeliveryTest(unittest.TestCase):
+    
+    # Items which are redelivered go back on the front of the queue, and must
+    # still be there, in the same order, when the log is replayed.
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = self.open()
+    
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.path)
+    
+    def open(self, **kwargs):
+        return DurableQueue(self.path, mode='sync', **kwargs)
+    
+    def reopen(self, **kwargs):
+        # As after a crash: whatever was logged is all there is.
+        self.queue.close()
+        self.queue = self.open(**kwargs)
+        return self.queue
+    
+    def contents(self, queue):
+        return queue.pull_many(None, timeout=0)
+    
+    def test_expired_lease(self):
+        queue = self.queue
+        queue.push_many('A', 'B', 'C', 'D', 'E')
+        self.assertEqual(queue.pull(), 'A')
+        lease_id, value = queue.pull(lease=5)
+        self.assertEqual(value, 'B')
+        self.assertEqual(queue.expire_leases(now=time.time() + 10), 1)
+        self.assertEqual(queue.pull(), 'B')
+        self.assertEqual(list(reversed(queue.queue)), ['C', 'D', 'E'])
+        self.assertEqual(self.contents(self.reopen()), ['C', 'D', 'E'])
+    
+    def test_redelivered_item_survives_restart(self):
+        queue = self.queue
+        queue.push_many('A', 'B', 'C')
+        lease_id, value = queue.pull(lease=5)
+        self.assertTrue(queue.nack(lease_id))
+        self.assertEqual(self.contents(self.reopen()), ['A', 'B', 'C'])
+    
+    def test_several_redeliveries(self):
+        queue = self.queue
+        queue.push_many('A', 'B', 'C', 'D')
+        pairs = queue.pull_many(3, lease=5)
+        # Handed back newest first, as a subscription gives back its items.
+        for lease_id, value in reversed(pairs):
+            queue.nack(lease_id)
+        queue.push('E')
+        self.assertEqual(self.contents(self.reopen()),
+                         ['A', 'B', 'C', 'D', 'E'])
+    
+    def test_redelivery_across_segments(self):
+        # Small segments are rotated (and compacted) as the log grows. The
+        # items still out on lease come back ahead of the rest.
+        queue = self.reopen(segment_size=64, compact_segments=2)
+        for i in xrange(20):
+            queue.push(i)
+            lease_id, value = queue.pull(lease=5)
+            if i % 2:
+                queue.nack(lease_id)
+        queue.pull()
+        expected = [queue.leases[lease_id][0]
+                    for lease_id in sorted(queue.leases)]
+        self.assertEqual(len(expected), 10)
+        expected.extend(reversed(queue.queue))
+        self.assertEqual(len(expected), 19)
+        self.assertEqual(self.contents(
+            self.reopen(segment_size=64, compact_segments=2)), expected)
+    
+    def test_requeue_needs_a_pull(self):
+        self.queue.push('A')
+        self.assertRaises(ValueError, self.queue.requeue, 'B')
+    
+    def test_unsettled_leases_survive_restart(self):
+        # Items still out on lease are redelivered after a restart, first
+        # leased first, ahead of everything else; acked ones aren't.
+        queue = self.queue
+        queue.push_many('A', 'B', 'C', 'D', 'E')
+        pairs = queue.pull_many(3, lease=5)
+        self.assertTrue(queue.ack(pairs[1][0]))
+        lease_id, value = queue.pull(lease=5)
+        self.assertEqual(value, 'D')
+        queue = self.reopen()
+        self.assertEqual(queue.leases, {})
+        self.assertTrue(queue.lease_ids.next() > lease_id)
+        self.assertEqual(self.contents(self.reopen()), ['A', 'C', 'D', 'E'])
+    
+    def test_leases_across_segments(self):
+        # Outstanding leases are logged again in each new segment, so they
+        # outlive the segments they were granted in.
+        queue = self.reopen(segment_size=64, compact_segments=2)
+        queue.push('A')
+        lease_id, value = queue.pull(lease=5)
+        for i in xrange(20):
+            queue.push(i)
+            [(other_id, other)] = queue.pull_many(1, lease=5)
+            self.assertTrue(queue.ack(other_id))
+        self.assertTrue(len(queue.segments) < 5)
+        queue.push('B')
+        self.assertEqual(self.contents(self.reopen()), ['A', 'B'])
+
+
+class DurableSyncTest(unittest.TestCase):
+    
+    # Records written just before the queue goes quiet are synced once
+    # `sync_interval` has passed, without waiting for another write.
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = DurableQueue(self.path, mode='sync', sync_interval=1.0)
+    
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.path)
+    
+    def logged_size(self):
+        return os.path.getsize(self.queue.segments[-1].path)
+    
+    def test_sync_overdue(self):
+        queue = self.queue
+        size = self.logged_size()
+        queue.push('A')
+        self.assertEqual(queue.unsynced, 1)
+        self.assertEqual(self.logged_size(), size)
+        self.assertFalse(queue.sync_overdue(now=queue.last_sync + 0.5))
+        self.assertTrue(queue.sync_overdue(now=queue.last_sync + 1.0))
+        self.assertEqual(queue.unsynced, 0)
+        self.assertTrue(self.logged_size() > size)
+        # Nothing more to sync until something else is written.
+        self.assertFalse(queue.sync_overdue(now=queue.last_sync + 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
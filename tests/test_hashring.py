@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from zenqueue.utils.hashring import HashRing, ring_hash
+
+
+class RingHashTest(unittest.TestCase):
+    
+    def test_keys_which_are_not_strings(self):
+        self.assertEqual(ring_hash(7), ring_hash('7'))
+        self.assertEqual(ring_hash(7L), ring_hash('7'))
+        ring = HashRing(['a', 'b', 'c'])
+        self.assertEqual(ring.get(7), ring.get('7'))
+    
+    def test_unicode_keys(self):
+        self.assertEqual(ring_hash(u'caf\xe9'), ring_hash('caf\xc3\xa9'))
+
+
+if __name__ == '__main__':
+    unittest.main()
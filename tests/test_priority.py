@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from zenqueue.queue import Queue
+
+
+class PriorityRedeliveryTest(unittest.TestCase):
+    
+    # A leased item which is nacked, or whose lease runs out, goes back on the
+    # front of its own priority level, not the highest one.
+    
+    def setUp(self):
+        self.queue = Queue(mode='sync', priorities=True)
+        self.queue.push_many('high', priority=5)
+        self.queue.push_many('low 1', 'low 2', priority=0)
+    
+    def contents(self):
+        return self.queue.pull_many(None, timeout=0)
+    
+    def test_nack(self):
+        self.assertEqual(self.queue.pull(), 'high')
+        lease_id, value = self.queue.pull(lease=5)
+        self.assertEqual(value, 'low 1')
+        self.queue.push('higher', priority=9)
+        self.assertTrue(self.queue.nack(lease_id))
+        self.assertEqual(self.contents(), ['higher', 'low 1', 'low 2'])
+    
+    def test_expired_lease(self):
+        pairs = self.queue.pull_many(2, timeout=0, lease=5)
+        self.assertEqual([value for lease_id, value in pairs],
+                         ['high', 'low 1'])
+        self.queue.push('middle', priority=3)
+        self.assertEqual(self.queue.expire_leases(now=time.time() + 10), 2)
+        self.assertEqual(self.contents(),
+                         ['high', 'middle', 'low 1', 'low 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
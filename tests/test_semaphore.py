@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from zenqueue.queue import Queue
+from zenqueue.utils.sync import Semaphore
+
+
+def wait_until(condition, timeout=5, sleep=time.sleep):
+    # Waits for other threads (or coroutines, given their sleep()) to get
+    # into place, or to finish.
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting')
+        sleep(0.001)
+
+
+class SyncSemaphoreTest(unittest.TestCase):
+    
+    # A release goes straight to the longest-waiting thread, and a waiter
+    # which times out is left in the queue as a tombstone, which release()
+    # skips and sweep() clears out.
+    
+    def setUp(self):
+        self.semaphore = Semaphore(initial=0)
+        self.results = []
+    
+    def wait(self, timeout=5):
+        def acquire():
+            try:
+                self.semaphore.acquire(timeout=timeout)
+            except Exception, exc:
+                self.results.append(exc)
+            else:
+                self.results.append(True)
+        waiting = self.semaphore.waiting
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        wait_until(lambda: self.semaphore.waiting > waiting)
+        return thread
+    
+    def test_release_is_handed_off(self):
+        thread = self.wait()
+        self.semaphore.release()
+        # The count went to the waiter, so it isn't there to be taken.
+        self.assertEqual(self.semaphore.count, 0)
+        self.assertFalse(self.semaphore.try_acquire())
+        thread.join()
+        self.assertEqual(self.results, [True])
+    
+    def test_waiters_are_woken_in_order(self):
+        threads = [self.wait() for i in xrange(3)]
+        self.semaphore.release()
+        threads[0].join()
+        self.assertEqual(self.semaphore.waiting, 2)
+        self.semaphore.release_many(2)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.results, [True] * 3)
+        self.assertEqual(self.semaphore.count, 0)
+    
+    def test_timed_out_waiter_is_skipped(self):
+        self.assertRaises(Semaphore.Timeout, self.semaphore.acquire,
+                          timeout=0.01)
+        self.assertEqual(self.semaphore.waiting, 0)
+        self.assertEqual(len(self.semaphore.evt_queue), 1)
+        # The release passes over the tombstone to the thread behind it.
+        thread = self.wait()
+        self.semaphore.release()
+        thread.join()
+        self.assertEqual(self.results, [True])
+        self.assertEqual(self.semaphore.count, 0)
+        self.assertEqual(len(self.semaphore.evt_queue), 0)
+    
+    def test_release_past_tombstones(self):
+        for i in xrange(3):
+            self.assertRaises(Semaphore.Timeout, self.semaphore.acquire,
+                              timeout=0)
+        self.semaphore.release()
+        self.assertEqual(self.semaphore.count, 1)
+        self.assertEqual(len(self.semaphore.evt_queue), 0)
+    
+    def test_tombstones_are_swept(self):
+        thread = self.wait()
+        for i in xrange(200):
+            self.assertRaises(Semaphore.Timeout, self.semaphore.acquire,
+                              timeout=0)
+            self.assertTrue(len(self.semaphore.evt_queue) <= 2 + 64)
+        self.assertEqual(self.semaphore.waiting, 1)
+        self.semaphore.release()
+        thread.join()
+        self.assertEqual(self.results, [True])
+    
+    def test_cancel_all(self):
+        threads = [self.wait() for i in xrange(2)]
+        self.semaphore.cancel_all()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(map(type, self.results),
+                         [Semaphore.WaitCancelled] * 2)
+        self.assertEqual(self.semaphore.waiting, 0)
+
+
+class ContendedPushManyTest(unittest.TestCase):
+    
+    # A batch of items pushed while a pull_many() and a pull() are both
+    # waiting must be shared out between them, without either finding the
+    # queue empty or the count going negative. (pull_many() goes on waiting
+    # for more until its timeout runs out, so that's kept short.)
+    
+    def check(self, queue, many, one):
+        for result in (many, one):
+            if isinstance(result, Exception):
+                raise result
+        self.assertEqual(sorted(many + [one]), ['a', 'b', 'c'])
+        self.assertEqual(len(many), 2)
+        self.assertEqual(queue.semaphore.count, 0)
+        self.assertEqual(len(queue), 0)
+    
+    def test_async(self):
+        from eventlet import api
+        queue = Queue(mode='async')
+        results = {}
+        def run(name, function, *args, **kwargs):
+            try:
+                results[name] = function(*args, **kwargs)
+            except Exception, exc:
+                results[name] = exc
+        api.spawn(run, 'many', queue.pull_many, 10, timeout=0.2)
+        api.spawn(run, 'one', queue.pull, timeout=0.5)
+        api.sleep(0)
+        self.assertEqual(queue.semaphore.waiting, 2)
+        queue.push_many('a', 'b', 'c')
+        wait_until(lambda: len(results) == 2, sleep=api.sleep)
+        self.check(queue, results['many'], results['one'])
+    
+    def test_sync(self):
+        queue = Queue(mode='sync')
+        results = {}
+        def pull_many():
+            results['many'] = queue.pull_many(10, timeout=1)
+        def pull():
+            results['one'] = queue.pull(timeout=5)
+        threads = [threading.Thread(target=pull_many)]
+        threads[0].start()
+        wait_until(lambda: queue.semaphore.waiting == 1)
+        threads.append(threading.Thread(target=pull))
+        threads[1].start()
+        wait_until(lambda: queue.semaphore.waiting == 2)
+        queue.push_many('a', 'b', 'c')
+        for thread in threads:
+            thread.join()
+        self.check(queue, results['many'], results['one'])
+    
+    def test_asyncio(self):
+        try:
+            from zenqueue.utils.aio import asyncio, From, Return
+        except ImportError:
+            return # Trollius isn't installed.
+        # The queue's futures are made for the default loop.
+        loop = asyncio.get_event_loop()
+        queue = Queue(mode='asyncio')
+        
+        @asyncio.coroutine
+        def main():
+            many = asyncio.async(queue.pull_many(10, timeout=0.2), loop=loop)
+            one = asyncio.async(queue.pull(timeout=0.5), loop=loop)
+            yield From(asyncio.sleep(0, loop=loop))
+            self.assertEqual(queue.semaphore.waiting, 2)
+            queue.push_many('a', 'b', 'c')
+            results = yield From(asyncio.gather(many, one, loop=loop))
+            raise Return(results)
+        
+        many, one = loop.run_until_complete(main())
+        self.check(queue, many, one)
+
+
+if __name__ == '__main__':
+    unittest.main()
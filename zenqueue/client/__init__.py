@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['common', 'http', 'native', 'QueueClient']
+__all__ = ['common', 'http', 'native', 'sharded', 'QueueClient']
 
 
 class QueueClient(object):
@@ -1,99 +1,478 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Benchmark the queue servers and clients under a range of workloads.
+
+Every combination of the chosen scenarios, methods (native/HTTP), modes
+(sync/async) and message sizes is run in turn, against a server started
+in-process for the purpose (or an existing one, given its address). Each run
+reports its throughput, along with HDR histograms of the time each message
+spent between being pushed and pulled, and of how long each push and pull
+request took. Pass `-j` to print the results as JSON.
+
+Scenarios are registered with `register()`; see `Scenario` for how to write
+another one.
+"""
+
 import optparse
+import sys
+import threading
 import time
 
-from zenqueue.client import QueueClient
+from zenqueue import json
 from zenqueue import log
+from zenqueue.client import QueueClient
+from zenqueue.utils.histogram import Histogram
+import zenqueue
+
+
+POLL_TIMEOUT = 0.1 # Seconds consumers wait before checking if they're done.
+STAMP_LENGTH = 17 # Every message starts with the time it was made.
 
 
 option_parser = optparse.OptionParser(
-    usage='python -m zenqueue.client.benchmark [options]', version='0.2')
+    usage='python -m zenqueue.client.benchmark [options]',
+    version=zenqueue.__version__)
 
-option_parser.add_option('-a', '--address', metavar='ADDR',
-    default='127.0.0.1:3000',
-    help='Contact server on address ADDR [default %default]')
+option_parser.add_option('-a', '--address', metavar='ADDR', default=None,
+    help='Contact the server on address ADDR, instead of starting one '
+         '(only one method may then be used)')
 
 option_parser.add_option('-l', '--log-level', metavar='LEVEL', default='SILENT',
     help='Set logging level to LEVEL [default %default]')
 
+option_parser.add_option('-S', '--scenarios', metavar='NAMES',
+    default='lockstep,pairs,fan-in,fan-out,many',
+    help='Run the comma-separated scenarios NAMES [default %default]')
+
+option_parser.add_option('-M', '--methods', metavar='METHODS',
+    default='native,http',
+    help='Use the comma-separated client METHODS [default %default]')
+
+option_parser.add_option('-m', '--modes', metavar='MODES', default='sync,async',
+    help='Use the comma-separated client MODES [default %default]')
+
+option_parser.add_option('-z', '--sizes', metavar='SIZES', default='64',
+    help='Send messages of each of the comma-separated SIZES, in bytes '
+         '[default %default]')
+
 option_parser.add_option('-n', '--num-messages', metavar='COUNT',
-    default=1000000, type='int',
-    help='Send/receive COUNT messages in total [default %default]')
+    default=10000, type='int',
+    help='Send/receive COUNT messages in each run [default %default]')
 
-option_parser.add_option('-u', '--unit-size', metavar='SIZE', default=10000,
+option_parser.add_option('-u', '--unit-size', metavar='SIZE', default=100,
     type='int',
     help='Send/receive messages in batches of SIZE [default %default]')
 
-option_parser.add_option('-m', '--message', metavar='MESSAGE', default='a',
-    help='Send/receive message MSG [default "%default"]')
+option_parser.add_option('-p', '--producers', metavar='COUNT', default=4,
+    type='int',
+    help='Use COUNT producers where a scenario has several [default %default]')
 
-option_parser.add_option('-s', '--synchronous', action='store_true',
-    default=False,
-    help='Use synchronous transfer mode [default asynchronous]')
+option_parser.add_option('-c', '--consumers', metavar='COUNT', default=4,
+    type='int',
+    help='Use COUNT consumers where a scenario has several [default %default]')
 
-option_parser.add_option('-t', '--http', action='store_true',
+option_parser.add_option('-b', '--binary', action='store_true',
     default=False,
-    help='Use HTTP instead of native client [default native]')
+    help='Use binary framing with the native client [default JSON]')
 
+option_parser.add_option('-f', '--prefetch', metavar='COUNT', default=0,
+    type='int',
+    help='Have native consumers prefetch COUNT messages [default none]')
 
-def main():
-    options, args = option_parser.parse_args()
+option_parser.add_option('-j', '--json', action='store_true', default=False,
+    help='Print the results as JSON')
 
-    # Set logging level
-    if options.log_level.upper() == 'SILENT':
-        log.silence()
-    else:
-        log.set_level(options.log_level.upper())
 
-    # Build address
-    split_addr = options.address.split(':')
-    if len(split_addr) == 1:
-        host, port = split_addr[0], 3000
-    elif len(split_addr) == 2:
-        host, port = split_addr[0], int(split_addr[1])
-    else:
-        print 'Invalid address specified; defaulting to 127.0.0.1:3000'
-        host, port = '127.0.0.1', 3000
+class Scenario(object):
+    
+    """
+    A workload to benchmark.
     
-    # Build message unit
-    message = options.message.decode('utf-8')
-    unit = [message] * options.unit_size
-    message_count = options.num_messages
+    By default, `producers` clients push to a single queue while `consumers`
+    clients pull from it, all at once; None for either means as many as were
+    asked for on the command line. Subclasses may override `run()` to do
+    something else entirely, recording into the run's histograms.
+    """
     
-    # Configure mode (sync/async).
-    mode = 'async'
-    if options.synchronous:
-        mode = 'sync'
+    producers = None
+    consumers = None
     
-    # Configure method (native/http)
-    method = 'native'
-    if options.http:
-        method = 'http'
+    def __init__(self, name, description, producers=None, consumers=None):
+        self.name = name
+        self.description = description
+        if producers is not None:
+            self.producers = producers
+        if consumers is not None:
+            self.consumers = consumers
     
-    client = QueueClient(mode=mode, method=method, host=host, port=port)
+    def workers(self, options):
+        # How many producers and consumers there are, in that order.
+        producers, consumers = self.producers, self.consumers
+        if producers is None:
+            producers = options.producers
+        if consumers is None:
+            consumers = options.consumers
+        return producers, consumers
     
-    start_time = time.time()
+    def run(self, run):
+        producers, consumers = self.workers(run.options)
+        shares = split(run.messages, producers)
+        targets = [lambda count=count: produce(run, count) for count in shares]
+        targets.extend([lambda: consume(run)] * consumers)
+        run.start()
+        run_workers(run.mode, targets)
+
+
+class LockStep(Scenario):
     
-    while message_count > 0:
-        client.push_many(*unit)
-        assert (client.pull_many(options.unit_size, timeout=0) == unit)
-        message_count -= options.unit_size
+    # A single client, pushing a batch and then pulling it straight back.
     
-    end_time = time.time()
+    producers = consumers = 1
     
-    if method == 'native':
+    def run(self, run):
+        def lock_step():
+            client = run.client()
+            push, pull = run.histogram('push'), run.histogram('pull')
+            latency = run.histogram('latency')
+            try:
+                remaining = run.messages
+                while remaining > 0:
+                    count = min(run.unit, remaining)
+                    batch = [make_message(run.size) for i in xrange(count)]
+                    start = time.time()
+                    client.push_many(queue=run.queue, *batch)
+                    middle = time.time()
+                    items = client.pull_many(count, timeout=0, queue=run.queue)
+                    end = time.time()
+                    push.record((middle - start) * 1e6)
+                    pull.record((end - middle) * 1e6)
+                    record_latency(latency, items, end)
+                    run.received(len(items))
+                    remaining -= count
+            finally:
+                client.close()
+        run.start()
+        run_workers(run.mode, [lock_step])
+
+
+SCENARIOS = {}
+ORDER = []
+
+
+def register(scenario):
+    if scenario.name not in SCENARIOS:
+        ORDER.append(scenario.name)
+    SCENARIOS[scenario.name] = scenario
+    return scenario
+
+
+register(LockStep('lockstep',
+    'One client pushing a batch, then pulling it back'))
+register(Scenario('pairs', 'One producer and one consumer', 1, 1))
+register(Scenario('fan-in', 'Many producers and one consumer', consumers=1))
+register(Scenario('fan-out', 'One producer and many consumers', producers=1))
+register(Scenario('many', 'Many producers and many consumers'))
+
+
+class Run(object):
+    
+    """The settings, progress and measurements of a single benchmark run."""
+    
+    def __init__(self, options, scenario, method, mode, size, address, queue):
+        self.options = options
+        self.scenario = scenario
+        self.method = method
+        self.mode = mode
+        self.size = size
+        self.address = address
+        self.queue = queue
+        self.messages = options.num_messages
+        self.unit = max(1, options.unit_size)
+        
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.remaining = self.messages
+        self.start_time = self.end_time = None
+    
+    def client(self, consumer=False):
+        kwargs = dict(mode=self.mode, method=self.method,
+                      host=self.address[0], port=self.address[1])
+        if self.method == 'native':
+            if self.options.binary:
+                kwargs['protocol'] = 'binary'
+            if consumer and self.options.prefetch:
+                kwargs['prefetch'] = self.options.prefetch
+                kwargs['prefetch_queue'] = self.queue
+        return QueueClient(**kwargs)
+    
+    def histogram(self, name):
+        # Each worker records into histograms of its own, which are merged
+        # into the run's when they're asked for.
+        histogram = Histogram()
+        self.lock.acquire()
+        try:
+            self.histograms.setdefault(name, []).append(histogram)
+        finally:
+            self.lock.release()
+        return histogram
+    
+    def start(self):
+        self.start_time = time.time()
+    
+    def received(self, count):
+        self.lock.acquire()
+        try:
+            self.remaining -= count
+            if self.remaining <= 0 and self.end_time is None:
+                self.end_time = time.time()
+        finally:
+            self.lock.release()
+    
+    @property
+    def finished(self):
+        return self.remaining <= 0
+    
+    def results(self):
+        seconds = self.end_time - self.start_time
+        producers, consumers = self.scenario.workers(self.options)
+        results = {
+            'scenario': self.scenario.name,
+            'method': self.method,
+            'mode': self.mode,
+            'protocol': self.method == 'native' and (
+                self.options.binary and 'binary' or 'json') or 'http',
+            'size': self.size,
+            'unit': self.unit,
+            'producers': producers,
+            'consumers': consumers,
+            'prefetch': self.method == 'native' and self.options.prefetch or 0,
+            'messages': self.messages,
+            'seconds': seconds,
+            'rate': self.messages / seconds,
+        }
+        # Times are given in microseconds.
+        for name, histograms in self.histograms.iteritems():
+            merged = Histogram()
+            for histogram in histograms:
+                merged.merge(histogram)
+            results[name] = merged.summary()
+        return results
+
+
+def make_message(size):
+    stamp = '%017.6f' % (time.time(),)
+    return stamp + 'x' * (size - STAMP_LENGTH)
+
+
+def record_latency(histogram, items, now):
+    for item in items:
+        histogram.record(max(0, now - float(item[:STAMP_LENGTH])) * 1e6)
+
+
+def produce(run, count):
+    client = run.client()
+    push = run.histogram('push')
+    try:
+        while count > 0:
+            batch = [make_message(run.size)
+                     for i in xrange(min(run.unit, count))]
+            start = time.time()
+            if len(batch) == 1:
+                client.push(batch[0], queue=run.queue)
+            else:
+                client.push_many(queue=run.queue, *batch)
+            push.record((time.time() - start) * 1e6)
+            count -= len(batch)
+    finally:
+        client.close()
+
+
+def consume(run):
+    client = run.client(consumer=True)
+    pull, latency = run.histogram('pull'), run.histogram('latency')
+    try:
+        while not run.finished:
+            start = time.time()
+            try:
+                if run.unit == 1:
+                    items = [client.pull(timeout=POLL_TIMEOUT,
+                                         queue=run.queue)]
+                else:
+                    items = client.pull_many(run.unit, timeout=POLL_TIMEOUT,
+                                             queue=run.queue)
+            except client.Timeout:
+                continue
+            now = time.time()
+            pull.record((now - start) * 1e6)
+            record_latency(latency, items, now)
+            run.received(len(items))
+    finally:
         client.close()
+
+
+def run_workers(mode, targets):
+    # Runs every target at once, as coroutines or threads to suit the mode,
+    # and waits for them all to finish. The first error is raised again here.
+    errors = []
+    def call(target):
+        try:
+            target()
+        except Exception:
+            errors.append(sys.exc_info())
+    
+    if mode == 'async':
+        from eventlet import api, coros
+        events = []
+        for target in targets:
+            event = coros.event()
+            api.spawn(lambda target=target, event=event: (call(target),
+                                                          event.send()))
+            events.append(event)
+        for event in events:
+            event.wait()
+    else:
+        threads = [threading.Thread(target=call, args=(target,))
+                   for target in targets]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+    
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def start_server(method):
+    
+    """
+    Start a server in a thread of its own, returning the address it's on.
+    
+    The server runs on its own hub in that thread, on a port picked by the
+    OS, until the process exits.
+    """
+    
+    if method == 'native':
+        from zenqueue.server.native import NativeQueueServer
+        server = NativeQueueServer()
+        serve = lambda: server.serve(interface='127.0.0.1', port=0)
+        listener = lambda: server.socket
+    else:
+        from zenqueue.server.http import HTTPQueueServer
+        server = HTTPQueueServer()
+        serve = lambda: server.serve(interface='127.0.0.1', port=0,
+                                     access_log=NullFile())
+        listener = lambda: getattr(server, 'sock', None)
+    
+    thread = threading.Thread(target=serve)
+    thread.setDaemon(True)
+    thread.start()
+    while listener() is None:
+        time.sleep(0.01)
+    return listener().getsockname()
+
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+
+def parse_address(address):
+    split_addr = address.split(':')
+    if len(split_addr) == 1:
+        return split_addr[0], 3000
+    elif len(split_addr) == 2:
+        return split_addr[0], int(split_addr[1])
+    raise ValueError('Invalid address: %r' % (address,))
+
+
+def split(total, parts):
+    # Divides `total` into `parts` counts which add back up to it.
+    return [total // parts + (i < total % parts) for i in xrange(parts)]
+
+
+def format_results(results):
+    # One line per run, with times in milliseconds.
+    def ms(histogram, key):
+        value = histogram.get(key)
+        if value is None:
+            return '-'
+        return '%0.2f' % (value / 1000.0,)
+    
+    latency = results.get('latency', {})
+    return ('%-9s %-6s %-5s %6dB %3dx%-3d %10.1f msg/s  '
+            'latency p50 %s p99 %s p999 %s max %s ms') % (
+        results['scenario'], results['method'], results['mode'],
+        results['size'], results['producers'], results['consumers'],
+        results['rate'], ms(latency, 'p50'), ms(latency, 'p99'),
+        ms(latency, 'p999'), ms(latency, 'max'))
+
+
+def main():
+    options, args = option_parser.parse_args()
+    
+    # Set logging level
+    if options.log_level.upper() == 'SILENT':
+        log.silence()
+    else:
+        log.set_level(options.log_level.upper())
+    
+    scenarios = options.scenarios.split(',')
+    methods = options.methods.split(',')
+    modes = options.modes.split(',')
+    try:
+        sizes = [max(STAMP_LENGTH, int(size))
+                 for size in options.sizes.split(',')]
+    except ValueError:
+        option_parser.error('Invalid message sizes: %r' % (options.sizes,))
+    for name in scenarios:
+        if name not in SCENARIOS:
+            option_parser.error('Unknown scenario: %r (choose from %s)' % (
+                name, ', '.join(ORDER)))
+    for method in methods:
+        if method not in ('native', 'http'):
+            option_parser.error('Unknown method: %r' % (method,))
+    for mode in modes:
+        if mode not in ('sync', 'async'):
+            option_parser.error('Unknown mode: %r' % (mode,))
+    
+    # eventlet's WSGI server prints a banner when it starts, which mustn't end
+    # up in the middle of the JSON.
+    output = sys.stdout
+    if options.json:
+        sys.stdout = sys.stderr
+    
+    addresses = {}
+    if options.address:
+        if len(methods) > 1:
+            option_parser.error('Only one method can be used with --address')
+        addresses[methods[0]] = parse_address(options.address)
     
-    time_taken = end_time - start_time
+    all_results = []
+    for method in methods:
+        if method not in addresses:
+            addresses[method] = start_server(method)
+        for name in scenarios:
+            for mode in modes:
+                for size in sizes:
+                    # Each run has a queue of its own, so that nothing left
+                    # over from one run can be picked up by another.
+                    queue = 'benchmark-%d' % (len(all_results),)
+                    run = Run(options, SCENARIOS[name], method, mode, size,
+                              addresses[method], queue)
+                    SCENARIOS[name].run(run)
+                    results = run.results()
+                    all_results.append(results)
+                    if not options.json:
+                        print >> output, format_results(results)
+                        output.flush()
     
-    print '%d messages transferred in chunks of %s' % (options.num_messages,
-                                                       options.unit_size)
-    print 'Time taken: %0.4f seconds' % (time_taken,)
-    print 'Average speed: %0.4f messages/second' % (
-        options.num_messages / time_taken,)
+    if options.json:
+        print >> output, json.dumps({'version': zenqueue.__version__,
+                          'runs': all_results}, indent=2, sort_keys=True)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
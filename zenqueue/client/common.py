@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from zenqueue import json
 from zenqueue import log
+from zenqueue.utils.codec import JSON, get as get_codec
+
+
+# Actions which come to the same thing if they're carried out twice, and so can
+# be tried again after the connection breaks part-way through. Anything else
+# might already have been carried out by the server (a push would be made
+# twice, and a pulled item lost), so the error is raised instead.
+RETRY_ACTIONS = frozenset(['extend', 'stats'])
 
 
 class AbstractQueueClient(object):
@@ -11,13 +18,22 @@ class AbstractQueueClient(object):
     class ClosedClientError(QueueClientError): pass
     class RequestError(QueueClientError): pass
     class Timeout(QueueClientError): pass
+    class Full(QueueClientError): pass
     class UnknownError(QueueClientError): pass
     
-    actions = ['push', 'push_many', 'pull', 'pull_many']
+    actions = ['push', 'push_many', 'pull', 'pull_many', 'ack', 'nack',
+        'extend', 'stats']
     log_name = 'zenq.client'
     
-    def __init__(self):
+    def __init__(self, codec=None):
         self.log = log.get_logger(self.log_name + ':%x' % (id(self),))
+        self.tracer = log.Tracer(self.log) # For debug output on each request.
+        
+        # Values are sent as they are, unless there's a codec to encode them
+        # with, in which case the server only ever sees byte strings.
+        self.codec = None
+        if codec is not None:
+            self.codec = get_codec(codec)
     
     def send(self, data):
         raise NotImplementedError
@@ -27,14 +43,16 @@ class AbstractQueueClient(object):
     
     def handle_response(self, data):
         try:
-            status, result = json.loads(data)
+            status, result = JSON.decode(data)
         except ValueError, exc:
             self.log.error('Invalid response returned: %r', data)
             raise
-        
+        return self.handle_status(status, result)
+    
+    def handle_status(self, status, result):
         # This handles the various response statuses the server can return.
+        # Successful requests are the common case, and aren't logged here.
         if status == 'success':
-            self.log.debug('Request successful')
             return result
         elif status == 'error:action':
             self.log.error('Action error occurred')
@@ -43,15 +61,93 @@ class AbstractQueueClient(object):
             self.log.error('Request error occurred')
             raise self.RequestError(result)
         elif status == 'error:timeout':
-            self.log.debug('Request timed out')
+            tracer = self.tracer
+            if tracer.enabled and tracer.sample():
+                self.log.debug('Request timed out')
             raise self.Timeout
+        elif status == 'error:full':
+            tracer = self.tracer
+            if tracer.enabled and tracer.sample():
+                self.log.debug('Queue is full')
+            raise self.Full
         elif status == 'error:unknown':
             self.log.error('Unknown error occurred')
             raise self.UnknownError(result)
     
+    def batch(self, requests):
+        
+        """
+        Carry out several `(action, args, kwargs)` requests in one round trip.
+        
+        The requests are sent to the server together, as a single `batch`
+        request, and carried out there one after the other. The results come
+        back in a list, in the same order as the requests; for any request
+        which failed, the exception it would have raised is put in its place
+        instead, without stopping the requests after it.
+        """
+        
+        return self.batch_results(self.action('batch',
+            [(action, list(args), kwargs) for action, args, kwargs in requests],
+            {}))
+    
+    def batch_results(self, responses):
+        results = []
+        for status, result in responses:
+            try:
+                results.append(self.handle_status(status, result))
+            except self.QueueClientError, exc:
+                results.append(exc)
+        return results
+    
+    def encode_values(self, action, args):
+        # Encodes the values being pushed with the client's codec.
+        if action == 'push' and args:
+            return (self.codec.encode(args[0]),) + tuple(args[1:])
+        elif action == 'push_many':
+            return tuple(self.codec.encode(value) for value in args)
+        elif action == 'batch':
+            return [(name, self.encode_values(name, command_args),
+                     command_kwargs)
+                    for name, command_args, command_kwargs in args]
+        return args
+    
+    def decode_values(self, action, args, kwargs, result):
+        # Decodes the values which were pulled, each of which comes paired
+        # with its lease ID if it was pulled with a lease.
+        decode = self.codec.decode
+        if action == 'pull':
+            if lease_option(args, kwargs, 2) is None:
+                return decode(result)
+            return [result[0], decode(result[1])]
+        elif action == 'pull_many':
+            if lease_option(args, kwargs, 3) is None:
+                return [decode(value) for value in result]
+            return [[lease_id, decode(value)] for lease_id, value in result]
+        elif action == 'batch':
+            # Only the results of the commands which succeeded are values.
+            responses = []
+            for (name, command_args, command_kwargs), (status, value) in zip(
+                    args, result):
+                if status == 'success':
+                    value = self.decode_values(name, command_args,
+                                               command_kwargs, value)
+                responses.append([status, value])
+            return responses
+        return result
+    
     def __getattr__(self, attribute):
         if attribute in self.actions:
             def wrapper(*args, **kwargs):
                 return self.action(attribute, args, kwargs)
             return wrapper
         raise AttributeError(attribute)
+
+
+def lease_option(args, kwargs, index):
+    # Finds the `lease` argument to a pull, which is positional argument
+    # `index` if it isn't given by keyword.
+    if 'lease' in kwargs:
+        return kwargs['lease']
+    elif len(args) > index:
+        return args[index]
+    return None
@@ -1,33 +1,264 @@
 # -*- coding: utf-8 -*-
 
+from collections import deque
+import errno
+import select
+import socket
 import urllib
 
-from urlobject import URLObject
+from zenqueue.client.common import AbstractQueueClient, RETRY_ACTIONS
+from zenqueue.utils.codec import JSON
 
-from zenqueue import json
-from zenqueue.client.common import AbstractQueueClient
+
+DEFAULT_POOL_SIZE = 10 # Idle connections kept open for reuse.
+
+HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+
+# Errors which mean a kept-alive connection was closed by the server, in which
+# case the request may be worth making again (see RETRY_ACTIONS).
+BROKEN_PIPE_ERRORS = (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN,
+                      errno.EBADF)
 
 
 class HTTPQueueClient(AbstractQueueClient):
     
+    """
+    A client for the HTTP server, which keeps its connections alive.
+    
+    Connections to the server are HTTP/1.1 and kept open between requests,
+    with up to `pool_size` idle ones held for reuse; concurrent requests each
+    take a connection of their own. `pipelined()` sends several requests down
+    one connection without waiting for each response in turn.
+    """
+    
     log_name = 'zenq.client.http'
+    httplib = NotImplemented # The httplib module to make connections with.
     
-    def __init__(self, host='127.0.0.1', port=3080):
-        super(HTTPQueueClient, self).__init__() # Initializes logging.
+    def __init__(self, host='127.0.0.1', port=3080,
+                 pool_size=DEFAULT_POOL_SIZE, codec=None):
+        # Initializes logging and the codec.
+        super(HTTPQueueClient, self).__init__(codec=codec)
+        if self.codec is not None and self.codec.binary:
+            raise ValueError('The HTTP client can only use text codecs, '
+                             'not %r' % (self.codec.name,))
         
         self.host = host
         self.port = port
+        self.pool_size = pool_size
+        self.idle = deque()
+        self.paths = {} # Caches the path for each action.
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
+    
+    def close(self):
+        # Other threads may be taking connections at the same time, so the
+        # deque is only ever popped, never checked first.
+        while True:
+            try:
+                connection = self.idle.pop()
+            except IndexError:
+                break
+            connection.close()
+    
+    def path(self, action):
+        try:
+            return self.paths[action]
+        except KeyError:
+            path = self.paths[action] = '/' + urllib.quote(action) + '/'
+            return path
     
-    def send(self, url, data=''):
-        raise NotImplementedError
+    def take(self):
+        # Returns an idle connection if there is one, or a new one if not,
+        # along with whether it has been used before. Idle connections which
+        # the server has closed in the meantime are dropped first, since a
+        # request can't always be made again once it's been sent.
+        while True:
+            try:
+                connection = self.idle.pop()
+            except IndexError:
+                break
+            if not is_stale(connection.sock):
+                return connection, True
+            connection.close()
+        return self.connect(), False
+    
+    def connect(self):
+        connection = self.httplib.HTTPConnection(self.host, self.port)
+        connection.connect()
+        # Requests are small and may be written in more than one piece (or
+        # pipelined), so they're sent straight away rather than held back
+        # waiting for the server to acknowledge the last piece.
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+    
+    def give_back(self, connection, will_close):
+        if will_close or len(self.idle) >= self.pool_size:
+            connection.close()
+        else:
+            self.idle.append(connection)
+    
+    def send(self, action, data=''):
+        path = self.path(action)
+        connection, reused = self.take()
+        try:
+            connection.request('POST', path, data, HEADERS)
+            response = connection.getresponse()
+            # Unsuccessful responses carry an error status in their body, so
+            # they're read just the same as successful ones.
+            result = response.read()
+        except (self.httplib.HTTPException, socket.error), exc:
+            connection.close()
+            if not (reused and self.can_retry(action, exc)):
+                raise
+            # A kept-alive connection may have been closed by the server while
+            # it sat idle, so the request is tried again on a new one.
+            self.log.debug('Connection broken (%r); reconnecting', exc)
+            try:
+                connection = self.connect()
+                connection.request('POST', path, data, HEADERS)
+                response = connection.getresponse()
+                result = response.read()
+            except:
+                connection.close()
+                raise
+        self.give_back(connection, response.will_close)
+        return result
+    
+    def can_retry(self, action, exc):
+        # A connection closed without a byte of the response coming back was
+        # most likely closed while it sat idle, before the request arrived.
+        # Any other failure may have come after the server carried out the
+        # request, so only requests which are safe to repeat are retried.
+        if isinstance(exc, self.httplib.BadStatusLine):
+            return is_empty_status(exc)
+        return action in RETRY_ACTIONS and is_broken_pipe(exc)
     
     def action(self, action, args, kwargs):
-        # It's really pathetic, but it's still debugging output.
-        self.log.debug('Action %r called with %d args', action,
-            len(args) + len(kwargs))
+        # It's really pathetic, but it's still debugging output. Only some
+        # requests (if any) are traced; see log.Tracer.
+        tracer = self.tracer
+        if tracer.enabled and tracer.sample():
+            self.log.debug('Action %r called with %d args', action,
+                len(args) + len(kwargs))
+        
+        codec = self.codec
+        if codec is not None:
+            args = self.encode_values(action, args)
+        received_data = self.send(action, data=JSON.encode([args, kwargs]))
+        if codec is not None:
+            return self.decode_values(action, args, kwargs,
+                                      self.handle_response(received_data))
+        return self.handle_response(received_data)
+    
+    def pipelined(self, requests):
+        
+        """
+        Send several `(action, args, kwargs)` requests at once.
+        
+        Every request is written to a single connection before any of the
+        responses are read, saving a round trip for each. The results come
+        back in a list, in the same order as the requests; for any request
+        which failed, the exception it would have raised is put in its place
+        instead, so that the other results aren't lost.
+        """
         
-        path = '/' + urllib.quote(action) + '/'        
-        url = URLObject(host=self.host).with_port(self.port).with_path(path)
-        received_data = self.send(url, data=json.dumps([args, kwargs]))
+        if self.codec is not None:
+            requests = [(action, self.encode_values(action, args), kwargs)
+                        for action, args, kwargs in requests]
+        else:
+            requests = list(requests)
+        connection = self.take()[0]
+        try:
+            connection.sock.sendall(''.join(
+                self.encode_request(action, args, kwargs)
+                for action, args, kwargs in requests))
+            
+            reader = SharedReader(connection.sock)
+            bodies = []
+            will_close = False
+            for request in requests:
+                response = self.httplib.HTTPResponse(reader, method='POST')
+                response.begin()
+                bodies.append(response.read())
+                will_close = will_close or response.will_close
+        except:
+            connection.close()
+            raise
+        self.give_back(connection, will_close)
         
-        return self.handle_response(received_data)
\ No newline at end of file
+        results = []
+        for (action, args, kwargs), body in zip(requests, bodies):
+            try:
+                result = self.handle_response(body)
+                if self.codec is not None:
+                    result = self.decode_values(action, args, kwargs, result)
+                results.append(result)
+            except self.QueueClientError, exc:
+                results.append(exc)
+        return results
+    
+    def encode_request(self, action, args, kwargs):
+        data = JSON.encode([args, kwargs])
+        return ('POST %s HTTP/1.1\r\n'
+                'Host: %s:%d\r\n'
+                'Content-Type: %s\r\n'
+                'Content-Length: %d\r\n'
+                '\r\n%s') % (self.path(action), self.host, self.port,
+                             HEADERS['Content-Type'], len(data), data)
+
+
+class SharedReader(object):
+    
+    """
+    Gives every pipelined response the same buffered reader for a socket.
+    
+    `HTTPResponse` reads from `sock.makefile()`, normally unbuffered so as not
+    to read past the end of its own response, and closes it when it's done.
+    Sharing one buffered reader between all of the responses, which they
+    can't close, means none of the data read ahead for later responses is
+    lost, and the socket isn't read a byte at a time.
+    """
+    
+    def __init__(self, sock):
+        self.fp = sock.makefile('rb')
+    
+    def makefile(self, *args):
+        return self
+    
+    def read(self, *args):
+        return self.fp.read(*args)
+    
+    def readline(self, *args):
+        return self.fp.readline(*args)
+    
+    def close(self):
+        pass
+
+
+def is_stale(sock):
+    # An idle connection should have nothing to read; if it does, the server
+    # has either closed it or sent something it shouldn't have.
+    if sock is None:
+        return True
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def is_broken_pipe(exc):
+    return (isinstance(exc, socket.error) and bool(exc.args) and
+            exc.args[0] in BROKEN_PIPE_ERRORS)
+
+
+def is_empty_status(exc):
+    # Whether a BadStatusLine came from reading nothing at all. Older copies
+    # of httplib give the (empty) line itself, or its repr, and newer ones a
+    # message saying so.
+    line = exc.line
+    return line in ('', "''") or line.startswith('No status line received')
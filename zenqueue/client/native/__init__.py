@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['async', 'common', 'sync', 'QueueClient']
+__all__ = ['aio', 'async', 'common', 'pool', 'sync', 'QueueClient',
+    'QueueClientPool']
 
 
 class QueueClient(object):
@@ -10,6 +11,20 @@ class QueueClient(object):
             from zenqueue.client.native.async import QueueClient
         elif mode == 'sync':
             from zenqueue.client.native.sync import QueueClient
+        elif mode == 'asyncio':
+            from zenqueue.client.native.aio import QueueClient
         else:
             raise ValueError('Invalid client mode: %r' % (mode,))
-        return QueueClient(*args, **kwargs)
\ No newline at end of file
+        return QueueClient(*args, **kwargs)
+
+
+class QueueClientPool(object):
+    
+    def __new__(cls, mode='async', *args, **kwargs):
+        if mode == 'async':
+            from zenqueue.client.native.async import QueueClientPool
+        elif mode == 'sync':
+            from zenqueue.client.native.sync import QueueClientPool
+        else:
+            raise ValueError('Invalid client pool mode: %r' % (mode,))
+        return QueueClientPool(*args, **kwargs)
\ No newline at end of file
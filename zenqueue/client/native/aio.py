@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+from zenqueue.client.common import AbstractQueueClient
+from zenqueue.client.native.common import choose_protocol
+from zenqueue.utils import framing
+from zenqueue.utils.codec import JSON
+from zenqueue.utils.aio import (asyncio, From, Return, Lock, read_frame,
+    read_line, STREAM_LIMIT)
+
+
+class QueueClient(AbstractQueueClient):
+    
+    """
+    A native protocol client which runs on an asyncio event loop.
+    
+    Every action is a coroutine, and so must be yielded from:
+        
+        value = yield From(client.pull(timeout=5))
+    
+    The connection is opened by the first action (or by yielding from
+    `connect()`), since a constructor can't wait for it.
+    """
+    
+    log_name = 'zenq.client.native.aio'
+    
+    def __init__(self, host='127.0.0.1', port=3000, protocol=None,
+                 loop=None, codec=None):
+        # Initializes the log and the codec.
+        super(QueueClient, self).__init__(codec=codec)
+        
+        self.address = (host, port)
+        self.loop = loop
+        self.reader = None
+        self.writer = None
+        self.__closed = False
+        
+        self.lock = Lock()
+        
+        # See NativeQueueClient for how protocols are negotiated.
+        self.protocol = 'json'
+        self.requested_protocol = choose_protocol(protocol, self.codec)
+    
+    @asyncio.coroutine
+    def connect(self):
+        yield From(self.lock.acquire())
+        try:
+            yield From(self._connect())
+        finally:
+            self.lock.release()
+    
+    @asyncio.coroutine
+    def _connect(self):
+        # Must be called with the lock held.
+        if self.__closed:
+            raise self.ClosedClientError
+        if self.writer is not None:
+            return
+        
+        self.log.info('Connecting to server at address %r', self.address)
+        self.reader, self.writer = yield From(asyncio.open_connection(
+            self.address[0], self.address[1], loop=self.loop,
+            limit=STREAM_LIMIT))
+        
+        if self.requested_protocol != 'json':
+            protocol = yield From(self._send('protocol',
+                (self.requested_protocol,), {}))
+            self.protocol = str(protocol)
+    
+    @asyncio.coroutine
+    def close(self):
+        yield From(self.lock.acquire())
+        try:
+            if self.writer is not None:
+                self.writer.write(self.encode_request('quit', (), {}))
+                self.writer.close()
+            self.reader = self.writer = None
+            self.__closed = True
+        finally:
+            self.lock.release()
+            self.lock.cancel_all()
+    
+    @asyncio.coroutine
+    def action(self, action, args, kwargs):
+        # It's really pathetic, but it's still debugging output. Only some
+        # requests (if any) are traced; see log.Tracer.
+        tracer = self.tracer
+        if tracer.enabled and tracer.sample():
+            self.log.debug('Action %r called with %d args', action,
+                len(args) + len(kwargs))
+        
+        codec = self.codec
+        if codec is not None:
+            args = self.encode_values(action, args)
+        yield From(self.lock.acquire())
+        try:
+            yield From(self._connect())
+            result = yield From(self._send(action, args, kwargs))
+        finally:
+            self.lock.release()
+        if codec is not None:
+            result = self.decode_values(action, args, kwargs, result)
+        raise Return(result)
+    
+    @asyncio.coroutine
+    def batch(self, requests):
+        responses = yield From(self.action('batch',
+            [(action, list(args), kwargs) for action, args, kwargs in requests],
+            {}))
+        raise Return(self.batch_results(responses))
+    
+    @asyncio.coroutine
+    def _send(self, action, args, kwargs):
+        # Must be called with the lock held.
+        self.writer.write(self.encode_request(action, args, kwargs))
+        yield From(self.writer.drain())
+        
+        if self.protocol == 'binary':
+            data = yield From(read_frame(self.reader, None))
+        else:
+            data = yield From(read_line(self.reader))
+        if data is None:
+            raise self.ClosedClientError
+        
+        if self.protocol == 'binary':
+            raise Return(self.handle_status(*framing.decode_response(data)))
+        raise Return(self.handle_response(data))
+    
+    def encode_request(self, action, args, kwargs):
+        if self.protocol == 'binary':
+            return framing.frame(framing.encode_request(action, args, kwargs))
+        return JSON.encode([action, args, kwargs]) + '\r\n'
+    
+    @property
+    def closed(self):
+        return self.__closed
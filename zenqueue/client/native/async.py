@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import socket
+
 from eventlet import api
 
 from zenqueue.client.native.common import NativeQueueClient
-from zenqueue.utils.async import Lock
+from zenqueue.client.native.pool import NativeQueueClientPool
+from zenqueue.utils.async import Lock, Semaphore
 
 
 class QueueClient(NativeQueueClient):
@@ -12,4 +15,19 @@ class QueueClient(NativeQueueClient):
     
     def connect_tcp(self, address):
         self.log.info('Connecting to server at address %r', address)
-        return api.connect_tcp(address)
+        sock = api.connect_tcp(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    
+    def wait_socket(self, timeout):
+        try:
+            api.trampoline(self.socket, read=True, timeout=timeout)
+        except api.TimeoutError:
+            return False
+        return True
+
+
+class QueueClientPool(NativeQueueClientPool):
+    
+    client_class = QueueClient
+    semaphore_class = Semaphore
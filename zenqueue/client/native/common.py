@@ -3,13 +3,44 @@
 from collections import deque
 import errno
 import socket
+import time
 
-from zenqueue import json
 from zenqueue import log
 from zenqueue.client.common import AbstractQueueClient
+from zenqueue.queue.registry import DEFAULT_QUEUE
+from zenqueue.utils import framing
+from zenqueue.utils.codec import JSON
 
 
 CLOSE_SIGNAL = object() # A sort of singleton, which you can test with `is`.
+DEFAULT_CREDIT = 100 # Items the server may send a subscriber at once.
+
+# How a batch of streamed items starts, in each protocol.
+ITEMS_CODE = framing.STATUS_CODES['items']
+ITEMS_PREFIX = '["items"'
+
+
+class PendingResponse(object):
+    
+    """A slot for the response to a request which has been pipelined."""
+    
+    __slots__ = ('done', 'data', 'error')
+    
+    def __init__(self):
+        self.done = False
+        self.data = None
+        self.error = None
+    
+    def set(self, data):
+        self.data, self.done = data, True
+    
+    def fail(self, error):
+        self.error, self.done = error, True
+    
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.data
 
 
 class NativeQueueClient(AbstractQueueClient):
@@ -17,8 +48,17 @@ class NativeQueueClient(AbstractQueueClient):
     log_name = 'zenq.client.native'
     lock_class = NotImplemented
     
-    def __init__(self, host='127.0.0.1', port=3000):
-        super(NativeQueueClient, self).__init__() # Initializes the log.
+    def __init__(self, host='127.0.0.1', port=3000, protocol=None,
+                 pipeline=False, prefetch=0, prefetch_queue=DEFAULT_QUEUE,
+                 codec=None):
+        # Initializes the log and the codec.
+        super(NativeQueueClient, self).__init__(codec=codec)
+        
+        if prefetch and pipeline:
+            raise ValueError('Prefetching cannot be combined with pipelining')
+        # Codecs which don't produce text need the binary protocol, which
+        # is otherwise only used if asked for.
+        protocol = choose_protocol(protocol, self.codec)
         
         self.socket = self.connect_tcp((host, port))
         self.__reader = None
@@ -26,6 +66,29 @@ class NativeQueueClient(AbstractQueueClient):
         self.__closed = False
         
         self.lock = self.lock_class()
+        
+        # In pipelined mode, the lock above only covers writing requests, so
+        # that many may be in flight at once. Responses come back in the same
+        # order as the requests were written, and are read under a second lock.
+        self.pipeline = pipeline
+        self.read_lock = self.lock_class()
+        self.pending = deque()
+        
+        # With a prefetch window, the server sends up to `prefetch` items from
+        # prefetch_queue ahead of the pulls which will take them, and they're
+        # buffered in `prefetched` until then. More credit is granted as they
+        # are taken, without waiting for the server to acknowledge it.
+        self.prefetch = prefetch
+        self.prefetch_queue = prefetch_queue
+        self.prefetched = None # Becomes a deque once the server is sending.
+        self.taken = 0 # Items taken since credit was last granted.
+        self.credit_replies = 0 # Acknowledgements of credit not yet read.
+        
+        # Every connection starts off using JSON; other protocols have to be
+        # negotiated with the server first.
+        self.protocol = 'json'
+        if protocol != 'json':
+            self.switch_protocol(protocol)
     
     def connect_tcp(self, address):
         # This is an abstract supermethod.
@@ -46,7 +109,9 @@ class NativeQueueClient(AbstractQueueClient):
         # message and then closing the socket via the forced _close() method.
         self.lock.acquire()
         try:
-            self.writer.write(json.dumps(['quit']) + '\r\n')
+            if self.prefetched is not None:
+                self.end_prefetch()
+            self.writer.write(self.encode_request('quit', (), {}))
             self._close()
         except Exception, exc:
             self.log.error('Error %r occurred while closing connection', exc)
@@ -56,6 +121,7 @@ class NativeQueueClient(AbstractQueueClient):
     
     def _close(self):
         self.lock.cancel_all()
+        self.read_lock.cancel_all()
         
         # If it's already been closed, no need to close it.
         if not self.socket:
@@ -79,10 +145,11 @@ class NativeQueueClient(AbstractQueueClient):
     
     def send(self, data):
         
+        if self.pipeline:
+            return self.send_pipelined(data)
+        
         # Acquire the socket lock.
-        self.log.debug('Acquiring socket lock')
         self.lock.acquire()
-        self.log.debug('Socket lock acquired')
         
         if not self.socket:
             raise self.ClosedClientError
@@ -92,35 +159,254 @@ class NativeQueueClient(AbstractQueueClient):
             # terminated by CR/LF characters, but we won't try to
             # enforce this because we assume the client knows what
             # he/she/it is doing.
-            self.log.debug('Sending request data')
             self.writer.write(data)
             # Necessary to ensure the data is sent.
             self.writer.flush()
             
-            self.log.debug('Reading line from server')
             # This could block, in which case no other thread would be able to
             # use this client object until it were finished.
-            result = self.reader.readline().rstrip('\r\n')
-            self.log.debug('Line read from server')
+            result = self.read_response()
         except Exception, exc:
             self.log.error('Error %r occurred', exc)
             raise
         finally:
-            self.log.debug('Releasing socket lock')
             self.lock.release()
         
         return result
     
+    def send_pipelined(self, data):
+        response = PendingResponse()
+        
+        # Requests are queued up in the order they were written, which is also
+        # the order the server will answer them in.
+        self.lock.acquire()
+        try:
+            if not self.socket:
+                raise self.ClosedClientError
+            self.writer.write(data)
+            self.writer.flush()
+            self.pending.append(response)
+        finally:
+            self.lock.release()
+        
+        # Whoever holds the read lock reads responses, handing each one to the
+        # oldest pending request, until its own has arrived. Anyone whose
+        # response was read on their behalf will find it waiting for them when
+        # they get the lock, and won't need to touch the socket at all.
+        self.read_lock.acquire()
+        try:
+            while not response.done:
+                try:
+                    result = self.read_response()
+                except Exception, exc:
+                    self.log.error('Error %r occurred', exc)
+                    # None of the outstanding requests can be answered now.
+                    while self.pending:
+                        self.pending.popleft().fail(exc)
+                    raise
+                self.pending.popleft().set(result)
+        finally:
+            self.read_lock.release()
+        
+        return response.get()
+    
+    def request(self, action, args, kwargs):
+        # Makes a request while the lock is already held.
+        self.writer.write(self.encode_request(action, args, kwargs))
+        self.writer.flush()
+        return self.handle_status(*self.decode_response(self.read_response()))
+    
+    def read_response(self):
+        # Prefetched items may arrive in between responses, as may the
+        # acknowledgements of credit granted for them; both are dealt with
+        # here, so that only the response itself is returned.
+        data = self.read_message()
+        if self.prefetched is not None:
+            while self.read_stream(data):
+                data = self.read_message()
+        return data
+    
+    def read_message(self):
+        if self.protocol == 'binary':
+            result = framing.read_frame(self.reader, None)
+            if result is None:
+                raise self.ClosedClientError
+        else:
+            line = self.reader.readline()
+            if not line:
+                raise self.ClosedClientError
+            result = line.rstrip('\r\n')
+        return result
+    
     def action(self, action, args, kwargs):
-        # It's really pathetic, but it's still debugging output.
-        self.log.debug('Action %r called with %d args', action,
-            len(args) + len(kwargs))
+        # It's really pathetic, but it's still debugging output. Only some
+        # requests (if any) are traced; see log.Tracer.
+        tracer = self.tracer
+        if tracer.enabled and tracer.sample():
+            self.log.debug('Action %r called with %d args', action,
+                len(args) + len(kwargs))
         
-        # This method is responsible for the JSON encoding/decoding, not send().
+        # This method is responsible for the encoding/decoding, not send().
         # This was deliberate because it keeps most of the protocol details
         # separate from the lower-level socket code.
-        received_data = self.send(json.dumps([action, args, kwargs]) + '\r\n')
-        return self.handle_response(received_data)
+        codec = self.codec
+        if codec is not None:
+            args = self.encode_values(action, args)
+        received_data = self.send(self.encode_request(action, args, kwargs))
+        if self.protocol == 'binary':
+            result = self.handle_status(*framing.decode_response(received_data))
+        else:
+            result = self.handle_response(received_data)
+        if codec is not None:
+            return self.decode_values(action, args, kwargs, result)
+        return result
+    
+    def pull(self, *args, **kwargs):
+        if self.prefetch:
+            timeout, queue, lease = pull_options(*args, **kwargs)
+            if queue == self.prefetch_queue and lease is None:
+                return self.take_prefetched(1, timeout)[0]
+        return self.action('pull', args, kwargs)
+    
+    def pull_many(self, n, *args, **kwargs):
+        if self.prefetch:
+            timeout, queue, lease = pull_options(*args, **kwargs)
+            if queue == self.prefetch_queue and lease is None:
+                return self.take_prefetched(n, timeout)
+        return self.action('pull_many', (n,) + args, kwargs)
+    
+    def take_prefetched(self, n, timeout=None):
+        
+        """
+        Take up to `n` (or all, if None) of the items sent ahead by the server.
+        
+        The first call subscribes to the prefetch queue. If no items have been
+        sent yet, this waits for up to `timeout` seconds for the next batch.
+        """
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        self.lock.acquire()
+        try:
+            if not self.socket:
+                raise self.ClosedClientError
+            if self.prefetched is None:
+                self.log.debug('Prefetching up to %d items', self.prefetch)
+                self.request('subscribe', (), {'queue': self.prefetch_queue,
+                                               'credit': self.prefetch})
+                self.prefetched = deque()
+            
+            prefetched = self.prefetched
+            while not prefetched:
+                if deadline is not None and not self.wait_readable(
+                    max(0, deadline - time.time())):
+                    raise self.Timeout
+                data = self.read_message()
+                if not self.read_stream(data):
+                    # With no request outstanding, nothing else should come.
+                    self.handle_status(*self.decode_response(data))
+                    raise self.UnknownError('Unexpected response %r' % (data,))
+            
+            if n is None or n >= len(prefetched):
+                items = list(prefetched)
+                prefetched.clear()
+            else:
+                items = [prefetched.popleft() for i in xrange(n)]
+            
+            # Credit is granted back in bulk, once half of the window has been
+            # used up, so that the next batch is on its way before it's needed.
+            self.taken += len(items)
+            if self.taken >= max(1, self.prefetch // 2):
+                self.writer.write(self.encode_request('credit', (self.taken,),
+                                                      {}))
+                self.writer.flush()
+                self.credit_replies += 1
+                self.taken = 0
+        finally:
+            self.lock.release()
+        if self.codec is not None:
+            return map(self.codec.decode, items)
+        return items
+    
+    def read_stream(self, data):
+        # Returns True if `data` was a batch of prefetched items, or the
+        # acknowledgement of some credit, rather than a response.
+        if self.protocol == 'binary':
+            is_items = data[:1] == ITEMS_CODE
+        else:
+            is_items = data.startswith(ITEMS_PREFIX)
+        if is_items:
+            self.prefetched.extend(self.decode_response(data)[1])
+            return True
+        elif self.credit_replies:
+            self.credit_replies -= 1
+            return True
+        return False
+    
+    def end_prefetch(self):
+        # Stops the server from sending any more items, and hands back those
+        # which were sent but never taken (which all arrive before the reply
+        # to unsubscribe), putting them back on the front of the queue.
+        try:
+            self.request('unsubscribe', (), {})
+            unused = list(self.prefetched)
+            if unused:
+                self.log.debug('Returning %d prefetched items', len(unused))
+                self.request('unsubscribe', unused,
+                             {'queue': self.prefetch_queue})
+        except Exception, exc:
+            self.log.error('Error %r occurred returning prefetched items', exc)
+        self.prefetched = None
+    
+    def wait_readable(self, timeout):
+        # Whatever has already been read into the reader's buffer can be had
+        # straight away; otherwise this waits on the socket itself.
+        buffered = getattr(self.reader, '_rbuf', None)
+        if buffered is not None and buffered.tell():
+            return True
+        return self.wait_socket(timeout)
+    
+    def wait_socket(self, timeout):
+        # Returns True if the socket becomes readable within `timeout` seconds.
+        # This is an abstract supermethod.
+        raise NotImplementedError
+    
+    def decode_response(self, data):
+        # Returns the `(status, result)` pair from a response.
+        if self.protocol == 'binary':
+            return framing.decode_response(data)
+        return JSON.decode(data)
+    
+    def subscribe(self, queue=DEFAULT_QUEUE, credit=DEFAULT_CREDIT,
+                  lease=None):
+        
+        """
+        Have the items on a queue sent to this client as they arrive.
+        
+        Returns a `Subscription`, which is iterated over to receive the items
+        (or `[lease_id, value]` pairs, with a lease). The server sends no more
+        than `credit` items ahead of those which have been taken from it.
+        Until the subscription is closed, this client can't be used for
+        anything else; leased items should be acked with another client.
+        """
+        
+        if self.prefetch:
+            raise ValueError('Cannot subscribe while prefetching')
+        self.action('subscribe', (), {'queue': queue, 'credit': credit,
+                                      'lease': lease})
+        return Subscription(self, credit, lease)
+    
+    def encode_request(self, action, args, kwargs):
+        if self.protocol == 'binary':
+            return framing.frame(framing.encode_request(action, args, kwargs))
+        return JSON.encode([action, args, kwargs]) + '\r\n'
+    
+    def switch_protocol(self, protocol):
+        # The server acknowledges the switch using the current protocol, so
+        # this client only changes over once the response has been read.
+        self.protocol = str(self.action('protocol', (protocol,), {}))
     
     @property
     def reader(self):
@@ -141,3 +427,114 @@ class NativeQueueClient(AbstractQueueClient):
     @property
     def closed(self):
         return self.__closed
+
+
+def pull_options(timeout=None, queue=DEFAULT_QUEUE, lease=None):
+    return timeout, queue, lease
+
+
+def choose_protocol(protocol, codec):
+    if codec is not None and codec.binary:
+        if protocol == 'json':
+            raise ValueError('The %r codec needs the binary protocol' % (
+                codec.name,))
+        return 'binary'
+    elif protocol is None:
+        return 'json'
+    return protocol
+
+
+class Subscription(object):
+    
+    """
+    The items streamed to a subscribed client, in the order they were sent.
+    
+    Items are granted back to the server as credit once half of the credit
+    has been used up, so that the next batch is on its way while the rest are
+    being processed. `close()` unsubscribes, returning any items which had
+    already been sent; without a lease, these are no longer on the queue.
+    """
+    
+    def __init__(self, client, credit, lease=None):
+        self.client = client
+        self.credit = credit
+        self.lease = lease
+        self.items = deque()
+        self.taken = 0 # Items taken since credit was last granted.
+        self.unanswered = 0 # Credit requests not yet acknowledged.
+        self.closed = False
+    
+    def __iter__(self):
+        return self
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
+    
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        if self.taken >= max(1, self.credit // 2):
+            self.grant(self.taken)
+            self.taken = 0
+        while not self.items:
+            self.read()
+        self.taken += 1
+        return self.decode(self.items.popleft())
+    
+    def decode(self, item):
+        codec = self.client.codec
+        if codec is None:
+            return item
+        elif self.lease is None:
+            return codec.decode(item)
+        return [item[0], codec.decode(item[1])]
+    
+    def grant(self, credit):
+        # The acknowledgement is read along with the items, whenever it comes.
+        client = self.client
+        client.lock.acquire()
+        try:
+            if not client.socket:
+                raise client.ClosedClientError
+            client.writer.write(client.encode_request('credit', (credit,),
+                                                      {}))
+            client.writer.flush()
+            self.unanswered += 1
+        finally:
+            client.lock.release()
+    
+    def read(self):
+        # Reads the next message from the server. Returns True if it was the
+        # response to an unsubscribe request.
+        status, result = self.client.decode_response(
+            self.client.read_response())
+        if status == 'items':
+            self.items.extend(result)
+        elif status == 'success' and self.unanswered:
+            self.unanswered -= 1
+        else:
+            # Anything else is either an error or the end of the stream.
+            self.client.handle_status(status, result)
+            return True
+        return False
+    
+    def close(self):
+        if self.closed:
+            return map(self.decode, self.items)
+        self.closed = True
+        client = self.client
+        client.lock.acquire()
+        try:
+            client.writer.write(client.encode_request('unsubscribe', (), {}))
+            client.writer.flush()
+        finally:
+            client.lock.release()
+        while not self.read():
+            pass
+        leftover = map(self.decode, self.items)
+        self.items.clear()
+        return leftover
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import errno
+import select
+import socket
+import time
+
+from zenqueue.client.common import AbstractQueueClient, RETRY_ACTIONS
+
+
+DEFAULT_MAX_SIZE = 10 # Connections open at once.
+DEFAULT_MAX_IDLE = 60 # Seconds a connection may sit unused before it's closed.
+
+# Errors which mean the connection was broken, rather than anything being wrong
+# with the request.
+BROKEN_PIPE_ERRORS = (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN,
+                      errno.EBADF)
+
+
+class NativeQueueClientPool(AbstractQueueClient):
+    
+    """
+    A pool of native client connections, shared between threads/coroutines.
+    
+    Every action checks a connection out of the pool, uses it, and checks it
+    back in, so that up to `max_size` requests can be in progress at once
+    (any more wait, for up to `checkout_timeout` seconds, for a connection to
+    be checked back in). Connections are only opened when there isn't an idle
+    one to reuse, and idle ones are closed after `max_idle` seconds. Any other
+    keyword arguments are passed on to each client.
+    
+    Before an idle connection is reused it's checked for having been closed
+    by the server. If a request on a reused connection fails with a broken
+    pipe anyway, it's only tried again (once, on another connection) if it's
+    one of RETRY_ACTIONS, since the server may have carried it out already.
+    """
+    
+    log_name = 'zenq.client.native.pool'
+    client_class = NotImplemented
+    semaphore_class = NotImplemented
+    
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                 checkout_timeout=None, **client_kwargs):
+        super(NativeQueueClientPool, self).__init__() # Initializes the log.
+        
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.checkout_timeout = checkout_timeout
+        self.client_kwargs = client_kwargs
+        
+        # The semaphore counts the connections which may still be checked out.
+        # Idle connections are kept with the time they were checked in, most
+        # recent on the right, so the ones taken are those least likely to
+        # have gone stale.
+        self.slots = self.semaphore_class(initial=max_size)
+        self.idle = deque()
+        self.closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
+    
+    def checkout(self, timeout=Ellipsis):
+        """Take a connection from the pool, opening one if none are idle."""
+        
+        return self.take(timeout)[0]
+    
+    def take(self, timeout=Ellipsis):
+        # Returns a connection, and whether it has been used before.
+        if timeout is Ellipsis:
+            timeout = self.checkout_timeout
+        if self.closed:
+            raise self.ClosedClientError
+        try:
+            self.slots.acquire(timeout=timeout)
+        except self.slots.Timeout:
+            raise self.Timeout
+        
+        try:
+            now = time.time()
+            while True:
+                try:
+                    client, checked_in = self.idle.pop()
+                except IndexError:
+                    break
+                if now - checked_in > self.max_idle or is_stale(client):
+                    self.log.debug('Discarding stale connection')
+                    discard(client)
+                    continue
+                return client, True
+            
+            self.log.debug('Opening a new connection')
+            return self.client_class(**self.client_kwargs), False
+        except:
+            self.slots.release()
+            raise
+    
+    def checkin(self, client, broken=False):
+        """Give a connection back to the pool once it's finished with."""
+        
+        try:
+            if broken or self.closed or client.closed:
+                discard(client)
+            else:
+                self.idle.append((client, time.time()))
+                self.prune()
+        finally:
+            self.slots.release()
+    
+    def prune(self):
+        # Idle connections are closed oldest first, from the left.
+        cutoff = time.time() - self.max_idle
+        while self.idle and self.idle[0][1] < cutoff:
+            try:
+                client, checked_in = self.idle.popleft()
+            except IndexError:
+                break
+            discard(client)
+    
+    def action(self, action, args, kwargs):
+        client, reused = self.take()
+        try:
+            result = client.action(action, args, kwargs)
+        except (self.Timeout, self.Full, self.RequestError):
+            # The server answered, so the connection is still good.
+            self.checkin(client)
+            raise
+        except (socket.error, self.ClosedClientError), exc:
+            self.checkin(client, broken=True)
+            # The server may simply have closed a connection which sat idle
+            # for too long, so it's worth trying again with a new one, if that
+            # can't do any harm.
+            if not (reused and is_broken_pipe(exc) and
+                    action in RETRY_ACTIONS):
+                raise
+            self.log.info('Connection broken (%r); reconnecting', exc)
+            client = self.checkout()
+            try:
+                result = client.action(action, args, kwargs)
+            except (self.Timeout, self.Full, self.RequestError):
+                self.checkin(client)
+                raise
+            except:
+                self.checkin(client, broken=True)
+                raise
+        except:
+            # The server drops the connection after any other error.
+            self.checkin(client, broken=True)
+            raise
+        self.checkin(client)
+        return result
+    
+    def close(self):
+        # Connections which are checked out are closed when they come back.
+        self.closed = True
+        while self.idle:
+            discard(self.idle.popleft()[0])
+    
+    @property
+    def size(self):
+        """The number of connections open, whether idle or checked out."""
+        return len(self.idle) + self.max_size - self.slots.count
+
+
+def is_stale(client):
+    # An idle connection should have nothing to read; if it does, the server
+    # has either closed it or sent something it shouldn't have.
+    if client.closed or client.socket is None:
+        return True
+    try:
+        readable = select.select([client.socket], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def is_broken_pipe(exc):
+    if isinstance(exc, socket.error):
+        return exc.args and exc.args[0] in BROKEN_PIPE_ERRORS
+    return True # The server closed the connection.
+
+
+def discard(client):
+    try:
+        client.close()
+    except Exception:
+        pass
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import select
 import socket
 import threading
 
 from zenqueue.client.native.common import NativeQueueClient
-from zenqueue.utils.sync import Lock
+from zenqueue.client.native.pool import NativeQueueClientPool
+from zenqueue.utils.sync import Lock, Semaphore
 
 
 class QueueClient(NativeQueueClient):
@@ -15,4 +17,14 @@ class QueueClient(NativeQueueClient):
         self.log.info('Connecting to server at address %r', address)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return sock
+    
+    def wait_socket(self, timeout):
+        return bool(select.select([self.socket], [], [], timeout)[0])
+
+
+class QueueClientPool(NativeQueueClientPool):
+    
+    client_class = QueueClient
+    semaphore_class = Semaphore
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import time
+
+from zenqueue.client import QueueClient
+from zenqueue.client.common import AbstractQueueClient, lease_option
+from zenqueue.queue.registry import DEFAULT_QUEUE
+from zenqueue.utils.hashring import HashRing, DEFAULT_REPLICAS, ring_hash
+
+
+DEFAULT_POLL_INTERVAL = 0.1 # Seconds to wait on each shard of a spread queue.
+
+
+class ShardedQueueClient(AbstractQueueClient):
+    
+    """
+    A client which shares queues out between several queue servers.
+    
+    `nodes` is a list of servers, each given as a `'host:port'` string or a
+    `(host, port)` pair, and a client is connected to each one (any extra
+    keyword arguments are passed on to every client). Queues are placed on the
+    servers with a consistent hash ring, keyed on their names, so adding a
+    server only moves a small fraction of the queues to it.
+    
+    Normally a queue lives on a single server, and every request for it goes
+    straight there. With `spread` greater than one, each queue is spread over
+    that many servers instead: pushes go to each of its servers in turn (or,
+    given a `key`, always to the same one for that key), and pulls take from
+    whichever of them has anything.
+    """
+    
+    log_name = 'zenq.client.sharded'
+    
+    def __init__(self, nodes, mode='async', method='native', spread=1,
+                 replicas=DEFAULT_REPLICAS, poll_interval=DEFAULT_POLL_INTERVAL,
+                 **client_kwargs):
+        super(ShardedQueueClient, self).__init__() # Initializes the log.
+        
+        # asyncio clients return coroutines, which this can't wait on.
+        if mode == 'asyncio':
+            raise ValueError('The sharded client does not support asyncio')
+        self.mode = mode
+        self.method = method
+        self.client_kwargs = client_kwargs
+        self.spread = spread
+        self.poll_interval = poll_interval
+        
+        self.clients = {}
+        self.ring = HashRing(replicas=replicas)
+        self.turns = itertools.count() # For taking turns between servers.
+        for node in nodes:
+            self.add_node(node)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
+    
+    def add_node(self, node):
+        """Connect to another server, and move its share of queues onto it."""
+        
+        name, address = parse_node(node)
+        if name in self.clients:
+            return
+        kwargs = dict(self.client_kwargs, **address)
+        self.log.info('Adding server %s', name)
+        self.clients[name] = QueueClient(mode=self.mode, method=self.method,
+                                         **kwargs)
+        self.ring.add(name)
+    
+    def remove_node(self, node):
+        """
+        Disconnect from a server, moving its queues onto the others.
+        
+        Queues aren't migrated from one server to another, so any items left
+        on the removed server (or on any server, for queues which were moved
+        off it by `add_node()`) should be drained separately.
+        """
+        
+        name = parse_node(node)[0]
+        self.log.info('Removing server %s', name)
+        self.ring.remove(name)
+        self.clients.pop(name).close()
+    
+    def close(self):
+        for name in self.clients.keys():
+            self.clients.pop(name).close()
+    
+    def shards(self, queue=DEFAULT_QUEUE):
+        """Return the names of the servers which hold `queue`."""
+        
+        if self.spread > 1:
+            return self.ring.get_nodes(queue, self.spread)
+        return [self.ring.get(queue)]
+    
+    def pick(self, queue, key=None):
+        # Picks one of the queue's servers to push to.
+        shards = self.shards(queue)
+        if len(shards) == 1:
+            return shards[0]
+        elif key is not None:
+            return shards[ring_hash(key) % len(shards)]
+        return shards[self.turns.next() % len(shards)]
+    
+    def push(self, value, queue=DEFAULT_QUEUE, key=None, **kwargs):
+        node = self.pick(queue, key)
+        return self.clients[node].push(value, queue=queue, **kwargs)
+    
+    def push_many(self, *values, **kwargs):
+        queue = kwargs.pop('queue', DEFAULT_QUEUE)
+        node = self.pick(queue, kwargs.pop('key', None))
+        return self.clients[node].push_many(queue=queue, *values, **kwargs)
+    
+    def pull(self, timeout=None, queue=DEFAULT_QUEUE, lease=None):
+        shards = self.shards(queue)
+        if len(shards) == 1:
+            node = shards[0]
+            value = self.clients[node].pull(timeout=timeout, queue=queue,
+                                            lease=lease)
+        else:
+            node, value = self.poll(shards, 'pull', (), timeout, queue, lease)
+        if lease is not None:
+            return tag_lease(node, value)
+        return value
+    
+    def pull_many(self, n, timeout=None, queue=DEFAULT_QUEUE, lease=None):
+        shards = self.shards(queue)
+        if len(shards) == 1:
+            node = shards[0]
+            values = self.clients[node].pull_many(n, timeout=timeout,
+                                                  queue=queue, lease=lease)
+            if lease is not None:
+                return [tag_lease(node, pair) for pair in values]
+            return values
+        
+        # Take whatever each of the queue's servers already has, until there
+        # are n items. Only if none of them have anything is it worth waiting.
+        results = []
+        for node in self.rotate(shards):
+            wanted = n
+            if n is not None:
+                wanted = n - len(results)
+            try:
+                values = self.clients[node].pull_many(wanted, timeout=0,
+                    queue=queue, lease=lease)
+            except self.Timeout:
+                continue
+            if lease is not None:
+                values = [tag_lease(node, pair) for pair in values]
+            results.extend(values)
+            if n is not None and len(results) >= n:
+                break
+        if results:
+            return results
+        
+        node, values = self.poll(shards, 'pull_many', (n,), timeout, queue,
+                                 lease, waited=True)
+        if lease is not None:
+            return [tag_lease(node, pair) for pair in values]
+        return values
+    
+    def poll(self, shards, action, args, timeout, queue, lease,
+             waited=False):
+        
+        # Waits for any one of a spread queue's servers to answer `action`,
+        # returning which one did along with its result. A server can only be
+        # asked to wait on its own copy of the queue, so they're tried in turn,
+        # first without waiting at all (unless that's already been `waited`
+        # out), and then for up to poll_interval seconds each until the
+        # timeout runs out.
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        wait = 0
+        if waited:
+            wait = self.poll_interval
+        while True:
+            for node in self.rotate(shards):
+                if wait and deadline is not None:
+                    wait = min(self.poll_interval, deadline - time.time())
+                    if wait <= 0:
+                        raise self.Timeout
+                client = self.clients[node]
+                try:
+                    return node, getattr(client, action)(timeout=wait,
+                        queue=queue, lease=lease, *args)
+                except self.Timeout:
+                    pass
+            
+            if deadline is not None and time.time() >= deadline:
+                raise self.Timeout
+            wait = self.poll_interval
+    
+    def rotate(self, shards):
+        # Starts at a different server each time, so that none of them is
+        # always drained first.
+        start = self.turns.next() % len(shards)
+        return shards[start:] + shards[:start]
+    
+    def stats(self, **kwargs):
+        # Each server's statistics, by its name on the ring.
+        return dict((name, client.stats(**kwargs))
+                    for name, client in self.clients.iteritems())
+    
+    def batch(self, requests):
+        
+        """
+        Carry out several `(action, args, kwargs)` requests, in one round trip
+        to each of the servers they're for.
+        
+        Each request goes in the batch for whichever server it would have been
+        sent to on its own, and the results are put back in the same order as
+        the requests. Requests for the same queue go to the same server, so
+        they're still carried out in order. Those which can't be sent to a
+        single server (pulls from a spread queue, and `stats`) are made on
+        their own, once the batches are done.
+        """
+        
+        requests = [(action, list(args), dict(kwargs))
+                    for action, args, kwargs in requests]
+        results = [None] * len(requests)
+        batches = {}
+        alone = []
+        for index, (action, args, kwargs) in enumerate(requests):
+            node, request = self.route(action, args, kwargs)
+            if node is None:
+                alone.append(index)
+            elif node not in self.clients:
+                # A lease from a server which has since been removed.
+                results[index] = False
+            else:
+                batches.setdefault(node, []).append((index, request))
+        
+        for node, batch in batches.iteritems():
+            indices = [index for index, request in batch]
+            sent = [request for index, request in batch]
+            for index, (action, args, kwargs), result in zip(indices, sent,
+                    self.clients[node].batch(sent)):
+                if not isinstance(result, Exception):
+                    result = tag_leases(node, action, args, kwargs, result)
+                results[index] = result
+        
+        for index in alone:
+            action, args, kwargs = requests[index]
+            try:
+                results[index] = getattr(self, action)(*args, **kwargs)
+            except self.QueueClientError, exc:
+                results[index] = exc
+        return results
+    
+    def route(self, action, args, kwargs):
+        # Returns the server a batched request should go to, along with the
+        # request as it should be sent there, or None if it has to be made on
+        # its own. Queues are found where the servers' actions take them, by
+        # keyword or by position.
+        if action in ('ack', 'nack', 'extend'):
+            if 'lease_id' in kwargs:
+                node, kwargs['lease_id'] = kwargs['lease_id']
+            else:
+                node, lease_id = args[0]
+                args = [lease_id] + args[1:]
+            return node, (action, args, kwargs)
+        elif action == 'stats':
+            return None, None
+        elif action in ('pull', 'pull_many'):
+            index = 1
+            if action == 'pull_many':
+                index = 2
+            shards = self.shards(get_option(args, kwargs, 'queue', index))
+            if len(shards) > 1:
+                return None, None
+            return shards[0], (action, args, kwargs)
+        # Pushes, and anything else (which the server will refuse).
+        key = kwargs.pop('key', None)
+        queue = kwargs.get('queue', DEFAULT_QUEUE)
+        if action == 'push':
+            queue = get_option(args, kwargs, 'queue', 1)
+        return self.pick(queue, key), (action, args, kwargs)
+    
+    # Lease IDs are tagged with the server they came from, as `(node, id)`.
+    
+    def ack(self, lease_id, queue=DEFAULT_QUEUE):
+        return self.lease_action('ack', lease_id, (), queue)
+    
+    def nack(self, lease_id, queue=DEFAULT_QUEUE):
+        return self.lease_action('nack', lease_id, (), queue)
+    
+    def extend(self, lease_id, lease, queue=DEFAULT_QUEUE):
+        return self.lease_action('extend', lease_id, (lease,), queue)
+    
+    def lease_action(self, action, lease_id, args, queue):
+        node, lease_id = lease_id
+        # A lease from a server which has since been removed is as good as
+        # expired.
+        if node not in self.clients:
+            return False
+        return getattr(self.clients[node], action)(lease_id, queue=queue,
+                                                   *args)
+
+
+def parse_node(node):
+    # Returns the node's name on the ring, and the keyword arguments which
+    # give a client its address.
+    if isinstance(node, (tuple, list)):
+        host, port = node
+        return '%s:%d' % (host, port), {'host': host, 'port': int(port)}
+    elif ':' in node:
+        host, port = node.rsplit(':', 1)
+        return node, {'host': host, 'port': int(port)}
+    return node, {'host': node}
+
+
+def get_option(args, kwargs, name, index, default=DEFAULT_QUEUE):
+    # Finds an argument which may be given by keyword or as positional argument
+    # `index`.
+    if name in kwargs:
+        return kwargs[name]
+    elif len(args) > index:
+        return args[index]
+    return default
+
+
+def tag_lease(node, pair):
+    lease_id, value = pair
+    return [(node, lease_id), value]
+
+
+def tag_leases(node, action, args, kwargs, result):
+    # Tags the lease IDs in the result of a batched pull.
+    if action == 'pull' and lease_option(args, kwargs, 2) is not None:
+        return tag_lease(node, result)
+    elif action == 'pull_many' and lease_option(args, kwargs, 3) is not None:
+        return [tag_lease(node, pair) for pair in result]
+    return result
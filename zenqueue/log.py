@@ -4,6 +4,7 @@
 
 import logging
 import sys
+import weakref
 
 
 LOG_FORMATTER = logging.Formatter(
@@ -15,7 +16,7 @@ CONSOLE_HANDLER.setLevel(logging.DEBUG)
 CONSOLE_HANDLER.setFormatter(LOG_FORMATTER)
 
 ROOT_LOGGER = logging.getLogger('')
-ROOT_LOGGER.setLevel(logging.DEBUG) # Default logging level for library work.
+ROOT_LOGGER.setLevel(logging.INFO) # Default logging level for library work.
 ROOT_LOGGER.addHandler(CONSOLE_HANDLER)
 
 LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'FATAL', 'CRITICAL']
@@ -27,14 +28,62 @@ get_logger = logging.getLogger
 
 def set_level(level):
     ROOT_LOGGER.setLevel(getattr(logging, level))
+    refresh()
 
 def silence():
     global get_logger
     get_logger = lambda name: NullLogger()
-    ROOT_LOGGER.setLevel(float('inf'))
+    # Newer versions of logging only take integer levels.
+    ROOT_LOGGER.setLevel(logging.CRITICAL + 1)
+    refresh()
 
 
 class NullLogger(object):
     def __getattr__(self, attr):
         if attr.upper() in LOG_LEVELS:
             return lambda *args, **kwargs: None
+    
+    def isEnabledFor(self, level):
+        return False
+
+
+# Debug output about each request is only written if a Tracer says so. Asking
+# the logging module whether debug output is wanted takes a walk up the logger
+# hierarchy every time, so the answer is cached, and worked out again only
+# when the level is changed with set_level() or silence() (or refresh() is
+# called after changing it some other way). With set_sampling(n), only one
+# request in every n is traced, even when debug output is on.
+
+SAMPLE_EVERY = 1
+TRACERS = weakref.WeakKeyDictionary()
+
+class Tracer(object):
+    
+    def __init__(self, logger):
+        self.logger = logger
+        self.count = 0
+        self.refresh()
+        TRACERS[self] = True
+    
+    def refresh(self):
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+        self.every = SAMPLE_EVERY
+    
+    def sample(self):
+        # Whether to trace the next request. Check `enabled` first; there's
+        # no need to call this at all if it's False. This counts down to the
+        # next request to be traced, so that it costs as little as possible.
+        self.count -= 1
+        if self.count > 0:
+            return False
+        self.count = self.every
+        return True
+
+def set_sampling(every):
+    global SAMPLE_EVERY
+    SAMPLE_EVERY = max(1, int(every))
+    refresh()
+
+def refresh():
+    for tracer in TRACERS.keys():
+        tracer.refresh()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['async', 'common', 'sync', 'Queue']
+__all__ = ['aio', 'async', 'common', 'durable', 'registry', 'sync', 'Queue']
 
 
 class Queue(object):
@@ -12,4 +12,7 @@ class Queue(object):
         elif mode == 'sync':
             from zenqueue.queue import sync
             return sync.Queue(*args, **kwargs)
+        elif mode == 'asyncio':
+            from zenqueue.queue import aio
+            return aio.Queue(*args, **kwargs)
         raise ValueError('Invalid queue mode: %r' % (mode,))
\ No newline at end of file
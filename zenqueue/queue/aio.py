@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from zenqueue.queue.common import AbstractQueue
+from zenqueue.utils.aio import asyncio, From, Return, Semaphore
+
+
+class Queue(AbstractQueue):
+    
+    """
+    A queue for coroutines running on an asyncio event loop.
+    
+    `push()` and `push_many()` never block, so they work exactly as they do
+    for the other queues, except that they raise `Full` straight away if the
+    queue is bounded and has no room. `pull()` and `pull_many()` are
+    coroutines, and must be yielded from.
+    """
+    
+    semaphore_class = Semaphore
+    
+    def reserve(self, values, timeout=None, force=False):
+        # Waiting for space would mean push() had to be a coroutine.
+        return super(Queue, self).reserve(values, timeout=0, force=force)
+    
+    @asyncio.coroutine
+    def pull(self, timeout=None, lease=None):
+        if self.scheduled:
+            self.release_scheduled()
+        try:
+            yield From(self.semaphore.acquire(timeout=timeout))
+        except self.semaphore.Timeout:
+            raise self.Timeout
+        if lease is not None and self.priorities:
+            values, priorities = self.take_prioritized(1)
+            raise Return(self.take_leases(values, lease, priorities)[0])
+        value = self.queue.pop()
+        if self.bounded:
+            self.free([value])
+        if lease is not None:
+            raise Return(self.take_leases([value], lease)[0])
+        raise Return(value)
+    
+    @asyncio.coroutine
+    def pull_many(self, n, timeout=None, lease=None):
+        
+        if self.scheduled:
+            self.release_scheduled()
+        
+        # Shortcut for null consumers.
+        if n is None and timeout is None:
+            while True:
+                self.take((yield From(self.semaphore.acquire_many())))
+        
+        # See AbstractQueue.pull_many().
+        results = []
+        priorities = None
+        if lease is not None and self.priorities:
+            priorities = []
+        
+        wanted = n
+        while wanted is None or wanted > 0:
+            try:
+                count = yield From(self.semaphore.acquire_many(wanted,
+                    timeout=timeout))
+            except self.semaphore.Timeout:
+                if not results:
+                    raise self.Timeout
+                break
+            if priorities is None:
+                results.extend(self.take(count))
+            else:
+                values, levels = self.take_prioritized(count)
+                results.extend(values)
+                priorities.extend(levels)
+            if wanted is not None:
+                wanted -= count
+        
+        if lease is not None:
+            raise Return(self.take_leases(results, lease, priorities))
+        raise Return(results)
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from collections import deque
+import heapq
+import itertools
+import threading
+import time
+
+from zenqueue.utils import framing
+from zenqueue.utils.priority import PriorityDeque
+from zenqueue.utils.timerwheel import TimerWheel
 
 
 class AbstractQueue(object):
@@ -10,61 +18,435 @@ class AbstractQueue(object):
     class Timeout(Exception):
         pass
     
-    def __init__(self, initial=None):
-        self.queue = deque(initial or [])
-        self.semaphore = self.semaphore_class(initial=0)
+    class Full(Exception):
+        pass
+    
+    def __init__(self, initial=None, maxsize=None, maxbytes=None,
+                 priorities=False):
+        # A priority queue keeps its items in levels, with the highest level
+        # pulled from first. Otherwise it's a plain FIFO deque.
+        self.priorities = priorities
+        if priorities:
+            self.queue = PriorityDeque(initial or [])
+        else:
+            self.queue = deque(initial or [])
+        self.semaphore = self.semaphore_class(initial=len(self.queue))
+        
+        # A bounded queue keeps count of the items (and bytes) it holds, and
+        # producers wait on a second semaphore for space to be freed up. Each
+        # time some is, every producer waiting on that semaphore is woken, and
+        # any which wait after that use a fresh one (see reserve()).
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.bounded = maxsize is not None or maxbytes is not None
+        self.size = len(self.queue)
+        self.bytes = 0
+        if maxbytes is not None:
+            self.bytes = sum(map(sizeof, self.queue))
+        self.space = self.semaphore_class(initial=0)
+        self.space_waiters = 0 # Producers waiting on the current `space`.
+        self.space_lock = threading.Lock()
+        
+        # Items pulled with a lease are kept here, by lease ID, until they are
+        # acknowledged. If the lease runs out first, the item is put back on
+        # the queue to be delivered again.
+        self.leases = {}
+        self.lease_timers = TimerWheel()
+        self.lease_ids = itertools.count(1)
+        self.lease_lock = threading.Lock()
+        
+        # Items pushed with a delay wait in a heap, ordered by when they're due
+        # (and then by the order they were pushed), until they're released
+        # onto the queue proper.
+        self.scheduled = []
+        self.schedule_ids = itertools.count()
+        self.schedule_lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.queue)
     
-    def pull(self, timeout=None):
+    def pull(self, timeout=None, lease=None):
+        if self.scheduled:
+            self.release_scheduled()
         try:
             self.semaphore.acquire(timeout=timeout)
         except self.semaphore.Timeout:
             raise self.Timeout
-        return self.queue.pop()
+        if lease is not None and self.priorities:
+            values, priorities = self.take_prioritized(1)
+            return self.take_leases(values, lease, priorities)[0]
+        value = self.queue.pop()
+        if self.bounded:
+            self.free([value])
+        if lease is not None:
+            return self.take_leases([value], lease)[0]
+        return value
     
-    def pull_many(self, n, timeout=None):
+    def pull_many(self, n, timeout=None, lease=None):
+        
+        if self.scheduled:
+            self.release_scheduled()
         
         # Shortcut for null consumers.
         if n is None and timeout is None:
             while True:
-                self.pull()
-        
-        # If n is None, iterate indefinitely, otherwise n times.
-        if n is None:
-            gen = eternal(True)
-        else:
-            gen = xrange(n)
+                self.take(self.semaphore.acquire_many())
         
-        # Pull either n or infinity items from the queue until timeout.
+        # Pull either n or infinity items from the queue until timeout. Every
+        # item which is already available is taken at once; the semaphore only
+        # blocks (for up to `timeout` seconds) when the queue is empty.
         results = []
+        priorities = None
+        if lease is not None and self.priorities:
+            priorities = []
         
-        for i in gen:
+        wanted = n
+        while wanted is None or wanted > 0:
             try:
-                results.append(self.pull(timeout=timeout))
-            except self.Timeout:
+                count = self.semaphore.acquire_many(wanted, timeout=timeout)
+            except self.semaphore.Timeout:
                 if not results:
-                    raise
+                    raise self.Timeout
+                break
+            if priorities is None:
+                results.extend(self.take(count))
+            else:
+                values, levels = self.take_prioritized(count)
+                results.extend(values)
+                priorities.extend(levels)
+            if wanted is not None:
+                wanted -= count
         
+        if lease is not None:
+            return self.take_leases(results, lease, priorities)
         return results
     
-    def push(self, value):
+    def take(self, count):
+        # Removes and returns the next `count` items, which must already have
+        # been acquired from the semaphore.
+        items = self.pop_items(count)
+        if self.bounded:
+            self.free(items)
+        return items
+    
+    def take_prioritized(self, count):
+        # Like take(), but also returns the priority each item had, so that a
+        # priority queue can put a leased item back in its own level.
+        pop = self.queue.pop_with_priority
+        values, priorities = [], []
+        for i in xrange(count):
+            value, priority = pop()
+            values.append(value)
+            priorities.append(priority)
+        if self.bounded:
+            self.free(values)
+        return values, priorities
+    
+    def pop_items(self, count):
+        if count == len(self.queue):
+            items = list(self.queue)
+            items.reverse()
+            self.queue.clear()
+            return items
+        pop = self.queue.pop
+        return [pop() for i in xrange(count)]
+    
+    def push(self, value, timeout=None, priority=None, delay=None,
+             deliver_at=None):
+        if priority is not None and not self.priorities:
+            raise ValueError('Priorities need a queue with priorities=True')
+        due = due_time(delay, deliver_at)
+        
+        # A full queue makes the producer wait up to `timeout` seconds for
+        # space, or raises Full straight away if that's zero.
+        if self.bounded:
+            self.reserve([value], timeout=timeout)
+        
+        if due is not None:
+            self.schedule([value], due, priority)
+            return
+        
         # Add it to the inner queue. appendleft() is used because pop() removes
         # from the right.
-        self.queue.appendleft(value)
+        if priority is None:
+            self.queue.appendleft(value)
+        else:
+            self.queue.appendleft(value, priority)
         
         # If coroutines are waiting for items to be available, then this will
         # notify the first of these that there is at least one item on the
         # queue.
         self.semaphore.release()
     
-    def push_many(self, *values):
-        for value in values:
-            self.push(value)
+    def push_many(self, *values, **kwargs):
+        timeout, priority, delay, deliver_at = pop_push_options(kwargs)
+        if priority is not None and not self.priorities:
+            raise ValueError('Priorities need a queue with priorities=True')
+        due = due_time(delay, deliver_at)
+        if self.bounded:
+            self.reserve(values, timeout=timeout)
+        
+        if due is not None:
+            self.schedule(values, due, priority)
+            return
+        
+        # extendleft() adds each value in turn to the left, just as push()
+        # would, and the semaphore then wakes as many waiting consumers as
+        # there are new items, all at once.
+        if priority is None:
+            self.queue.extendleft(values)
+        else:
+            self.queue.extendleft(values, priority)
+        self.semaphore.release_many(len(values))
+    
+    def requeue(self, value, priority=None):
+        # Items being redelivered go to the front of the queue (or the front of
+        # their own priority level, or the highest one if it isn't known),
+        # since they were due to be processed before anything else there.
+        # They're let in even if the queue is full, as they were already on it
+        # once.
+        if self.bounded:
+            self.reserve([value], force=True)
+        if priority is None:
+            self.queue.append(value)
+        else:
+            self.queue.append(value, priority)
+        self.semaphore.release()
+    
+    def schedule(self, values, due, priority=None):
+        # Scheduled items count towards the size of a bounded queue, and so
+        # must already have been reserved.
+        self.schedule_lock.acquire()
+        try:
+            for value in values:
+                heapq.heappush(self.scheduled,
+                    (due, self.schedule_ids.next(), priority, value))
+        finally:
+            self.schedule_lock.release()
+    
+    def release_scheduled(self, now=None):
+        # Moves every scheduled item which is due onto the queue, and returns
+        # how many there were. Like expire_leases(), this needs to be called
+        # regularly, although pulling from the queue does so too.
+        if now is None:
+            now = time.time()
+        due = []
+        self.schedule_lock.acquire()
+        try:
+            while self.scheduled and self.scheduled[0][0] <= now:
+                due.append(heapq.heappop(self.scheduled))
+        finally:
+            self.schedule_lock.release()
+        
+        if due:
+            for due_at, schedule_id, priority, value in due:
+                if priority is None:
+                    self.queue.appendleft(value)
+                else:
+                    self.queue.appendleft(value, priority)
+            self.semaphore.release_many(len(due))
+        return len(due)
+    
+    def has_room(self, count, nbytes):
+        # Anything fits in an empty queue, so that an item (or a batch) which
+        # is bigger than the limit itself doesn't wait forever.
+        if not self.size:
+            return True
+        if self.maxsize is not None and self.size + count > self.maxsize:
+            return False
+        if self.maxbytes is not None and self.bytes + nbytes > self.maxbytes:
+            return False
+        return True
+    
+    def reserve(self, values, timeout=None, force=False):
+        # Counts the values towards the queue's size before they're added,
+        # waiting up to `timeout` seconds for there to be room for them.
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = sum(map(sizeof, values))
+        
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            remaining = None
+            self.space_lock.acquire()
+            try:
+                if force or self.has_room(len(values), nbytes):
+                    self.size += len(values)
+                    self.bytes += nbytes
+                    return
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise self.Full
+                # The producer signs up to be woken before the lock is let go,
+                # so that space freed up before it starts waiting still wakes
+                # it: free() releases the semaphore it's about to wait on once
+                # for every producer signed up to it.
+                space = self.space
+                self.space_waiters += 1
+            finally:
+                self.space_lock.release()
+            
+            # Every producer waiting for space is woken whenever some is freed
+            # up, and checks again whether there's enough for it.
+            try:
+                space.acquire(timeout=remaining)
+            except space.Timeout:
+                self.space_lock.acquire()
+                try:
+                    # Unless it's already been released for this producer.
+                    if space is self.space:
+                        self.space_waiters -= 1
+                finally:
+                    self.space_lock.release()
+                raise self.Full
+    
+    def free(self, items):
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = sum(map(sizeof, items))
+        self.space_lock.acquire()
+        try:
+            self.size -= len(items)
+            self.bytes -= nbytes
+            waiters = self.space_waiters
+            if waiters:
+                space = self.space
+                self.space = self.semaphore_class(initial=0)
+                self.space_waiters = 0
+        finally:
+            self.space_lock.release()
+        # Releasing may switch to another coroutine, so it's done once the
+        # lock has been let go.
+        if waiters:
+            space.release_many(waiters)
+    
+    # Leases are only ever touched with the lease lock held, as the sync queue
+    # may be used from several threads at once.
+    
+    def take_leases(self, values, lease, priorities=None):
+        # Returns the `[lease_id, value]` pairs which are handed to the
+        # consumer, in the same order as the values. Each lease keeps its item
+        # along with the priority it had (if it's known), to be requeued with.
+        deadline = time.time() + lease
+        pairs = []
+        if priorities is None:
+            priorities = itertools.repeat(None)
+        self.lease_lock.acquire()
+        try:
+            for value, priority in itertools.izip(values, priorities):
+                lease_id = self.lease_ids.next()
+                self.leases[lease_id] = (value, priority)
+                self.lease_timers.schedule(lease_id, deadline)
+                pairs.append([lease_id, value])
+        finally:
+            self.lease_lock.release()
+        return pairs
+    
+    def ack(self, lease_id):
+        # Returns False if the lease had already run out (or never existed), in
+        # which case the item may have been delivered to someone else.
+        self.lease_lock.acquire()
+        try:
+            if self.leases.pop(lease_id, Missing) is Missing:
+                return False
+            self.lease_timers.cancel(lease_id)
+        finally:
+            self.lease_lock.release()
+        return True
+    
+    def nack(self, lease_id):
+        # Gives the item back straight away, rather than waiting for the lease
+        # to run out.
+        self.lease_lock.acquire()
+        try:
+            leased = self.leases.pop(lease_id, Missing)
+            if leased is Missing:
+                return False
+            self.lease_timers.cancel(lease_id)
+        finally:
+            self.lease_lock.release()
+        self.redeliver(lease_id, leased)
+        return True
+    
+    def extend(self, lease_id, lease):
+        # The lease is renewed to run out `lease` seconds from now.
+        self.lease_lock.acquire()
+        try:
+            if lease_id not in self.leases:
+                return False
+            self.lease_timers.schedule(lease_id, time.time() + lease)
+        finally:
+            self.lease_lock.release()
+        return True
+    
+    def expire_leases(self, now=None):
+        # This needs to be called regularly (servers do so from a background
+        # coroutine); the timer wheel makes it cheap even with many leases.
+        self.lease_lock.acquire()
+        try:
+            expired = [(lease_id, self.leases.pop(lease_id))
+                       for lease_id in self.lease_timers.expire(now=now)]
+        finally:
+            self.lease_lock.release()
+        for lease_id, leased in expired:
+            self.redeliver(lease_id, leased)
+        return len(expired)
+    
+    def redeliver(self, lease_id, leased):
+        # Called with the (value, priority) pair of a lease which has been
+        # given up, once it's been removed from the leases.
+        self.requeue(*leased)
+    
+    # Only durable queues have anything to write out or close; servers call
+    # these for every queue regardless.
+    
+    def sync_overdue(self, now=None):
+        return False
+    
+    def close(self):
+        pass
     
     @classmethod
     def with_semaphore_class(cls, semaphore_class):
         return type('Queue', (cls,), {'semaphore_class': semaphore_class})
 
 
-def eternal(item):
-    while True:
-        yield item
\ No newline at end of file
+def sizeof(value):
+    # Strings are counted by their length; anything else by the length of its
+    # binary encoding, which is close to what it costs to hold and send it.
+    if isinstance(value, str):
+        return len(value)
+    elif isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(framing.encode(value))
+
+
+def pop_push_options(kwargs):
+    # Python 2 has no keyword-only arguments, so push_many() has to get these
+    # out of **kwargs, since its values are passed in *values.
+    timeout = kwargs.pop('timeout', None)
+    priority = kwargs.pop('priority', None)
+    delay = kwargs.pop('delay', None)
+    deliver_at = kwargs.pop('deliver_at', None)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %r' % (kwargs.keys(),))
+    return timeout, priority, delay, deliver_at
+
+
+def due_time(delay, deliver_at):
+    # Returns when an item pushed with a delay (in seconds) or a deliver_at
+    # time (a UNIX timestamp) is due, or None if it can be delivered now.
+    if delay is not None and deliver_at is not None:
+        raise TypeError('Give either a delay or a deliver_at time, not both')
+    elif delay is not None:
+        deliver_at = time.time() + delay
+    if deliver_at is None or deliver_at <= time.time():
+        return None
+    return deliver_at
+
+
+class Missing(object):
+    # A sentinel for lease lookups, since None is a perfectly good item.
+    pass
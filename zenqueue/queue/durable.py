@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+# A queue which survives restarts by keeping a write-ahead log on disk.
+#
+# The log is a directory of numbered segment files. Each segment starts with a
+# header giving the sequence number of its first push and the number of items
+# which had been pulled from the queue when it was created. After that, every
+# push is recorded with its value, and every pull with the new total number of
+# items pulled (the 'head'). Items are numbered in the order they're pushed, so
+# on startup the live items are simply those numbered from the head onwards.
+#
+# An item which is redelivered (after a nack, say) goes back on the front of
+# the queue, and so is recorded with its value as a 'requeue': the head moves
+# back by one, and the item takes the number just before the old head. The
+# records are replayed in the order they were written, so the log always puts
+# the items in the same order as the queue in memory.
+#
+# An item pulled with a lease is logged as pulled, and then its lease is logged
+# with its value. Acking, nacking or expiring the lease logs it as settled (a
+# nack or expiry logs the requeue first). Every new segment starts by logging
+# again the leases still outstanding, so they outlive the segments they were
+# first logged in. On startup, leases which were never settled are redelivered
+# as though they'd been nacked, the first leased going first.
+#
+# When the current segment grows past `segment_size` bytes, a new one is
+# started. Old segments whose items have all been pulled are then deleted, and
+# if too many old segments are still live, the live items are written out to a
+# single snapshot segment which replaces them. Both happen on a background
+# thread, so pushes and pulls are never held up by compaction.
+
+from collections import deque
+import itertools
+import os
+import struct
+import threading
+import time
+
+from zenqueue import log
+from zenqueue.queue.common import AbstractQueue, pop_push_options
+from zenqueue.utils import framing
+
+
+DEFAULT_SYNC_EVERY = 1000 # Records written between each fsync().
+DEFAULT_SYNC_INTERVAL = 1.0 # Maximum seconds between each fsync().
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024 # Bytes.
+DEFAULT_COMPACT_SEGMENTS = 4 # Live old segments before taking a snapshot.
+
+HEADER = struct.Struct('!cQQ') # 'S', first sequence number, head.
+PUSH = struct.Struct('!cI') # 'P', length of the encoded value.
+PULL = struct.Struct('!cQ') # 'D', head.
+REQUEUE = struct.Struct('!cI') # 'R', length of the encoded value.
+LEASE = struct.Struct('!cQI') # 'L', lease ID, length of the encoded value.
+SETTLE = struct.Struct('!cQ') # 'A', lease ID.
+
+SEGMENT_SUFFIX = '.log'
+
+
+class Segment(object):
+    
+    """The in-memory record of a segment file."""
+    
+    __slots__ = ('number', 'path', 'first', 'end')
+    
+    def __init__(self, number, path, first, end=None):
+        self.number = number
+        self.path = path
+        self.first = first
+        # One past the sequence number of the last item pushed to this segment.
+        self.end = first if end is None else end
+
+
+class AbstractDurableQueue(AbstractQueue):
+    
+    def __init__(self, path, sync_every=DEFAULT_SYNC_EVERY,
+                 sync_interval=DEFAULT_SYNC_INTERVAL,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 compact_segments=DEFAULT_COMPACT_SEGMENTS,
+                 maxsize=None, maxbytes=None):
+        
+        self.log = log.get_logger('zenq.queue.durable:%x' % (id(self),))
+        
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.segment_size = segment_size
+        self.compact_segments = compact_segments
+        
+        # Guards the log file and the counters below. This is needed even for
+        # coroutines, because compaction runs on a separate thread.
+        self.wal_lock = threading.Lock()
+        self.compactor = None
+        
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        
+        (self.segments, self.head, self.next_seq, items, leases,
+         last_lease_id) = self.replay()
+        super(AbstractDurableQueue, self).__init__(initial=items,
+            maxsize=maxsize, maxbytes=maxbytes)
+        # Lease IDs carry on from those logged, so that a consumer acking a
+        # lease from before the restart can't settle somebody else's.
+        self.lease_ids = itertools.count(last_lease_id + 1)
+        
+        self.log.info('Recovered %d items from %s', len(items), path)
+        
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.rotate()
+        
+        if leases:
+            self.log.info('Redelivering %d items which were out on lease',
+                len(leases))
+        for lease_id in sorted(leases, reverse=True):
+            self.requeue(leases[lease_id], lease_id=lease_id)
+    
+    def segment_path(self, number):
+        return os.path.join(self.path, '%010d%s' % (number, SEGMENT_SUFFIX))
+    
+    def replay(self):
+        numbers = sorted(int(filename[:-len(SEGMENT_SUFFIX)])
+            for filename in os.listdir(self.path)
+            if filename.endswith(SEGMENT_SUFFIX) and
+                filename[:-len(SEGMENT_SUFFIX)].isdigit())
+        
+        # A snapshot may hold the same items as the segments it was about to
+        # replace, so items are collected by sequence number. The head can
+        # move back as well as forward, so it's whatever the last segment
+        # (which is always the current one) left it at. Leases are collected
+        # by ID, and dropped as they're settled.
+        segments, head, values, leases = [], 0, {}, {}
+        last_lease_id = 0
+        for number in numbers:
+            segment, segment_head, segment_lease_id = self.replay_segment(
+                number, values, leases)
+            if segment is not None:
+                segments.append(segment)
+                head = segment_head
+            last_lease_id = max(last_lease_id, segment_lease_id)
+        
+        next_seq = max([head] + [segment.end for segment in segments])
+        items = deque()
+        for seq in xrange(head, next_seq):
+            if seq in values:
+                items.appendleft(values[seq])
+            else:
+                self.log.error('Item %d is missing from the log', seq)
+        return segments, head, next_seq, items, leases, last_lease_id
+    
+    def replay_segment(self, number, values, leases):
+        path = self.segment_path(number)
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        
+        if len(data) < HEADER.size or data[0] != 'S':
+            # The process died before the header was written, so there can't
+            # be anything else in the segment either.
+            self.log.warning('Removing segment %s with no header', path)
+            os.remove(path)
+            return None, 0, 0
+        tag, first, head = HEADER.unpack_from(data, 0)
+        segment = Segment(number, path, first)
+        offset = HEADER.size
+        last_lease_id = 0
+        
+        while offset < len(data):
+            try:
+                if data[offset] == 'P':
+                    length = PUSH.unpack_from(data, offset)[1]
+                    start = offset + PUSH.size
+                    if start + length > len(data):
+                        raise ValueError('Truncated push record')
+                    values[segment.end] = framing.decode(
+                        data[start:start + length])
+                    segment.end += 1
+                    offset = start + length
+                elif data[offset] == 'D':
+                    head = PULL.unpack_from(data, offset)[1]
+                    offset += PULL.size
+                elif data[offset] == 'R':
+                    length = REQUEUE.unpack_from(data, offset)[1]
+                    start = offset + REQUEUE.size
+                    if start + length > len(data):
+                        raise ValueError('Truncated requeue record')
+                    elif not head:
+                        raise ValueError('Requeue record before any pull')
+                    head -= 1
+                    values[head] = framing.decode(data[start:start + length])
+                    offset = start + length
+                elif data[offset] == 'L':
+                    lease_id, length = LEASE.unpack_from(data, offset)[1:]
+                    start = offset + LEASE.size
+                    if start + length > len(data):
+                        raise ValueError('Truncated lease record')
+                    leases[lease_id] = framing.decode(
+                        data[start:start + length])
+                    last_lease_id = max(last_lease_id, lease_id)
+                    offset = start + length
+                elif data[offset] == 'A':
+                    lease_id = SETTLE.unpack_from(data, offset)[1]
+                    leases.pop(lease_id, None)
+                    last_lease_id = max(last_lease_id, lease_id)
+                    offset += SETTLE.size
+                else:
+                    raise ValueError('Unknown record %r' % (data[offset],))
+            except (ValueError, struct.error), exc:
+                # A record which was only partly written when the process died.
+                # Nothing after it can be trusted, so it's cut off.
+                self.log.warning('Truncating %s at offset %d: %s',
+                    path, offset, exc)
+                fp = open(path, 'r+b')
+                try:
+                    fp.truncate(offset)
+                finally:
+                    fp.close()
+                break
+        
+        return segment, head, last_lease_id
+    
+    def write(self, record, count=1):
+        # Must be called with the WAL lock held. `record` may hold several
+        # records, in which case `count` says how many.
+        self.file.write(record)
+        self.unsynced += count
+        
+        now = time.time()
+        if ((self.sync_every is not None and
+             self.unsynced >= self.sync_every) or
+            (self.sync_interval is not None and
+             now - self.last_sync >= self.sync_interval)):
+            self.sync(now=now)
+    
+    def sync(self, now=None):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = now or time.time()
+    
+    def sync_overdue(self, now=None):
+        # write() only checks `sync_interval` when something is written, so
+        # the last records before a quiet spell would otherwise sit unsynced
+        # until the next one. Servers call this from their timer loop.
+        if self.sync_interval is None:
+            return False
+        if now is None:
+            now = time.time()
+        self.wal_lock.acquire()
+        try:
+            if (self.file is None or not self.unsynced or
+                now - self.last_sync < self.sync_interval):
+                return False
+            self.sync(now=now)
+        finally:
+            self.wal_lock.release()
+        return True
+    
+    def rotate(self):
+        # Must be called with the WAL lock held (or from the constructor).
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        
+        if self.segments:
+            number = self.segments[-1].number + 1
+        else:
+            number = 0
+        segment = Segment(number, self.segment_path(number), self.next_seq)
+        self.file = open(segment.path, 'ab')
+        self.file.write(HEADER.pack('S', self.next_seq, self.head))
+        # The leases still outstanding are logged again, so that the segments
+        # they were granted in can be deleted.
+        self.lease_lock.acquire()
+        try:
+            leased = self.leases.items()
+        finally:
+            self.lease_lock.release()
+        for lease_id, (value, priority) in leased:
+            encoded = framing.encode(value)
+            self.file.write(LEASE.pack('L', lease_id, len(encoded)) + encoded)
+        self.sync()
+        
+        old_segments = self.segments
+        self.segments = [segment]
+        self.compact(old_segments)
+    
+    def compact(self, old_segments):
+        # Segments which only hold pulled items can just be deleted. The rest
+        # are kept, unless there are so many of them that a snapshot is due.
+        dead = [s for s in old_segments if s.end <= self.head]
+        live = [s for s in old_segments if s.end > self.head]
+        
+        snapshot = None
+        if self.compactor is not None and self.compactor.isAlive():
+            # Only one compaction runs at a time; these will be reconsidered
+            # when the next segment is started.
+            self.segments[:0] = old_segments
+            return
+        elif len(live) >= self.compact_segments:
+            # The snapshot takes the place of the newest of the live segments,
+            # which keeps it ordered before the current segment.
+            items = list(self.queue)
+            items.reverse()
+            snapshot = (Segment(live[-1].number, live[-1].path, self.head,
+                self.head + len(items)), items)
+            dead.extend(live)
+            live = [snapshot[0]]
+        
+        self.segments[:0] = live
+        if dead:
+            self.compactor = threading.Thread(target=self.run_compaction,
+                args=(dead, snapshot))
+            self.compactor.setDaemon(True)
+            self.compactor.start()
+    
+    def run_compaction(self, dead, snapshot):
+        try:
+            if snapshot is not None:
+                segment, items = snapshot
+                temp_path = segment.path + '.compact'
+                fp = open(temp_path, 'wb')
+                try:
+                    fp.write(HEADER.pack('S', segment.first, segment.first))
+                    for value in items:
+                        encoded = framing.encode(value)
+                        fp.write(PUSH.pack('P', len(encoded)) + encoded)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                finally:
+                    fp.close()
+                # The rename is atomic, so a crash leaves either the old
+                # segment or the snapshot in its place.
+                os.rename(temp_path, segment.path)
+            
+            for segment in dead:
+                if snapshot is None or segment.path != snapshot[0].path:
+                    os.remove(segment.path)
+        except (IOError, OSError), exc:
+            self.log.error('Error %r occurred during compaction', exc)
+    
+    def close(self):
+        self.wal_lock.acquire()
+        try:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+        finally:
+            self.wal_lock.release()
+        if self.compactor is not None:
+            self.compactor.join()
+    
+    # The in-memory queue is only changed with the WAL lock held, so that a
+    # snapshot always agrees with the counters. Waiting for an item, and waking
+    # up those waiting, happen outside of the lock.
+    
+    def push(self, value, timeout=None, priority=None, delay=None,
+             deliver_at=None):
+        # The log relies on items being pulled in the order they were pushed,
+        # so neither priorities nor scheduled delivery can be supported.
+        if priority is not None:
+            raise ValueError('Durable queues do not support priorities')
+        elif delay is not None or deliver_at is not None:
+            raise ValueError('Durable queues do not support scheduling')
+        if self.bounded:
+            self.reserve([value], timeout=timeout)
+        
+        # The value is encoded before taking the lock, since that's the slow
+        # part, and logged before it's added to the queue.
+        encoded = framing.encode(value)
+        self.wal_lock.acquire()
+        try:
+            self.write(PUSH.pack('P', len(encoded)) + encoded)
+            self.next_seq += 1
+            self.segments[-1].end = self.next_seq
+            self.queue.appendleft(value)
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        self.semaphore.release()
+    
+    def push_many(self, *values, **kwargs):
+        timeout, priority, delay, deliver_at = pop_push_options(kwargs)
+        if priority is not None:
+            raise ValueError('Durable queues do not support priorities')
+        elif delay is not None or deliver_at is not None:
+            raise ValueError('Durable queues do not support scheduling')
+        if self.bounded:
+            self.reserve(values, timeout=timeout)
+        
+        records = []
+        for value in values:
+            encoded = framing.encode(value)
+            records.append(PUSH.pack('P', len(encoded)) + encoded)
+        self.wal_lock.acquire()
+        try:
+            self.write(''.join(records), count=len(records))
+            self.next_seq += len(values)
+            self.segments[-1].end = self.next_seq
+            self.queue.extendleft(values)
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        self.semaphore.release_many(len(values))
+    
+    def pull(self, timeout=None, lease=None):
+        try:
+            self.semaphore.acquire(timeout=timeout)
+        except self.semaphore.Timeout:
+            raise self.Timeout
+        value = self.take(1)[0]
+        if lease is not None:
+            return self.take_leases([value], lease)[0]
+        return value
+    
+    def pop_items(self, count):
+        # pull_many() takes a whole batch of items at once, and so only needs
+        # a single record for it.
+        self.wal_lock.acquire()
+        try:
+            items = super(AbstractDurableQueue, self).pop_items(count)
+            self.head += count
+            self.write(PULL.pack('D', self.head))
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        return items
+    
+    def take_leases(self, values, lease, priorities=None):
+        # The leases are granted with the WAL lock held, so that they're
+        # logged before anything else can expire or settle them.
+        encoded = map(framing.encode, values)
+        self.wal_lock.acquire()
+        try:
+            pairs = super(AbstractDurableQueue, self).take_leases(values,
+                lease, priorities)
+            records = [LEASE.pack('L', lease_id, len(data)) + data
+                       for (lease_id, value), data in zip(pairs, encoded)]
+            self.write(''.join(records), count=len(records))
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        return pairs
+    
+    def ack(self, lease_id):
+        if not super(AbstractDurableQueue, self).ack(lease_id):
+            return False
+        self.wal_lock.acquire()
+        try:
+            self.write(SETTLE.pack('A', lease_id))
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        return True
+    
+    def redeliver(self, lease_id, leased):
+        self.requeue(leased[0], lease_id=lease_id)
+    
+    def requeue(self, value, priority=None, lease_id=None):
+        # Durable queues have no priorities.
+        #
+        # An item is logged as pulled as soon as it's handed out, so one which
+        # is redelivered is logged again, as being put back in front of the
+        # head. The head only ever goes up between a pull and the requeue of
+        # what it pulled, so it can't go below zero. If the item was leased,
+        # the lease is logged as settled straight after, in the same write; a
+        # crash in between at worst delivers the item twice.
+        if not self.head:
+            raise ValueError('Only items which were pulled can be requeued')
+        if self.bounded:
+            self.reserve([value], force=True)
+        encoded = framing.encode(value)
+        record = REQUEUE.pack('R', len(encoded)) + encoded
+        count = 1
+        if lease_id is not None:
+            record += SETTLE.pack('A', lease_id)
+            count += 1
+        self.wal_lock.acquire()
+        try:
+            self.write(record, count=count)
+            self.head -= 1
+            self.queue.append(value)
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+        finally:
+            self.wal_lock.release()
+        self.semaphore.release()
+
+
+class DurableQueue(object):
+    
+    def __new__(cls, path, mode='async', *args, **kwargs):
+        if mode == 'async':
+            from zenqueue.utils.async import Semaphore
+        elif mode == 'sync':
+            from zenqueue.utils.sync import Semaphore
+        else:
+            raise ValueError('Invalid durable queue mode: %r' % (mode,))
+        queue_class = AbstractDurableQueue.with_semaphore_class(Semaphore)
+        return queue_class(path, *args, **kwargs)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from zenqueue.queue.common import AbstractQueue
+
+
+DEFAULT_QUEUE = 'default'
+DEFAULT_IDLE_TIMEOUT = 300 # Seconds a queue may sit empty before eviction.
+
+
+class QueueRegistry(object):
+    
+    """
+    A dictionary of named queues, created lazily on first use.
+    
+    Queues are created by calling `factory()` the first time a name is asked
+    for. Any queue which has been empty, with no waiting consumers and nothing
+    out on lease or scheduled, for longer than `idle_timeout` seconds is
+    evicted; the next request for that name will simply create a new, empty
+    queue. Queues added with `add()` are pinned and will never be evicted.
+    """
+    
+    Timeout = AbstractQueue.Timeout
+    Full = AbstractQueue.Full
+    
+    def __init__(self, factory, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        
+        self.queues = {}
+        self.pinned = set()
+        self.last_used = {}
+        self.last_sweep = time.time()
+    
+    def __contains__(self, name):
+        return name in self.queues
+    
+    def __len__(self):
+        return len(self.queues)
+    
+    def __iter__(self):
+        return iter(self.queues)
+    
+    def add(self, name, queue):
+        self.queues[name] = queue
+        self.pinned.add(name)
+        return queue
+    
+    def get(self, name=DEFAULT_QUEUE):
+        now = time.time()
+        
+        # Sweeping at most once per idle_timeout keeps the cost of eviction
+        # amortized over all of the requests made in that period.
+        if (self.idle_timeout is not None and
+            now - self.last_sweep >= self.idle_timeout):
+            self.evict_idle(now=now)
+        
+        try:
+            queue = self.queues[name]
+        except KeyError:
+            queue = self.queues[name] = self.factory()
+        self.last_used[name] = now
+        return queue
+    
+    def remove(self, name):
+        self.pinned.discard(name)
+        self.last_used.pop(name, None)
+        return self.queues.pop(name)
+    
+    def is_idle(self, name, now=None):
+        if name in self.pinned:
+            return False
+        
+        queue = self.queues[name]
+        if (len(queue) or queue.semaphore.waiting or queue.leases or
+            queue.scheduled):
+            return False
+        
+        if now is None:
+            now = time.time()
+        return now - self.last_used.get(name, 0) >= self.idle_timeout
+    
+    def evict_idle(self, now=None):
+        if now is None:
+            now = time.time()
+        self.last_sweep = now
+        
+        evicted = [name for name in self.queues if self.is_idle(name, now=now)]
+        for name in evicted:
+            self.remove(name)
+        return evicted
+    
+    def expire_leases(self, now=None):
+        # Redelivers items whose leases have run out, on every queue which has
+        # items out on lease. Returns the number of items redelivered.
+        if now is None:
+            now = time.time()
+        return sum(queue.expire_leases(now=now)
+                   for queue in self.queues.values() if queue.leases)
+    
+    def release_scheduled(self, now=None):
+        # Moves scheduled items which are due onto their queues. Returns the
+        # number of items released.
+        if now is None:
+            now = time.time()
+        return sum(queue.release_scheduled(now=now)
+                   for queue in self.queues.values() if queue.scheduled)
+    
+    def sync_overdue(self, now=None):
+        # Syncs durable queues which have gone `sync_interval` seconds with
+        # records unsynced. Returns the number of queues synced.
+        if now is None:
+            now = time.time()
+        return sum(queue.sync_overdue(now=now)
+                   for queue in self.queues.values())
+    
+    def close(self):
+        # Durable queues sync and close their logs; others do nothing.
+        for queue in self.queues.values():
+            queue.close()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['http', 'native']
+__all__ = ['aio', 'common', 'http', 'native']
 
 
 class QueueServer(object):
@@ -12,4 +12,7 @@ class QueueServer(object):
         elif method == 'http':
             from zenqueue.server.http import HTTPQueueServer
             return HTTPQueueServer(*args, **kwargs)
+        elif method == 'asyncio':
+            from zenqueue.server.aio import AsyncIOQueueServer
+            return AsyncIOQueueServer(*args, **kwargs)
         raise ValueError('Invalid server method: %r' % (method,))
\ No newline at end of file
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import optparse
+import time
+
+from zenqueue import log
+from zenqueue.queue.aio import Queue
+from zenqueue.queue.registry import DEFAULT_IDLE_TIMEOUT, DEFAULT_QUEUE
+from zenqueue.server.common import (AbstractQueueServer, Break,
+    SwitchProtocol, BATCH_ACTIONS, ENCODERS, TIMER_INTERVAL, parse_command,
+    unpack_command)
+from zenqueue.utils import framing
+from zenqueue.utils.aio import (asyncio, From, Return, Semaphore, read_frame,
+    read_line, STREAM_LIMIT)
+import zenqueue
+
+
+DEFAULT_MAX_CONC_REQUESTS = 1024
+
+
+# Option parser setup (for command-line usage)
+
+USAGE = ('Usage: %prog [-i IFACE] [-p PORT] [-c NUM] [-e SECS] [-s NUM] '
+    '[-b BYTES] [--priorities] [-l LEVEL] [--sample NUM]')
+OPTION_PARSER = optparse.OptionParser(prog='python -m zenqueue.server.aio',
+    usage=USAGE, version=zenqueue.__version__)
+OPTION_PARSER.add_option('-i', '--interface', default='0.0.0.0',
+    help='Bind to interface IFACE [default %default]', metavar='IFACE')
+OPTION_PARSER.add_option('-p', '--port', type='int', default=3000,
+    help='Run on port PORT [default %default]', metavar='PORT')
+OPTION_PARSER.add_option('-c', '--max-connections', type='int', dest='max_size',
+    help='Allow maximum NUM concurrent requests [default %default]',
+    metavar='NUM', default=DEFAULT_MAX_CONC_REQUESTS)
+OPTION_PARSER.add_option('-e', '--idle-timeout', type='float',
+    dest='idle_timeout', default=DEFAULT_IDLE_TIMEOUT,
+    help='Evict named queues left empty for SECS seconds [default %default]',
+    metavar='SECS')
+OPTION_PARSER.add_option('-s', '--queue-size', type='int', dest='maxsize',
+    default=None, metavar='NUM',
+    help='Hold at most NUM items in each queue [default no limit]')
+OPTION_PARSER.add_option('-b', '--queue-bytes', type='int', dest='maxbytes',
+    default=None, metavar='BYTES',
+    help='Hold at most BYTES bytes in each queue [default no limit]')
+OPTION_PARSER.add_option('--priorities', action='store_true',
+    dest='priorities', default=False,
+    help='Allow items to be pushed with a priority [default %default]')
+OPTION_PARSER.add_option('-l', '--log-level', dest='log_level', default='INFO',
+    help='Use log level LEVEL [default %default] (use SILENT for no logging)',
+    metavar='LEVEL')
+OPTION_PARSER.add_option('--sample', type='int', dest='sample', default=1,
+    help='At log level DEBUG, trace one request in every NUM [default '
+         '%default]', metavar='NUM')
+
+# End option parser setup
+
+
+class AsyncIOQueueServer(AbstractQueueServer):
+    
+    """
+    A native protocol server which runs on an asyncio event loop.
+    
+    Use `serve()` to run the server on its own, or yield from `start()` to run
+    it alongside other coroutines on an existing event loop.
+    """
+    
+    log_name = 'zenq.server.aio'
+    queue_factory = Queue
+    
+    def __init__(self, queue=None, max_size=DEFAULT_MAX_CONC_REQUESTS,
+                 queue_factory=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        
+        # Initializes the log and the queue registry.
+        super(AsyncIOQueueServer, self).__init__(queue=queue,
+            queue_factory=queue_factory, idle_timeout=idle_timeout)
+        
+        # Much like the coroutine pool of the native server, this stops more
+        # than max_size clients from being handled at once. Any more will wait
+        # for a slot to become free.
+        self.client_slots = Semaphore(initial=max_size)
+        
+        self.server = None
+        self.timer = None
+    
+    @asyncio.coroutine
+    def start(self, interface='0.0.0.0', port=3000, loop=None):
+        self.log.info('ZenQueue AsyncIO Server v%s', zenqueue.__version__)
+        if interface == '0.0.0.0':
+            self.log.info('Serving on %s:%d (all interfaces)', interface, port)
+        else:
+            self.log.info('Serving on %s:%d', interface, port)
+        
+        self.server = yield From(asyncio.start_server(self.handle,
+            interface, port, loop=loop, limit=STREAM_LIMIT))
+        self.timer = asyncio.ensure_future(self.run_timer_loop(),
+            loop=loop)
+        raise Return(self.server)
+    
+    def stop(self):
+        if self.server is not None:
+            self.log.info('Shutting down server.')
+            self.server.close()
+            self.server = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+    
+    @asyncio.coroutine
+    def run_timer_loop(self):
+        # Runs alongside the server until it's stopped.
+        while True:
+            yield From(asyncio.sleep(TIMER_INTERVAL))
+            try:
+                self.run_timers()
+            except Exception, exc:
+                self.log.error('Error %r occurred running timers', exc)
+    
+    def serve(self, interface='0.0.0.0', port=3000):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.start(interface=interface, port=port,
+            loop=loop))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            # It's a fatal error because it kills the program.
+            self.log.fatal('Received keyboard interrupt.')
+        finally:
+            self.stop()
+            self.queues.close()
+    
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        client = writer
+        
+        yield From(self.client_slots.acquire())
+        self.log.info('Client %x connected: %r', id(client),
+            writer.get_extra_info('peername'))
+        self.metrics.clients += 1
+        
+        # See NativeQueueServer.handle() for the protocol negotiation.
+        protocol = 'json'
+        
+        try:
+            while True:
+                if protocol == 'binary':
+                    try:
+                        data = yield From(read_frame(reader))
+                    except framing.FrameTooLarge, exc:
+                        # See NativeQueueServer.handle().
+                        self.log.error('Received oversized frame from client '
+                            '%x', id(client))
+                        writer.write(ENCODERS[protocol](
+                            ['error:request', str(exc)]))
+                        yield From(writer.drain())
+                        break
+                    parse = framing.decode_request
+                else:
+                    data = yield From(read_line(reader))
+                    parse = parse_command
+                if data is None:
+                    break
+                elif not data:
+                    # If the client sends an empty line, ignore it.
+                    continue
+                
+                response, next_protocol = yield From(
+                    self.respond(client, parse, data, protocol))
+                if response is None:
+                    break
+                
+                # A protocol switch is acknowledged using the old protocol.
+                writer.write(ENCODERS[protocol](response))
+                yield From(writer.drain())
+                protocol = next_protocol
+                
+                if response[0] == 'error:action':
+                    # As with the native server, an action error causes the
+                    # client to be disconnected.
+                    break
+        except Exception, exc:
+            self.log.error('Unknown error occurred for client %x: %r',
+                id(client), exc)
+            self.log.error('Forcing disconnection of client %x', id(client))
+        finally:
+            self.log.info('Client %x disconnected', id(client))
+            self.metrics.clients -= 1
+            writer.close()
+            self.client_slots.release()
+    
+    @asyncio.coroutine
+    def respond(self, client, parse, data, protocol, batched=False):
+        
+        # Returns the response to send to the client (or None to disconnect
+        # them), and the protocol to use once it has been sent. Commands in a
+        # batch are limited to BATCH_ACTIONS; see do_batch().
+        
+        try:
+            action, args, kwargs = parse(data)
+        except ValueError:
+            self.log.error('Received malformed request from client %x',
+                id(client))
+            raise Return((['error:request', 'malformed request'], protocol))
+        
+        method = None
+        if not batched or action in BATCH_ACTIONS:
+            method = getattr(self, 'do_' + action, None)
+        if method is None:
+            self.log.error('Missing action requested by client %x',
+                id(client))
+            raise Return((['error:request', 'action not found'], protocol))
+        
+        # Unlike call_action(), this also times how long it takes to wait on
+        # actions which are coroutines.
+        # Only some requests (if any) are traced; see log.Tracer.
+        tracer = self.tracer
+        traced = tracer.enabled and tracer.sample()
+        
+        started = time.time()
+        outcome = 'error'
+        try:
+            if traced:
+                self.log.debug('Action %r requested by client %x',
+                    action, id(client))
+            output = method(client, *args, **kwargs)
+            # Actions which might block (such as pull) are coroutines.
+            if (asyncio.iscoroutine(output) or
+                isinstance(output, asyncio.Future)):
+                output = yield From(output)
+            outcome = 'success'
+        except Break:
+            outcome = 'success'
+            raise Return((None, protocol))
+        except SwitchProtocol, exc:
+            outcome = 'success'
+            self.log.debug('Client %x switched to protocol %r',
+                id(client), exc.args[0])
+            raise Return((['success', exc.args[0]], exc.args[0]))
+        except self.queues.Timeout:
+            outcome = 'timeout'
+            raise Return((['error:timeout', None], protocol))
+        except self.queues.Full:
+            outcome = 'full'
+            raise Return((['error:full', None], protocol))
+        except Exception, exc:
+            self.log.error('Action %r raised error %r for client %x',
+                action, exc, id(client))
+            raise Return((['error:action', repr(exc)], protocol))
+        finally:
+            self.metrics.observe(action, time.time() - started, outcome)
+        
+        if traced:
+            self.log.debug('Action %r successful for client %x',
+                action, id(client))
+        raise Return((['success', output], protocol))
+    
+    # Pulls from asyncio queues are coroutines, so the items they return can
+    # only be counted once they've been waited on.
+    
+    @asyncio.coroutine
+    def do_pull(self, client, timeout=None, queue=DEFAULT_QUEUE, lease=None):
+        value = yield From(self.queues.get(queue).pull(timeout=timeout,
+            lease=lease))
+        self.metrics.pulled.mark()
+        raise Return(value)
+    
+    @asyncio.coroutine
+    def do_pull_many(self, client, n, timeout=None, queue=DEFAULT_QUEUE,
+                     lease=None):
+        values = yield From(self.queues.get(queue).pull_many(n,
+            timeout=timeout, lease=lease))
+        self.metrics.pulled.mark(len(values))
+        raise Return(values)
+    
+    @asyncio.coroutine
+    def do_batch(self, client, *commands):
+        # Each command is carried out (and waited on) by respond(), just as if
+        # it had been sent on its own, except that an action error doesn't
+        # cause the client to be disconnected.
+        responses = []
+        for command in commands:
+            response, protocol = yield From(self.respond(client,
+                unpack_command, command, None, batched=True))
+            responses.append(response)
+        raise Return(responses)
+    
+    def do_quit(self, client):
+        # The client loop closes the connection once this is caught.
+        raise Break
+    # exit and shutdown are synonyms for quit.
+    do_exit = do_shutdown = do_quit
+    
+    def do_protocol(self, client, name):
+        if name not in ENCODERS:
+            raise ValueError('Unknown protocol: %r' % (name,))
+        raise SwitchProtocol(str(name))
+    
+    def do_subscribe(self, client, *args, **kwargs):
+        # Subscriptions pull from the queue as a blocking call, which asyncio
+        # queues can't do.
+        raise ValueError('Subscriptions need the native or HTTP server')
+
+
+def _main():
+    options, args = OPTION_PARSER.parse_args()
+    
+    # Handle log level.
+    log_level = options.log_level
+    if log_level.upper() == 'SILENT':
+        # Completely disables logging output.
+        log.silence()
+    elif log_level.upper() not in log.LOG_LEVELS:
+        log.ROOT_LOGGER.warning(
+            'Invalid log level supplied, defaulting to INFO')
+        log.ROOT_LOGGER.setLevel(log.INFO)
+    else:
+        log.ROOT_LOGGER.setLevel(getattr(log, log_level.upper()))
+    log.set_sampling(options.sample)
+    
+    # Every queue, including any created later on, gets the same settings.
+    def queue_factory():
+        return Queue(maxsize=options.maxsize, maxbytes=options.maxbytes,
+                     priorities=options.priorities)
+    
+    # Instantiate and start server.
+    server = AsyncIOQueueServer(max_size=options.max_size,
+                                queue_factory=queue_factory,
+                                idle_timeout=options.idle_timeout)
+    server.serve(interface=options.interface, port=options.port)
+
+
+if __name__ == '__main__':
+    _main()
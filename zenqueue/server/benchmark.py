@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time how much the native server's debug tracing costs each request.
+
+Requests are fed straight to `NativeQueueServer.handle()` from memory, and
+the responses thrown away, so that nothing but the server's own work is
+timed. Each run pushes and then pulls a number of items, one request at a
+time, with logging set up in one of these ways:
+    
+    off         At INFO, so that nothing is traced (as in production).
+    unguarded   At INFO, but making every debug call regardless, as each
+                request used to before tracing was guarded.
+    sampled     At DEBUG, tracing one request in every `--sample`.
+    full        At DEBUG, tracing every request.
+
+Traced requests are formatted as usual, but the output is thrown away.
+"""
+
+from cStringIO import StringIO
+import gc
+import optparse
+import time
+
+from zenqueue import log
+from zenqueue.server.common import ENCODERS
+from zenqueue.server.native import NativeQueueServer
+from zenqueue.utils import framing
+import zenqueue
+
+
+MODES = ['off', 'unguarded', 'sampled', 'full']
+
+
+option_parser = optparse.OptionParser(
+    usage='python -m zenqueue.server.benchmark [options]',
+    version=zenqueue.__version__)
+
+option_parser.add_option('-n', '--num-messages', metavar='COUNT',
+    default=20000, type='int',
+    help='Push and then pull COUNT messages in each run [default %default]')
+
+option_parser.add_option('-r', '--repeat', metavar='COUNT', default=5,
+    type='int',
+    help='Take the best of COUNT runs of each mode [default %default]')
+
+option_parser.add_option('-s', '--sample', metavar='NUM', default=100,
+    type='int',
+    help='Trace one request in every NUM when sampling [default %default]')
+
+option_parser.add_option('-b', '--binary', action='store_true',
+    default=False,
+    help='Use binary framing [default JSON]')
+
+option_parser.add_option('-m', '--modes', metavar='MODES',
+    default=','.join(MODES),
+    help='Run the comma-separated MODES [default %default]')
+
+
+class NullFile(object):
+    def write(self, data):
+        pass
+    
+    def flush(self):
+        pass
+
+
+class MemoryClient(object):
+    
+    # Stands in for a client's socket, reading its requests from a string.
+    
+    def __init__(self, data):
+        self.data = data
+    
+    def makefile(self, mode='r'):
+        if 'r' in mode:
+            return StringIO(self.data)
+        return NullFile()
+    
+    def close(self):
+        pass
+
+
+def encode_requests(protocol, count):
+    requests = ([['push', ['a'], {}]] * count +
+                [['pull', [], {'timeout': 0}]] * count)
+    if protocol == 'binary':
+        return ''.join(framing.frame(framing.encode_request(*request))
+                       for request in requests)
+    return ''.join(ENCODERS['json'](request) for request in requests)
+
+
+def time_mode(mode, protocol, count, sample):
+    if mode in ('sampled', 'full'):
+        log.set_level('DEBUG')
+    else:
+        log.set_level('INFO')
+    log.set_sampling(mode == 'sampled' and sample or 1)
+    
+    server = NativeQueueServer()
+    if mode == 'unguarded':
+        # Every debug call is made, and then dropped by the logger itself.
+        server.tracer.enabled = True
+    
+    client = MemoryClient(encode_requests(protocol, count))
+    # As timeit does, the garbage collector is kept from running part-way.
+    gc.disable()
+    try:
+        start = time.time()
+        server.handle(client, protocol)
+        elapsed = time.time() - start
+    finally:
+        gc.enable()
+    if len(server.queue):
+        raise RuntimeError('Not every request was handled')
+    return elapsed
+
+
+def main():
+    options, args = option_parser.parse_args()
+    modes = options.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            option_parser.error('Unknown mode: %r' % (mode,))
+    protocol = options.binary and 'binary' or 'json'
+    requests = 2 * options.num_messages
+    
+    # Everything logged goes nowhere, but is still formatted.
+    log.CONSOLE_HANDLER.stream = NullFile()
+    
+    # The modes take turns, so that anything else going on at the time slows
+    # them all down alike.
+    times = dict((mode, []) for mode in modes)
+    for i in xrange(options.repeat):
+        for mode in modes:
+            times[mode].append(time_mode(mode, protocol, options.num_messages,
+                                         options.sample))
+    
+    baseline = None
+    for mode in modes:
+        elapsed = min(times[mode])
+        per_request = elapsed / requests * 1e6
+        line = '%-10s %10.1f requests/s  %7.2f us/request' % (
+            mode, requests / elapsed, per_request)
+        if baseline is None:
+            baseline = per_request
+        else:
+            line += '  (%+.2f us)' % (per_request - baseline,)
+        print line
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+
+from zenqueue import log
+from zenqueue.queue.registry import (QueueRegistry, DEFAULT_QUEUE,
+    DEFAULT_IDLE_TIMEOUT)
+from zenqueue.server.metrics import Metrics
+from zenqueue.utils import codec
+from zenqueue.utils import framing
+
+
+TIMER_INTERVAL = 0.1 # Seconds between checks for expired leases, etc.
+DEFAULT_CREDIT = 100 # Items a subscriber may be sent before granting more.
+MAX_BATCH = 1000 # Most items sent to a subscriber at once.
+
+
+# These exception definitions, while empty, allow code higher up the call chain
+# to identify the nature of an error. Break and SwitchProtocol, for example,
+# are more signals than errors.
+class ActionError(Exception): pass
+class Break(Exception): pass
+class SwitchProtocol(Exception): pass
+class Subscribe(Exception): pass
+
+# Actions which raise one of these have still succeeded.
+SIGNALS = (Break, SwitchProtocol, Subscribe)
+
+# The actions which can be carried out as part of a batch. The others change
+# the state of the connection itself, and so only make sense on their own.
+BATCH_ACTIONS = frozenset(['push', 'pull', 'push_many', 'pull_many', 'ack',
+                           'nack', 'extend', 'stats'])
+
+
+class AbstractQueueServer(object):
+    
+    log_name = 'zenq.server'
+    queue_factory = NotImplemented
+    
+    def __init__(self, queue=None, queue_factory=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        
+        self.log = log.get_logger(self.log_name + ':%x' % (id(self),))
+        self.tracer = log.Tracer(self.log) # For debug output on each request.
+        
+        # Queues are held by name in the registry, being created by calling
+        # queue_factory() the first time a client asks for them. Queues which
+        # sit empty for idle_timeout seconds are evicted.
+        if queue_factory is None:
+            queue_factory = self.queue_factory
+        self.queues = QueueRegistry(queue_factory, idle_timeout=idle_timeout)
+        
+        # An initial queue may be provided; this might help with durable queues
+        # (i.e. those that save their state to disk and can restore it on load).
+        # It's pinned as the default queue, so it will never be evicted.
+        if queue is None:
+            queue = queue_factory()
+        self.queue = self.queues.add(DEFAULT_QUEUE, queue)
+        
+        self.metrics = Metrics()
+    
+    def call_action(self, client, action, method, args, kwargs):
+        # Runs an action, recording how long it took and how it turned out.
+        started = time.time()
+        outcome = 'error'
+        try:
+            output = method(client, *args, **kwargs)
+            outcome = 'success'
+            return output
+        except self.queues.Timeout:
+            outcome = 'timeout'
+            raise
+        except self.queues.Full:
+            outcome = 'full'
+            raise
+        except SIGNALS:
+            outcome = 'success'
+            raise
+        finally:
+            self.metrics.observe(action, time.time() - started, outcome)
+    
+    # Most of these methods are pure wrappers around the underlying queue
+    # objects. Every one takes an optional `queue` keyword argument naming the
+    # queue to operate on. The `client` argument identifies the client making
+    # the request, and its type depends on the server.
+    
+    def do_push(self, client, value, queue=DEFAULT_QUEUE, timeout=None,
+                priority=None, delay=None, deliver_at=None):
+        # If the queue is full, Full propagates upwards just like Timeout.
+        self.queues.get(queue).push(value, timeout=timeout, priority=priority,
+            delay=delay, deliver_at=deliver_at)
+        self.metrics.pushed.mark()
+    
+    def do_pull(self, client, timeout=None, queue=DEFAULT_QUEUE, lease=None):
+        # Timeouts will propagate upwards to the client loop and be handled
+        # accordingly. With a lease, the result is a `[lease_id, value]` pair.
+        value = self.queues.get(queue).pull(timeout=timeout, lease=lease)
+        self.metrics.pulled.mark()
+        return value
+    
+    def do_push_many(self, client, *values, **kwargs):
+        # Python 2 has no keyword-only arguments, so the queue name has to come
+        # out of **kwargs. The other options are checked by push_many().
+        queue = self.queues.get(kwargs.pop('queue', DEFAULT_QUEUE))
+        queue.push_many(*values, **kwargs)
+        self.metrics.pushed.mark(len(values))
+    
+    def do_pull_many(self, client, n, timeout=None, queue=DEFAULT_QUEUE,
+                     lease=None):
+        # Timeouts will propagate upwards to the client loop and be handled
+        # accordingly.
+        values = self.queues.get(queue).pull_many(n, timeout=timeout,
+            lease=lease)
+        self.metrics.pulled.mark(len(values))
+        return values
+    
+    # Each of these returns False if the lease has already run out.
+    
+    def do_ack(self, client, lease_id, queue=DEFAULT_QUEUE):
+        return self.queues.get(queue).ack(lease_id)
+    
+    def do_nack(self, client, lease_id, queue=DEFAULT_QUEUE):
+        return self.queues.get(queue).nack(lease_id)
+    
+    def do_extend(self, client, lease_id, lease, queue=DEFAULT_QUEUE):
+        return self.queues.get(queue).extend(lease_id, lease)
+    
+    def do_subscribe(self, client, queue=DEFAULT_QUEUE, credit=DEFAULT_CREDIT,
+                     lease=None):
+        # Caught by the server, which then streams items to the client.
+        raise Subscribe(Subscription(self.queues, queue, credit=credit,
+                                     lease=lease, metrics=self.metrics))
+    
+    def do_stats(self, client, format='json'):
+        # The server's statistics, as a dictionary (see Metrics.snapshot()),
+        # or as text in the Prometheus exposition format.
+        if format == 'prometheus':
+            return self.metrics.prometheus(self.queues)
+        elif format != 'json':
+            raise ValueError('Unknown stats format: %r' % (format,))
+        return self.metrics.snapshot(self.queues)
+    
+    def do_batch(self, client, *commands):
+        # Carries out each `[action, args, kwargs]` command in turn, returning
+        # the `[status, result]` response to each as it would have been sent
+        # on its own. A command which fails doesn't stop the ones after it.
+        return [self.run_batched(client, command) for command in commands]
+    
+    def run_batched(self, client, command):
+        try:
+            action, args, kwargs = unpack_command(command)
+        except ValueError:
+            self.log.error('Received malformed batched command from client %x',
+                id(client))
+            return ['error:request', 'malformed request']
+        if action not in BATCH_ACTIONS:
+            self.log.error('Missing batched action requested by client %x',
+                id(client))
+            return ['error:request', 'action not found']
+        
+        try:
+            output = self.call_action(client, action,
+                getattr(self, 'do_' + action), args, kwargs)
+        except self.queues.Timeout:
+            return ['error:timeout', None]
+        except self.queues.Full:
+            return ['error:full', None]
+        except Exception, exc:
+            # Unlike an error in an action sent on its own, this doesn't cause
+            # the client to be disconnected.
+            self.log.error('Batched action %r raised error %r for client %x',
+                action, exc, id(client))
+            return ['error:action', repr(exc)]
+        return ['success', output]
+    
+    def run_timers(self):
+        # Servers call this every TIMER_INTERVAL seconds.
+        now = time.time()
+        expired = self.queues.expire_leases(now=now)
+        if expired:
+            self.log.info('Redelivering %d items with expired leases', expired)
+            self.metrics.redelivered.mark(expired)
+        released = self.queues.release_scheduled(now=now)
+        if released:
+            self.log.debug('Released %d scheduled items', released)
+        self.queues.sync_overdue(now=now)
+        self.metrics.tick(now=now)
+
+
+class Subscription(object):
+    
+    """
+    A consumer which is sent items from a queue as they arrive.
+    
+    The consumer starts off with `credit` for that many items, and each item
+    sent to it uses one up; once it runs out, nothing more is sent until it
+    grants some more, so a slow consumer is never sent more than it's ready
+    for. Items are pulled in batches of as many as are available, up to the
+    credit remaining (and MAX_BATCH), and with a lease if one is given.
+    `sent` counts the items which have gone to the consumer, and so may be
+    handed back by it (see `hand_back()`).
+    """
+    
+    def __init__(self, queues, name=DEFAULT_QUEUE, credit=DEFAULT_CREDIT,
+                 lease=None, metrics=None):
+        self.queues = queues
+        self.name = name
+        self.lease = lease
+        self.metrics = metrics
+        self.queue = queues.get(name)
+        self.credit = self.queue.semaphore_class(initial=0)
+        self.sent = 0
+        self.grant(credit)
+    
+    def grant(self, credit):
+        if credit > 0:
+            self.credit.release_many(int(credit))
+    
+    def next_batch(self):
+        # Blocks until there's both credit and at least one item to send.
+        count = self.credit.acquire_many(MAX_BATCH)
+        try:
+            # The queue is looked up afresh each time, in case it was evicted
+            # while the consumer had no credit.
+            self.queue = self.queues.get(self.name)
+            items = [self.queue.pull(lease=self.lease)]
+        except:
+            self.credit.release_many(count)
+            raise
+        if count > 1:
+            try:
+                items.extend(self.queue.pull_many(count - 1, timeout=0,
+                                                  lease=self.lease))
+            except self.queue.Timeout:
+                pass
+        if len(items) < count:
+            self.credit.release_many(count - len(items))
+        self.sent += len(items)
+        if self.metrics is not None:
+            self.metrics.pulled.mark(len(items))
+        return items
+    
+    def give_back(self, items):
+        # Puts items which were pulled but never sent back on the front of the
+        # queue, in the order they were pulled in.
+        self.sent -= len(items)
+        for item in reversed(items):
+            if self.lease is not None:
+                self.queue.nack(item[0])
+            else:
+                self.queue.requeue(item)
+    
+    def hand_back(self, items):
+        # Puts back items which the consumer was sent but never used. They
+        # skip the queue's size limits, having only just come out of it, so no
+        # more can be handed back than were sent; leased items are nacked by
+        # the consumer instead.
+        if self.lease is not None:
+            raise ValueError('Leased items must be nacked, not handed back')
+        elif len(items) > self.sent:
+            raise ValueError('Cannot hand back %d items; only %d were sent' % (
+                len(items), self.sent))
+        self.give_back(items)
+        if self.metrics is not None:
+            self.metrics.redelivered.mark(len(items))
+
+
+def partition(name, count):
+    # Picks which of `count` workers owns the named queue. crc32 is used rather
+    # than hash() so that every worker process agrees on the answer.
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % count
+
+
+def parse_command(line):
+    return unpack_command(codec.JSON.decode(line))
+
+
+def unpack_command(command):
+    # The specification for commands is really simple. Essentially they
+    # consist of lists:
+    #     ['action_name', ['arg1', 'arg2'], {'key': 'value'}]
+    # The protocol is surprisingly close to Remote Procedure Call (RPC).
+    if not (isinstance(command, list) and command and
+            isinstance(command[0], basestring)):
+        raise ValueError('Malformed command')
+    action, args, kwargs = str(command[0]), (), {}
+    if len(command) > 1:
+        args = command[1]
+    if len(command) > 2:
+        kwargs = command[2]
+    if not (isinstance(args, list) and isinstance(kwargs, dict)):
+        raise ValueError('Malformed command')
+    
+    # Convert unicode strings to byte strings.
+    for key in kwargs.keys():
+        kwargs[str(key)] = kwargs.pop(key)
+    
+    return action, args, kwargs
+
+
+# Each of the native protocols' encoders turns a `[status, result]` response
+# into the bytes which are sent down the wire.
+
+def encode_json(object):
+    return codec.JSON.encode(object) + '\r\n'
+
+
+def encode_binary(object):
+    return framing.frame(framing.encode_response(*object))
+
+
+ENCODERS = {'json': encode_json, 'binary': encode_binary}
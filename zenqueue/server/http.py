@@ -2,27 +2,33 @@
 
 import optparse
 import random
-import re
+import signal
+import socket
 
 from eventlet import api
 from eventlet import wsgi
 
-from werkzeug import Request, Response
-from werkzeug import exceptions
-from werkzeug.routing import Map, Rule
-
-from zenqueue import json
 from zenqueue import log
 from zenqueue.queue import Queue
+from zenqueue.queue.durable import DurableQueue
+from zenqueue.queue.registry import DEFAULT_IDLE_TIMEOUT
+from zenqueue.server.common import (AbstractQueueServer, Subscribe,
+    TIMER_INTERVAL)
+from zenqueue.server.metrics import PROMETHEUS_CONTENT_TYPE
+from zenqueue.utils import codec
+from zenqueue.utils.async import exit_on_signal
 import zenqueue
 
 
 DEFAULT_MAX_CONC_REQUESTS = 1024
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+EVENTS_CONTENT_TYPE = 'text/event-stream; charset=utf-8'
 
 
 # Option parser setup (for command-line usage)
 
-USAGE = 'Usage: %prog [-i IFACE] [-p PORT] [-c NUM] [-l LEVEL]'
+USAGE = ('Usage: %prog [-i IFACE] [-p PORT] [-c NUM] [-e SECS] [-s NUM] '
+    '[-b BYTES] [--priorities] [-d DIR] [-l LEVEL] [--sample NUM]')
 OPTION_PARSER = optparse.OptionParser(prog='python -m zenqueue.server.http',
     usage=USAGE, version=zenqueue.__version__)
 OPTION_PARSER.add_option('-i', '--interface', default='0.0.0.0',
@@ -32,40 +38,107 @@ OPTION_PARSER.add_option('-p', '--port', type='int', default=3080,
 OPTION_PARSER.add_option('-c', '--max-connections', type='int', dest='max_size',
     help='Allow maximum NUM concurrent requests [default %default]',
     metavar='NUM', default=DEFAULT_MAX_CONC_REQUESTS)
+OPTION_PARSER.add_option('-e', '--idle-timeout', type='float',
+    dest='idle_timeout', default=DEFAULT_IDLE_TIMEOUT,
+    help='Evict named queues left empty for SECS seconds [default %default]',
+    metavar='SECS')
+OPTION_PARSER.add_option('-d', '--data-dir', dest='data_dir', default=None,
+    help='Keep the default queue on disk in directory DIR [default memory]',
+    metavar='DIR')
+OPTION_PARSER.add_option('-s', '--queue-size', type='int', dest='maxsize',
+    default=None, metavar='NUM',
+    help='Hold at most NUM items in each queue [default no limit]')
+OPTION_PARSER.add_option('-b', '--queue-bytes', type='int', dest='maxbytes',
+    default=None, metavar='BYTES',
+    help='Hold at most BYTES bytes in each queue [default no limit]')
+OPTION_PARSER.add_option('--priorities', action='store_true',
+    dest='priorities', default=False,
+    help='Allow items to be pushed with a priority [default %default]')
 OPTION_PARSER.add_option('-l', '--log-level', dest='log_level', default='INFO',
     help='Use log level LEVEL [default %default] (use SILENT for no logging)',
     metavar='LEVEL')
+OPTION_PARSER.add_option('--sample', type='int', dest='sample', default=1,
+    help='At log level DEBUG, trace one request in every NUM [default '
+         '%default]', metavar='NUM')
 
 # End option parser setup
 
 
-URL_MAP = Map([
-    Rule('/push/', endpoint='push'),
-    Rule('/pull/', endpoint='pull'),
-    Rule('/push_many/', endpoint='push_many'),
-    Rule('/pull_many/', endpoint='pull_many'),
-])
+# Each of these actions is available both on the default queue and on a named
+# queue, e.g. `/push/` and `/jobs/push/`. The others are for the whole server,
+# e.g. `/stats/`.
+QUEUE_ACTIONS = ['push', 'pull', 'push_many', 'pull_many', 'ack', 'nack',
+                 'extend', 'subscribe']
+SERVER_ACTIONS = ['credit', 'stats', 'metrics', 'batch']
 
 
-class JSONResponse(Response):
+class Reply(object):
+    
+    """
+    A response to a request: its status, headers and body.
+    
+    A body given as a string gets a Content-Length header. Anything else is
+    an iterable of strings, sent as each one is produced. Replies which never
+    change are made once, up front, and sent as they are every time.
+    """
     
-    def __new__(cls, obj, status=200):
-        return Response(response=json.dumps(obj), mimetype='application/json',
-            status=status)
+    __slots__ = ('status', 'headers', 'body')
+    
+    def __init__(self, body, content_type=JSON_CONTENT_TYPE, status='200 OK',
+                 headers=()):
+        self.status = status
+        self.headers = [('Content-Type', content_type)]
+        if isinstance(body, str):
+            self.headers.append(('Content-Length', str(len(body))))
+            body = [body]
+        self.headers.extend(headers)
+        self.body = body
+
+
+def json_reply(obj, status='200 OK'):
+    return Reply(codec.JSON.encode(obj), status=status)
 
 
-class HTTPQueueServer(object):
+SUCCESS = json_reply(['success', None])
+TIMEOUT = json_reply(['error:timeout', None])
+FULL = json_reply(['error:full', None], status='503 Service Unavailable')
+MALFORMED = json_reply(['error:request', 'malformed request'],
+                       status='400 Bad Request')
+NOT_FOUND = json_reply(['error:request', 'action not found'],
+                       status='404 Not Found')
+
+
+class HttpProtocol(wsgi.HttpProtocol):
     
-    def __init__(self, queue=None):
-        self.log = log.get_logger('zenq.server.http:%x' % (id(self),))
-        self.queue = queue or Queue()
+    # Writes every piece of a response as soon as it's produced. Passing
+    # minimum_chunk_size to wsgi.server() instead would set it on eventlet's
+    # own HttpProtocol, for every WSGI server in the process.
     
-    def unpack_args(self, data):
-        self.log.debug('Data received: %r', data)
+    minimum_chunk_size = 0
+
+
+class HTTPQueueServer(AbstractQueueServer):
+    
+    log_name = 'zenq.server.http'
+    queue_factory = Queue
+    
+    def __init__(self, *args, **kwargs):
+        super(HTTPQueueServer, self).__init__(*args, **kwargs)
+        
+        # Open subscriptions, by the ID their subscribers grant credit with.
+        self.subscriptions = {}
         
+        # The route for each path without a queue name in it, worked out once
+        # rather than on every request; see route().
+        self.routes = {}
+        for endpoint in QUEUE_ACTIONS + SERVER_ACTIONS:
+            self.routes['/%s/' % (endpoint,)] = (endpoint,
+                getattr(self, 'do_' + endpoint), None)
+    
+    def unpack_args(self, data):
         args, kwargs = (), {}
         if data:
-            parsed = json.loads(data)
+            parsed = codec.JSON.decode(data)
             if len(parsed) > 0:
                 args = parsed[0]
             if len(parsed) > 1:
@@ -77,64 +150,165 @@ class HTTPQueueServer(object):
         
         return args, kwargs
     
-    def __call__(self, request):
+    def route(self, path):
+        # Returns the endpoint for a path, the method which carries it out, and
+        # the queue named in the path (or None), or None if nothing matches.
+        try:
+            return self.routes[path]
+        except KeyError:
+            pass
+        # `/jobs/push/` splits into `['', 'jobs', 'push', '']`.
+        parts = path.split('/')
+        if (len(parts) == 4 and parts[1] and not parts[3] and
+            parts[2] in QUEUE_ACTIONS):
+            endpoint, method, queue = self.routes['/%s/' % (parts[2],)]
+            return endpoint, method, parts[1]
+        return None
+    
+    def __call__(self, environ, start_response):
+        # Requests in progress count as connected clients, as do open
+        # subscriptions (see stream()), since connections themselves are
+        # looked after by the WSGI server.
+        self.metrics.clients += 1
+        try:
+            reply = self.dispatch(environ)
+        finally:
+            self.metrics.clients -= 1
+        start_response(reply.status, reply.headers)
+        return reply.body
+    
+    def dispatch(self, environ):
         
-        adapter = URL_MAP.bind_to_environ(request.environ)
-        client_id = '%0.6x' % (random.randint(1, 16777215),)
+        # The WSGI environment stands in for the client, both in the logs and
+        # as the `client` argument to actions.
+        client = environ
         
         try:
-            endpoint, values = adapter.match()
-            action = 'do_' + endpoint
+            path = environ['PATH_INFO']
+            route = self.route(path)
+            if route is None:
+                # Paths are redirected to their canonical form, with a slash
+                # on the end (Prometheus asks for `/metrics`, for example).
+                if not path.endswith('/') and self.route(path + '/'):
+                    return Reply('', status='301 Moved Permanently',
+                                 headers=[('Location', path + '/')])
+                self.log.error('Missing action requested by client %x',
+                    id(client))
+                return NOT_FOUND
+            endpoint, method, queue = route
+            
+            # Only some requests (if any) are traced; see log.Tracer.
+            data = environ['wsgi.input'].read()
+            tracer = self.tracer
+            traced = tracer.enabled and tracer.sample()
+            if traced:
+                self.log.debug('Data received: %r', data)
             
             # Parse arguments and keyword arguments from request data.
             try:
-                args, kwargs = self.unpack_args(request.data)
+                args, kwargs = self.unpack_args(data)
             except ValueError:
-                self.log.error('Received malformed request from client %s',
-                    client_id)
-                return JSONResponse(['error:request', 'malformed request'],
-                    status=400) # Bad Request
-        
-            # Find the method corresponding to the requested action.
-            try:
-                method = getattr(self, action)
-            except AttributeError:
-                self.log.error('Missing action requested by client %s',
-                    client_id)
-                return JSONResponse(['error:request', 'action not found'],
-                    status=404) # Not Found
+                self.log.error('Received malformed request from client %x',
+                    id(client))
+                return MALFORMED
+            
+            # A queue name given in the URL takes precedence over the body.
+            if queue is not None:
+                kwargs['queue'] = queue
             
             # Run the method, dealing with exceptions or success.
             try:
-                self.log.debug('Action %r requested by client %s',
-                    action, client_id)
-                output = method(*args, **kwargs)
-            except self.queue.Timeout:
+                if traced:
+                    self.log.debug('Action %r requested by client %x',
+                        endpoint, id(client))
+                output = self.call_action(client, endpoint, method, args,
+                                          kwargs)
+            except Subscribe, exc:
+                return self.stream(exc.args[0])
+            except self.queues.Timeout:
                 # The client will pick this up. It's not so much a
                 # serious error, which is why we don't log it: timeouts
                 # are more often than not specified for very useful
                 # reasons.
-                return JSONResponse(['error:timeout', None])
+                return TIMEOUT
+            except self.queues.Full:
+                return FULL
             except Exception, exc:
                 self.log.error(
-                    'Action %r raised error %r for client %s',
-                    action, exc, client_id)
-                return JSONResponse(['error:action', repr(exc)], status=500)
+                    'Action %r raised error %r for client %x',
+                    endpoint, exc, id(client))
+                return json_reply(['error:action', repr(exc)],
+                    status='500 Internal Server Error')
             else:
                 # I guess debug is overkill.
-                self.log.debug('Action %r successful for client %s',
-                    action, client_id)
-                return JSONResponse(['success', output])
+                if traced:
+                    self.log.debug('Action %r successful for client %x',
+                        endpoint, id(client))
+                # Actions may also make a reply of their own.
+                if output is None:
+                    return SUCCESS
+                elif isinstance(output, Reply):
+                    return output
+                return json_reply(['success', output])
         except Exception, exc:
-            self.log.error('Unknown error occurred for client %s: %r',
-                client_id, exc)
+            self.log.error('Unknown error occurred for client %x: %r',
+                id(client), exc)
             # If we really don't know what happened, return a generic 500.
-            return JSONResponse(['error:unknown', repr(exc)], status=500)
-        except exceptions.HTTPException, exc:
-            return exc
+            return json_reply(['error:unknown', repr(exc)],
+                status='500 Internal Server Error')
+    
+    def stream(self, subscription):
+        
+        """
+        Stream a subscription's items to the client as server-sent events.
+        
+        The first event, `subscribed`, gives the ID which the client grants
+        more credit with (by POSTing `[[id, credit], {}]` to `/credit/`); each
+        event after that is a JSON list of items. The subscription ends when
+        the client disconnects. An item is only known not to have been sent
+        if writing it fails, so items which must not be lost should be pulled
+        with a lease.
+        """
+        
+        subscription_id = '%0.16x' % (random.getrandbits(64),)
+        self.subscriptions[subscription_id] = subscription
+        self.log.debug('Subscription %s opened', subscription_id)
+        
+        def events():
+            items = []
+            self.metrics.clients += 1
+            try:
+                yield 'event: subscribed\ndata: %s\n\n' % (
+                    codec.JSON.encode(subscription_id),)
+                while True:
+                    items = subscription.next_batch()
+                    yield 'data: %s\n\n' % (codec.JSON.encode(items),)
+                    items = []
+            finally:
+                self.metrics.clients -= 1
+                del self.subscriptions[subscription_id]
+                if items:
+                    subscription.give_back(items)
+                self.log.debug('Subscription %s closed', subscription_id)
+        
+        return Reply(events(), content_type=EVENTS_CONTENT_TYPE,
+                     headers=[('Cache-Control', 'no-cache')])
+    
+    def do_credit(self, client, subscription_id, credit):
+        # Returns False if the subscription has already ended.
+        subscription = self.subscriptions.get(subscription_id)
+        if subscription is None:
+            return False
+        subscription.grant(credit)
+        return True
+    
+    def do_metrics(self, client):
+        # For Prometheus to scrape.
+        return Reply(self.do_stats(client, format='prometheus'),
+                     content_type=PROMETHEUS_CONTENT_TYPE)
     
     def serve(self, interface='0.0.0.0', port=3080,
-        max_size=DEFAULT_MAX_CONC_REQUESTS):
+        max_size=DEFAULT_MAX_CONC_REQUESTS, access_log=None):
         
         self.log.info('ZenQueue HTTP Server v%s', zenqueue.__version__)
         if interface == '0.0.0.0':
@@ -143,29 +317,40 @@ class HTTPQueueServer(object):
             self.log.info('Serving on %s:%d', interface, port)
         
         self.sock = api.tcp_listener((interface, port))
+        # Accepted connections inherit this, so that responses to pipelined
+        # requests aren't held back waiting for the client to acknowledge the
+        # one before.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        api.spawn(self.run_timer_loop)
         
         try:
-            # Wrap `self` with `Request.application` so that we get a request as
-            # an argument instead of the usual `environ, start_response`.
-            wsgi.server(self.sock, Request.application(self), max_size=max_size)
+            # The server is a WSGI application in its own right. Every piece
+            # of a response is written as soon as it's produced, rather than
+            # being held back until there's a few KB of it, so that
+            # subscribers get each batch of items straight away. The access
+            # log goes to stderr unless another file is given.
+            wsgi.server(self.sock, self, max_size=max_size,
+                        protocol=HttpProtocol, log=access_log)
         finally:
             self.sock = None
+            # Durable queues sync and close their logs.
+            self.queues.close()
     
-    def do_push(self, value):
-        self.queue.push(value)
-    
-    def do_pull(self, timeout=None):
-        return self.queue.pull(timeout=timeout)
-    
-    def do_push_many(self, *values):
-        self.queue.push_many(*values)
-    
-    def do_pull_many(self, n, timeout=None):
-        return self.queue.pull_many(n, timeout=timeout)
+    def run_timer_loop(self):
+        # Runs alongside the WSGI server until it shuts down.
+        while self.sock is not None:
+            api.sleep(TIMER_INTERVAL)
+            try:
+                self.run_timers()
+            except Exception, exc:
+                self.log.error('Error %r occurred running timers', exc)
 
 
 def _main():
     options, args = OPTION_PARSER.parse_args()
+    if options.priorities and options.data_dir:
+        OPTION_PARSER.error('--priorities cannot be used with -d, as the '
+                            'durable default queue has no priorities')
     
     # Handle log level.
     log_level = options.log_level
@@ -178,9 +363,23 @@ def _main():
         log.ROOT_LOGGER.setLevel(log.INFO)
     else:
         log.ROOT_LOGGER.setLevel(getattr(log, log_level.upper()))
+    log.set_sampling(options.sample)
+    
+    # Every queue, including any created later on, gets the same settings.
+    def queue_factory():
+        return Queue(maxsize=options.maxsize, maxbytes=options.maxbytes,
+                     priorities=options.priorities)
+    
+    # Keep the default queue in a write-ahead log, if asked to.
+    queue = None
+    if options.data_dir:
+        queue = DurableQueue(options.data_dir, maxsize=options.maxsize,
+                             maxbytes=options.maxbytes)
     
-    # Instantiate and start server.
-    server = HTTPQueueServer()
+    # Instantiate and start server. SIGTERM shuts it down cleanly.
+    exit_on_signal(signal.SIGTERM)
+    server = HTTPQueueServer(queue=queue, queue_factory=queue_factory,
+                             idle_timeout=options.idle_timeout)
     server.serve(interface=options.interface, port=options.port,
                  max_size=options.max_size)
 
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+# Servers keep a Metrics object counting what they do: how many clients are
+# connected, how many items are pushed and pulled (and how fast), and how
+# long each action takes. Everything here is a plain counter or histogram
+# update, so it's cheap enough to do on every request. The state of every
+# queue is only looked at when the statistics are asked for.
+
+import math
+import time
+
+from zenqueue.utils.histogram import Histogram
+
+
+RATE_INTERVAL = 5.0 # Seconds between updates of the moving average rates.
+RATE_WINDOW = 60.0 # Seconds the moving average rates are taken over.
+
+# The outcomes an action can have, in the order they're reported.
+OUTCOMES = ('success', 'timeout', 'full', 'error')
+
+# Latencies are recorded in microseconds, and summarized at these percentiles.
+PERCENTILES = (50, 90, 99, 99.9)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Meter(object):
+    
+    """
+    Counts events, and keeps a moving average of how often they happen.
+    
+    The rate is an exponentially weighted moving average of events per second
+    over the last RATE_WINDOW seconds or so (like the load average), updated
+    by `tick()`.
+    """
+    
+    def __init__(self):
+        self.count = 0
+        self.rate = 0.0
+        self.last_count = 0
+        self.ticked = False
+    
+    def mark(self, count=1):
+        self.count += count
+    
+    def tick(self, elapsed):
+        current = (self.count - self.last_count) / elapsed
+        self.last_count = self.count
+        if self.ticked:
+            self.rate += (1 - math.exp(-elapsed / RATE_WINDOW)) * (
+                current - self.rate)
+        else:
+            self.rate = current
+            self.ticked = True
+
+
+class ActionMetrics(object):
+    
+    # How many times an action was carried out, how each of those turned out,
+    # and how long they took (in microseconds).
+    
+    def __init__(self):
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.latency = Histogram()
+    
+    def observe(self, seconds, outcome):
+        self.outcomes[outcome] += 1
+        self.latency.record(seconds * 1e6)
+
+
+class Metrics(object):
+    
+    """
+    The counters and histograms for a single server.
+    
+    The server marks the `pushed`, `pulled` and `redelivered` meters as items
+    pass through it, keeps `clients` up to date, and calls `observe()` after
+    each action and `tick()` every so often (from its timer loop).
+    """
+    
+    def __init__(self):
+        self.started = self.last_tick = time.time()
+        self.clients = 0
+        self.pushed = Meter()
+        self.pulled = Meter()
+        self.redelivered = Meter()
+        self.actions = {}
+    
+    def meters(self):
+        return (('pushed', self.pushed), ('pulled', self.pulled),
+                ('redelivered', self.redelivered))
+    
+    def observe(self, action, seconds, outcome='success'):
+        try:
+            metrics = self.actions[action]
+        except KeyError:
+            metrics = self.actions[action] = ActionMetrics()
+        metrics.observe(seconds, outcome)
+    
+    def tick(self, now=None):
+        # Updates the moving averages, if it's been RATE_INTERVAL seconds
+        # since they were last updated.
+        if now is None:
+            now = time.time()
+        elapsed = now - self.last_tick
+        if elapsed < RATE_INTERVAL:
+            return
+        self.last_tick = now
+        for name, meter in self.meters():
+            meter.tick(elapsed)
+    
+    def snapshot(self, queues):
+        
+        """
+        Return the statistics for the server and each queue in `queues`.
+        
+        The result is made only of dictionaries, numbers and strings, so that
+        it can be sent to a client as the result of an action. Rates are in
+        items per second, and latencies in microseconds.
+        """
+        
+        items = {}
+        rates = {}
+        for name, meter in self.meters():
+            items[name] = meter.count
+            rates[name] = meter.rate
+        
+        actions = {}
+        for action, metrics in self.actions.iteritems():
+            stats = dict(metrics.outcomes)
+            stats['count'] = metrics.latency.total
+            stats['latency'] = metrics.latency.summary(PERCENTILES)
+            actions[action] = stats
+        
+        return {'uptime': time.time() - self.started,
+                'clients': self.clients,
+                'items': items,
+                'rates': rates,
+                'queues': dict((name, queue_stats(queues.queues[name]))
+                               for name in queues),
+                'actions': actions}
+    
+    def prometheus(self, queues):
+        
+        """
+        Return the statistics in the Prometheus text exposition format.
+        
+        Action latencies are given as summaries, in seconds, with quantiles
+        taken over the whole life of the server.
+        """
+        
+        lines = []
+        def metric(name, type, help, samples):
+            lines.append('# HELP zenqueue_%s %s' % (name, help))
+            lines.append('# TYPE zenqueue_%s %s' % (name, type))
+            for suffix, labels, value in samples:
+                lines.append('zenqueue_%s%s%s %s' % (name, suffix,
+                    format_labels(labels), format_value(value)))
+        
+        metric('uptime_seconds', 'gauge', 'Seconds since the server started.',
+               [('', (), time.time() - self.started)])
+        metric('clients', 'gauge', 'Clients currently connected.',
+               [('', (), self.clients)])
+        for name, meter in self.meters():
+            metric('items_%s_total' % (name,), 'counter',
+                   'Items %s since the server started.' % (name,),
+                   [('', (), meter.count)])
+        
+        names = sorted(queues)
+        states = [(name, queue_stats(queues.queues[name])) for name in names]
+        for key, help in (('depth', 'Items waiting on the queue.'),
+                          ('waiting', 'Consumers waiting for items.'),
+                          ('leased', 'Items out on lease.'),
+                          ('scheduled', 'Items scheduled for later.')):
+            metric('queue_%s' % (key,), 'gauge', help,
+                   [('', (('queue', name),), stats[key])
+                    for name, stats in states])
+        
+        actions = sorted(self.actions.iteritems())
+        metric('requests_total', 'counter', 'Actions carried out, by outcome.',
+               [('', (('action', action), ('outcome', outcome)),
+                 metrics.outcomes[outcome])
+                for action, metrics in actions for outcome in OUTCOMES])
+        samples = []
+        for action, metrics in actions:
+            latency = metrics.latency
+            for percentile in PERCENTILES:
+                quantile = '%g' % (percentile / 100.0,)
+                samples.append(('', (('action', action), ('quantile', quantile)),
+                                latency.percentile(percentile) / 1e6))
+            samples.append(('_sum', (('action', action),), latency.sum / 1e6))
+            samples.append(('_count', (('action', action),), latency.total))
+        metric('request_duration_seconds', 'summary',
+               'How long actions took to carry out.', samples)
+        
+        return '\n'.join(lines) + '\n'
+
+
+def queue_stats(queue):
+    return {'depth': len(queue),
+            'waiting': queue.semaphore.waiting,
+            'leased': len(queue.leases),
+            'scheduled': len(queue.scheduled)}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, escape_label(value))
+                              for name, value in labels),)
+
+
+def escape_label(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = repr(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -2,56 +2,98 @@
 
 import errno
 import optparse
+import os
+import shutil
+import signal
 import socket
 import sys
+import tempfile
 
 from eventlet import api
 from eventlet import coros
+from eventlet import greenio
+from eventlet import wsgi
 
-from zenqueue import json
 from zenqueue import log
 from zenqueue.queue import Queue
+from zenqueue.queue.durable import DurableQueue
+from zenqueue.queue.registry import DEFAULT_IDLE_TIMEOUT, DEFAULT_QUEUE
+from zenqueue.server.common import (AbstractQueueServer, ActionError, Break,
+    Subscribe, SwitchProtocol, ENCODERS, TIMER_INTERVAL, parse_command,
+    partition, unpack_command)
+from zenqueue.server.metrics import PROMETHEUS_CONTENT_TYPE
+from zenqueue.utils import framing
+from zenqueue.utils.async import Lock, exit_on_signal
 import zenqueue
 
 
 DEFAULT_MAX_CONC_REQUESTS = 1024
 
+# The actions which operate on a named queue. With several worker processes,
+# these are carried out by whichever worker owns the queue.
+ROUTED_ACTIONS = frozenset(['push', 'pull', 'push_many', 'pull_many', 'ack',
+                            'nack', 'extend'])
+
 
 # Option parser setup (for command-line usage)
 
-USAGE = 'Usage: %prog [-i IFACE] [-p PORT] [-c NUM] [-l LEVEL]'
+USAGE = ('Usage: %prog [-i IFACE] [-p PORT] [-w NUM] [-c NUM] [-e SECS] '
+    '[-s NUM] [-b BYTES] [--priorities] [-d DIR] [-m PORT] [-l LEVEL] '
+    '[--sample NUM]')
 OPTION_PARSER = optparse.OptionParser(prog='python -m zenqueue.server.native',
     usage=USAGE, version=zenqueue.__version__)
 OPTION_PARSER.add_option('-i', '--interface', default='0.0.0.0',
     help='Bind to interface IFACE [default %default]', metavar='IFACE')
 OPTION_PARSER.add_option('-p', '--port', type='int', default=3000,
     help='Run on port PORT [default %default]', metavar='PORT')
+OPTION_PARSER.add_option('-w', '--workers', type='int', default=1,
+    help='Run NUM worker processes on the same port [default %default]',
+    metavar='NUM')
 OPTION_PARSER.add_option('-c', '--max-connections', type='int', dest='max_size',
     help='Allow maximum NUM concurrent requests [default %default]',
     metavar='NUM', default=DEFAULT_MAX_CONC_REQUESTS)
+OPTION_PARSER.add_option('-e', '--idle-timeout', type='float',
+    dest='idle_timeout', default=DEFAULT_IDLE_TIMEOUT,
+    help='Evict named queues left empty for SECS seconds [default %default]',
+    metavar='SECS')
+OPTION_PARSER.add_option('-d', '--data-dir', dest='data_dir', default=None,
+    help='Keep the default queue on disk in directory DIR [default memory]',
+    metavar='DIR')
+OPTION_PARSER.add_option('-s', '--queue-size', type='int', dest='maxsize',
+    default=None, metavar='NUM',
+    help='Hold at most NUM items in each queue [default no limit]')
+OPTION_PARSER.add_option('-b', '--queue-bytes', type='int', dest='maxbytes',
+    default=None, metavar='BYTES',
+    help='Hold at most BYTES bytes in each queue [default no limit]')
+OPTION_PARSER.add_option('--priorities', action='store_true',
+    dest='priorities', default=False,
+    help='Allow items to be pushed with a priority [default %default]')
+OPTION_PARSER.add_option('-m', '--metrics-port', type='int',
+    dest='metrics_port', default=None, metavar='PORT',
+    help='Serve Prometheus metrics over HTTP on port PORT (plus the number of '
+         'the worker, with several) [default none]')
 OPTION_PARSER.add_option('-l', '--log-level', dest='log_level', default='INFO',
     help='Use log level LEVEL [default %default] (use SILENT for no logging)',
     metavar='LEVEL')
+OPTION_PARSER.add_option('--sample', type='int', dest='sample', default=1,
+    help='At log level DEBUG, trace one request in every NUM [default '
+         '%default]', metavar='NUM')
 
 # End option parser setup
 
 
-# These exception definitions, while empty, allow code higher up the call chain
-# to identify the nature of an error. Break, for example, is more of a signal
-# than an error.
-class ActionError(Exception): pass
-class Break(Exception): pass
-
-
-class NativeQueueServer(object):
+class NativeQueueServer(AbstractQueueServer):
     
-    def __init__(self, queue=None, max_size=DEFAULT_MAX_CONC_REQUESTS):
-        
-        self.log = log.get_logger('zenq.server.native:%x' % (id(self),))
+    log_name = 'zenq.server.native'
+    queue_factory = Queue
+    
+    def __init__(self, queue=None, max_size=DEFAULT_MAX_CONC_REQUESTS,
+                 queue_factory=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 worker=0, peers=None):
         
-        # An initial queue may be provided; this might help with durable queues
-        # (i.e. those that save their state to disk and can restore it on load).
-        self.queue = queue or Queue()
+        # Initializes the log and the queue registry.
+        super(NativeQueueServer, self).__init__(queue=queue,
+            queue_factory=queue_factory, idle_timeout=idle_timeout)
         
         # The client pool is a pool of coroutines which doesn't allow more than
         # max_size coroutines to be running 'at the same time' (although
@@ -60,16 +102,47 @@ class NativeQueueServer(object):
         self.client_pool = coros.CoroutinePool(max_size=max_size)
         
         self.socket = None
+        
+        # When the server is one of several worker processes, `peers` holds
+        # the address of every worker's internal socket, and `worker` is this
+        # one's index into it. Each queue belongs to exactly one worker, and
+        # requests for queues belonging to the others are passed on to them
+        # over connections kept in peer_connections.
+        self.worker = worker
+        self.peers = peers
+        self.peer_connections = {}
+        
+        # Clients which have subscribed to a queue, mapped to their Streams.
+        self.streams = {}
     
-    def serve(self, interface='0.0.0.0', port=3000):
+    def serve(self, interface='0.0.0.0', port=3000, reuse_port=False,
+              peer_socket=None, metrics_port=None):
         
         self.log.info('ZenQueue Native Server v%s', zenqueue.__version__)
+        if self.peers:
+            self.log.info('Worker %d of %d', self.worker + 1, len(self.peers))
         if interface == '0.0.0.0':
             self.log.info('Serving on %s:%d (all interfaces)', interface, port)
         else:
             self.log.info('Serving on %s:%d', interface, port)
         
-        self.socket = api.tcp_listener((interface, port))
+        # With SO_REUSEPORT, each worker has a listening socket of its own on
+        # the same port, and the kernel shares connections out between them.
+        if reuse_port:
+            self.socket = reuse_port_listener((interface, port))
+        else:
+            self.socket = api.tcp_listener((interface, port))
+        # Accepted connections inherit this, so that a large response (or the
+        # last piece of one) isn't held back waiting for the client to
+        # acknowledge the one before.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if peer_socket is not None:
+            api.spawn(self.serve_peers, greenio.GreenSocket(peer_socket))
+        api.spawn(self.run_timer_loop)
+        if metrics_port is not None:
+            self.log.info('Serving metrics on %s:%d', interface, metrics_port)
+            api.spawn(self.serve_metrics,
+                      api.tcp_listener((interface, metrics_port)))
         
         # A lot of the code below was copied or adapted from eventlet's
         # implementation of an asynchronous WSGI server.
@@ -112,52 +185,142 @@ class NativeQueueServer(object):
                     raise
             finally:
                 self.socket = None
+                # Durable queues sync and close their logs.
+                self.queues.close()
     
-    @staticmethod
-    def parse_command(line):
-        command = json.loads(line)
-        
-        # The specification for commands is really simple. Essentially they
-        # consist of lists:
-        #     ['action_name', ['arg1', 'arg2'], {'key': 'value'}]
-        # The protocol is surprisingly close to Remote Procedure Call (RPC).
-        action, args, kwargs = command[0], (), {}
-        if len(command) > 1:
-            args = command[1]
-        if len(command) > 2:
-            kwargs = command[2]
-        
-        # Convert unicode strings to byte strings.
-        for key in kwargs.keys():
-            kwargs[str(key)] = kwargs.pop(key)
+    def run_timer_loop(self):
+        # Runs alongside the accept loop until the server shuts down.
+        while self.socket is not None:
+            api.sleep(TIMER_INTERVAL)
+            try:
+                self.run_timers()
+            except Exception, exc:
+                self.log.error('Error %r occurred running timers', exc)
+    
+    def serve_metrics(self, listener):
+        # Every request, whatever its path, gets the Prometheus metrics. The
+        # access log goes to the server's own log, at debug level.
+        def application(environ, start_response):
+            body = self.do_stats(None, format='prometheus')
+            start_response('200 OK', [('Content-Type', PROMETHEUS_CONTENT_TYPE),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        wsgi.server(listener, application, log=LogWriter(self.log))
+    
+    def serve_peers(self, peer_socket):
+        # Accepts connections from the other workers, which speak the binary
+        # protocol from the outset. Their requests came from clients, and have
+        # been checked already, so frames of any length are read.
+        try:
+            while self.socket is not None:
+                client_socket, client_addr = peer_socket.accept()
+                self.client_pool.execute_async(self.handle, client_socket,
+                                               'binary', None)
+        finally:
+            peer_socket.close()
+    
+    def owner(self, kwargs):
+        # The index of the worker which owns the queue a request is for.
+        return partition(kwargs.get('queue', DEFAULT_QUEUE), len(self.peers))
+    
+    def forward(self, owner, action, args, kwargs):
+        # Sends a request on to the worker which owns its queue, returning the
+        # `[status, result]` response so it can be relayed to the client as-is.
+        # Idle connections to each worker are kept for reuse; one which fails
+        # part-way through a request, or which the worker is about to drop
+        # after an action error, is closed rather than being put back.
+        idle = self.peer_connections.setdefault(owner, [])
+        if idle:
+            connection = idle.pop()
+        else:
+            peer = greenio.GreenSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+            peer.connect(self.peers[owner])
+            connection = (peer, peer.makefile('r'), peer.makefile('w'))
         
-        return action, args, kwargs
+        peer, reader, writer = connection
+        try:
+            framing.write_frame(writer,
+                framing.encode_request(action, args, kwargs))
+            writer.flush()
+            frame = framing.read_frame(reader, None)
+            if frame is None:
+                raise socket.error(errno.ECONNRESET,
+                    'Worker %d closed the connection' % (owner + 1,))
+            response = list(framing.decode_response(frame))
+        except:
+            peer.close()
+            raise
+        if response[0] == 'error:action':
+            peer.close()
+        else:
+            idle.append(connection)
+        return response
+    
+    parse_command = staticmethod(parse_command)
     
-    def handle(self, client):
+    def handle(self, client, protocol='json', max_frame=framing.MAX_FRAME):
         reader, writer = client.makefile('r'), client.makefile('w')
         
+        # Every client starts off speaking line-based JSON, but may switch to
+        # length-prefixed binary frames with the `protocol` action.
+        write = PROTOCOLS[protocol]
+        tracer = self.tracer
+        self.metrics.clients += 1
+        
         try:
             while True:
                 try:
-                    # If the client sends an empty line, ignore it.
-                    line = reader.readline()
-                    stripped_line = line.rstrip('\r\n')
-                    if not line:
-                        break
-                    elif not stripped_line:
-                        api.sleep(0)
-                        continue
+                    if protocol == 'binary':
+                        try:
+                            frame = framing.read_frame(reader, max_frame)
+                        except framing.FrameTooLarge, exc:
+                            # The rest of the frame would have to be read to
+                            # get past it, so the client is disconnected.
+                            self.log.error('Received oversized frame from '
+                                'client %x', id(client))
+                            write(writer, ['error:request', str(exc)])
+                            break
+                        if frame is None:
+                            break
+                        parse, data = framing.decode_request, frame
+                    else:
+                        # If the client sends an empty line, ignore it.
+                        line = reader.readline()
+                        stripped_line = line.rstrip('\r\n')
+                        if not line:
+                            break
+                        elif not stripped_line:
+                            api.sleep(0)
+                            continue
+                        parse, data = self.parse_command, stripped_line
                 
                     # Try to parse the request, failing if it is invalid.
                     try:
-                        action, args, kwargs = self.parse_command(stripped_line)
+                        action, args, kwargs = parse(data)
                     except ValueError:
                         # Request was malformed. ValueError is raised by
-                        # simplejson when the passed string is not valid JSON.
+                        # simplejson when the passed string is not valid JSON,
+                        # and by the framing module for invalid frames.
                         self.log.error('Received malformed request from client %x',
                             id(client))
-                        write_json(writer, ['error:request', 'malformed request'])
+                        write(writer, ['error:request', 'malformed request'])
                         continue
+                    
+                    # Only some requests (if any) are traced; see log.Tracer.
+                    traced = tracer.enabled and tracer.sample()
+                    
+                    # Requests for queues which belong to another worker are
+                    # carried out there.
+                    if self.peers and action in ROUTED_ACTIONS:
+                        owner = self.owner(kwargs)
+                        if owner != self.worker:
+                            if traced:
+                                self.log.debug('Forwarding %r from client %x '
+                                    'to worker %d', action, id(client),
+                                    owner + 1)
+                            write(writer,
+                                self.forward(owner, action, args, kwargs))
+                            continue
                 
                     # Find the method corresponding to the requested action.
                     try:
@@ -165,41 +328,65 @@ class NativeQueueServer(object):
                     except AttributeError:
                         self.log.error('Missing action requested by client %x',
                             id(client))
-                        write_json(writer, ['error:request', 'action not found'])
+                        write(writer, ['error:request', 'action not found'])
                         continue
                 
                     # Run the method, dealing with exceptions or success.
                     try:
-                        self.log.debug('Action %r requested by client %x',
-                            action, id(client))
+                        if traced:
+                            self.log.debug('Action %r requested by client %x',
+                                action, id(client))
                         # All actions get the client socket as an additional
                         # argument. This means they can do cool things with the
                         # client object that might not be possible otherwise.
-                        output = method(client, *args, **kwargs)
+                        output = self.call_action(client, action, method, args,
+                                                  kwargs)
                     except Break:
                         # The Break error propagates up the call chain and
                         # causes the server to disconnect the client.
                         break
-                    except self.queue.Timeout:
+                    except Subscribe, exc:
+                        # From now on responses share the client's socket with
+                        # the items being streamed to it, so they're written
+                        # by the stream, one message at a time.
+                        stream = self.streams.get(client)
+                        if stream is None:
+                            stream = Stream(client, protocol, self.log)
+                            self.streams[client] = stream
+                            writer, write = stream.writer, stream.write
+                        stream.stop()
+                        write(writer, ['success', None])
+                        stream.start(exc.args[0])
+                    except SwitchProtocol, exc:
+                        # The acknowledgement is sent using the old protocol;
+                        # everything after it uses the new one.
+                        write(writer, ['success', exc.args[0]])
+                        protocol = exc.args[0]
+                        write = PROTOCOLS[protocol]
+                    except self.queues.Timeout:
                         # The client will pick this up. It's not so much a
                         # serious error, which is why we don't log it: timeouts
                         # are more often than not specified for very useful
                         # reasons.
-                        write_json(writer, ['error:timeout', None])
+                        write(writer, ['error:timeout', None])
+                    except self.queues.Full:
+                        # Much the same as a timeout, but for producers.
+                        write(writer, ['error:full', None])
                     except Exception, exc:
                         self.log.error(
                             'Action %r raised error %r for client %x',
                             action, exc, id(client))
-                        write_json(writer, ['error:action', repr(exc)])
+                        write(writer, ['error:action', repr(exc)])
                         # Chances are that if an error occurred, we'll need to
                         # raise it properly. This will trigger the closing of
                         # the client socket via the finally clause below.
                         raise ActionError(exc)
                     else:
                         # I guess debug is overkill.
-                        self.log.debug('Action %r successful for client %x',
-                            action, id(client))
-                        write_json(writer, ['success', output])
+                        if traced:
+                            self.log.debug('Action %r successful for client '
+                                '%x', action, id(client))
+                        write(writer, ['success', output])
                 except ActionError, exc:
                     # Raise the inner action error. This will prevent the
                     # catch-all except statement below from logging action
@@ -210,7 +397,7 @@ class NativeQueueServer(object):
                     self.log.error('Unknown error occurred for client %x: %r',
                         id(client), exc)
                     # If we really don't know what happened, then
-                    write_json(writer, ['error:unknown', repr(exc)])
+                    write(writer, ['error:unknown', repr(exc)])
                     raise # Raises the last exception, in this case exc.
         except:
             # If any exception has been raised at this point, it will show up as
@@ -221,26 +408,13 @@ class NativeQueueServer(object):
             # actual call to the quit, exit or shutdown actions), then it will
             # not include an error-level logging event.
             self.log.info('Client %x disconnected', id(client))
+            self.metrics.clients -= 1
+            stream = self.streams.pop(client, None)
+            if stream is not None:
+                stream.close()
             client.close()
     
-    # Most of these methods are pure wrappers around the underlying queue
-    # object.
-    
-    def do_push(self, client, value):
-        self.queue.push(value)
-    
-    def do_pull(self, client, timeout=None):
-        # Timeouts will propagate upwards to the client loop and be handled
-        # accordingly.
-        return self.queue.pull(timeout=timeout)
-    
-    def do_push_many(self, client, *values):
-        self.queue.push_many(*values)
-    
-    def do_pull_many(self, client, n, timeout=None):
-        # Timeouts will propagate upwards to the client loop and be handled
-        # accordingly.
-        return self.queue.pull_many(n, timeout=timeout)
+    # The queue actions themselves are inherited from AbstractQueueServer.
     
     def do_quit(self, client):
         client.shutdown(socket.SHUT_RDWR)
@@ -249,15 +423,255 @@ class NativeQueueServer(object):
         raise Break
     # exit and shutdown are synonyms for quit.
     do_exit = do_shutdown = do_quit
+    
+    def do_protocol(self, client, name):
+        if name not in ENCODERS:
+            raise ValueError('Unknown protocol: %r' % (name,))
+        elif client in self.streams:
+            raise ValueError('Cannot switch protocol after subscribing')
+        # Caught by the client loop, which acknowledges the request and then
+        # changes how it reads requests and writes responses.
+        raise SwitchProtocol(str(name))
+    
+    def do_subscribe(self, client, queue=DEFAULT_QUEUE, **kwargs):
+        # Items can only be streamed from queues this worker owns.
+        if self.peers and self.owner({'queue': queue}) != self.worker:
+            raise ValueError('Queue %r belongs to worker %d' % (
+                queue, self.owner({'queue': queue}) + 1))
+        return super(NativeQueueServer, self).do_subscribe(client,
+            queue=queue, **kwargs)
+    
+    def run_batched(self, client, command):
+        # As with requests sent on their own, batched commands for queues
+        # which belong to another worker are carried out there.
+        if self.peers:
+            try:
+                action, args, kwargs = unpack_command(command)
+            except ValueError:
+                pass # Reported as usual below.
+            else:
+                if action in ROUTED_ACTIONS:
+                    owner = self.owner(kwargs)
+                    if owner != self.worker:
+                        return self.forward(owner, action, args, kwargs)
+        return super(NativeQueueServer, self).run_batched(client, command)
+    
+    def do_credit(self, client, credit):
+        # Lets a subscriber be sent `credit` more items. Returns False if the
+        # client isn't subscribed to anything.
+        stream = self.streams.get(client)
+        if stream is None or stream.subscription is None:
+            return False
+        stream.subscription.grant(credit)
+        return True
+    
+    def do_unsubscribe(self, client, *items, **kwargs):
+        # Once the response to this has been sent, no more items will be. Any
+        # items given were sent to the client but not used, and are put back
+        # on the front of the queue, in the order they were sent in. They can
+        # only be handed back to the subscription which sent them.
+        stream = self.streams.get(client)
+        if stream is not None:
+            stream.stop()
+        if items:
+            subscription = stream and stream.stopped
+            if (subscription is None or
+                subscription.name != kwargs.get('queue', DEFAULT_QUEUE)):
+                raise ValueError('No subscription to hand items back to')
+            subscription.hand_back(items)
+
+
+class Stream(object):
+    
+    """
+    Sends the items from a client's subscription to it as they arrive.
+    
+    Items are written by a coroutine of their own, while the client's own
+    coroutine carries on reading its requests. The two mustn't wait on the
+    same socket at once (the hub only keeps one listener per descriptor), so
+    the items and any further responses are written to a duplicate of the
+    client's socket instead, each under a lock so they can't be interleaved.
+    Any items which were pulled but couldn't be sent are put back on the
+    queue.
+    """
+    
+    def __init__(self, client, protocol, log):
+        self.log = log
+        self.client_id = id(client)
+        # socket.dup() would share the same descriptor; fromfd() doesn't.
+        self.socket = greenio.GreenSocket(socket.fromfd(client.fileno(),
+            client.family, socket.SOCK_STREAM))
+        self.writer = self.socket.makefile('w')
+        self.encode = PROTOCOLS[protocol]
+        self.lock = Lock()
+        self.subscription = None
+        self.stopped = None # The last subscription, once it's been stopped.
+        self.coroutine = None
+    
+    def write(self, writer, object):
+        self.lock.acquire()
+        try:
+            self.encode(writer, object)
+        finally:
+            self.lock.release()
+    
+    def start(self, subscription):
+        self.subscription = subscription
+        self.coroutine = api.spawn(self.run, subscription)
+    
+    def run(self, subscription):
+        items = []
+        try:
+            while True:
+                items = subscription.next_batch()
+                self.write(self.writer, ['items', items])
+                items = []
+        except api.GreenletExit:
+            pass
+        except Exception, exc:
+            self.log.error('Error %r occurred streaming to client %x', exc,
+                self.client_id)
+        finally:
+            if items:
+                self.log.debug('Returning %d unsent items to the queue',
+                    len(items))
+                subscription.give_back(items)
+    
+    def stop(self, wait=True):
+        # Normally the coroutine is only stopped between writes, so that the
+        # client is never sent part of a message.
+        coroutine, self.coroutine = self.coroutine, None
+        if self.subscription is not None:
+            self.stopped, self.subscription = self.subscription, None
+        if coroutine is None or coroutine.dead:
+            return
+        if not wait:
+            api.kill(coroutine)
+            return
+        self.lock.acquire()
+        try:
+            api.kill(coroutine)
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        # The client has gone, so there's no point waiting for writes to it.
+        self.stop(wait=False)
+        self.socket.close()
 
 
 def write_json(writer, object):
-    # A simple utility method.
-    writer.write(json.dumps(object) + '\r\n')
+    # A simple utility method. The writer may be buffered, so it's flushed to
+    # make sure the client actually gets the response.
+    writer.write(ENCODERS['json'](object))
+    writer.flush()
+
+
+def write_binary(writer, object):
+    writer.write(ENCODERS['binary'](object))
+    writer.flush()
+
+
+PROTOCOLS = {'json': write_json, 'binary': write_binary}
+
+
+class LogWriter(object):
+    
+    # Lets eventlet's WSGI server write its access log to a logger.
+    
+    def __init__(self, log):
+        self.log = log
+    
+    def write(self, data):
+        self.log.debug('%s', data.rstrip('\n'))
+
+
+def reuse_port_listener(address, backlog=50):
+    # Like api.tcp_listener(), but allows other processes to listen on the same
+    # port at the same time.
+    listener = greenio.GreenSocket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    listener.listen(backlog)
+    return listener
+
+
+def prefork(options, make_server):
+    
+    """
+    Run `options.workers` server processes, all serving on the same port.
+    
+    The workers' internal sockets (which they use to pass requests on to each
+    other) are all bound before any worker starts, so that none of them can
+    be sent a request before another is ready for it. If any worker exits, the
+    rest are shut down too, as the queues it owned are gone.
+    """
+    
+    peer_dir = tempfile.mkdtemp(prefix='zenqueue-')
+    peers = [os.path.join(peer_dir, 'worker-%d.sock' % (worker,))
+             for worker in xrange(options.workers)]
+    peer_sockets = []
+    for address in peers:
+        peer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer_socket.bind(address)
+        peer_socket.listen(DEFAULT_MAX_CONC_REQUESTS)
+        peer_sockets.append(peer_socket)
+    
+    pids = []
+    try:
+        for worker in xrange(options.workers):
+            pid = os.fork()
+            if pid == 0:
+                # Each worker only needs its own internal socket.
+                for other, peer_socket in enumerate(peer_sockets):
+                    if other != worker:
+                        peer_socket.close()
+                exit_on_signal(signal.SIGTERM)
+                status = 0
+                try:
+                    server = make_server(worker, peers)
+                    metrics_port = options.metrics_port
+                    if metrics_port is not None:
+                        metrics_port += worker
+                    server.serve(interface=options.interface,
+                                 port=options.port, reuse_port=True,
+                                 peer_socket=peer_sockets[worker],
+                                 metrics_port=metrics_port)
+                except SystemExit:
+                    pass # Shut down by SIGTERM.
+                except:
+                    log.ROOT_LOGGER.exception('Worker %d failed', worker + 1)
+                    status = 1
+                os._exit(status)
+            pids.append(pid)
+        
+        # SIGTERM is turned into an exception, so that the workers are shut
+        # down on the way out.
+        def terminate(signum, frame):
+            raise SystemExit
+        signal.signal(signal.SIGTERM, terminate)
+        
+        pid, status = os.wait()
+        pids.remove(pid)
+        log.ROOT_LOGGER.error('Worker process %d exited; shutting down', pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        shutil.rmtree(peer_dir, ignore_errors=True)
 
 
 def _main():
     options, args = OPTION_PARSER.parse_args()
+    if options.priorities and options.data_dir:
+        OPTION_PARSER.error('--priorities cannot be used with -d, as the '
+                            'durable default queue has no priorities')
     
     # Handle log level.
     log_level = options.log_level
@@ -270,10 +684,36 @@ def _main():
         log.ROOT_LOGGER.setLevel(log.INFO)
     else:
         log.ROOT_LOGGER.setLevel(getattr(log, log_level.upper()))
+    log.set_sampling(options.sample)
+    
+    # Every queue, including any created later on, gets the same settings.
+    def queue_factory():
+        return Queue(maxsize=options.maxsize, maxbytes=options.maxbytes,
+                     priorities=options.priorities)
     
-    # Instantiate and start server.
-    server = NativeQueueServer(max_size=options.max_size)
-    server.serve(interface=options.interface, port=options.port)
+    def make_server(worker=0, peers=None):
+        # Keep the default queue in a write-ahead log, if asked to. Only the
+        # worker which owns it opens the log.
+        queue = None
+        if options.data_dir and (
+            not peers or partition(DEFAULT_QUEUE, len(peers)) == worker):
+            queue = DurableQueue(options.data_dir, maxsize=options.maxsize,
+                                 maxbytes=options.maxbytes)
+        return NativeQueueServer(queue=queue, max_size=options.max_size,
+                                 queue_factory=queue_factory,
+                                 idle_timeout=options.idle_timeout,
+                                 worker=worker, peers=peers)
+    
+    # Instantiate and start server, or several in separate processes.
+    if options.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            OPTION_PARSER.error('Multiple workers need SO_REUSEPORT, which '
+                                'this platform lacks')
+        prefork(options, make_server)
+    else:
+        exit_on_signal(signal.SIGTERM)
+        make_server().serve(interface=options.interface, port=options.port,
+                            metrics_port=options.metrics_port)
 
 
 if __name__ == '__main__':
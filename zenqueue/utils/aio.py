@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Synchronization primitives and stream helpers for the asyncio backend. These
+# are written in the Trollius dialect of asyncio (`yield From(...)` and
+# `raise Return(...)`), since that's the only way to use asyncio from Python 2.
+
+from collections import deque
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    raise ImportError('Looks like you need to install Trollius')
+
+from zenqueue.utils import framing
+
+
+class Semaphore(object):
+    
+    """
+    A semaphore for coroutines running on an asyncio event loop.
+    
+    This works just like `zenqueue.utils.async.Semaphore`, except that
+    `acquire()` is a coroutine, which must be yielded from. Each waiting
+    coroutine is represented by a future, and futures are resolved in the order
+    they started waiting. A future which has been cancelled (as `wait_for()`
+    does on a timeout) is left in the queue as a tombstone, to be skipped over.
+    """
+    
+    class WaitCancelled(Exception): pass
+    class Timeout(Exception): pass
+    
+    def __init__(self, initial=0):
+        self.waiters = deque()
+        self.__count = initial
+        self.__waiting = 0 # Waiters which are still pending.
+    
+    @asyncio.coroutine
+    def acquire(self, timeout=None):
+        
+        if self.__count > 0:
+            self.__count -= 1
+            return
+        
+        # The count is never incremented on behalf of a waiting coroutine;
+        # release() hands it straight over instead, so nothing else can take
+        # it before the waiter gets to run.
+        waiter = asyncio.Future()
+        self.waiters.appendleft(waiter)
+        self.__waiting += 1
+        
+        try:
+            if timeout is None:
+                result = yield From(waiter)
+            else:
+                result = yield From(asyncio.wait_for(waiter, timeout))
+        except (asyncio.TimeoutError, asyncio.CancelledError), exc:
+            if not waiter.done() or waiter.cancelled():
+                # The cancelled future is a tombstone; release() skips it.
+                waiter.cancel()
+                self.__waiting -= 1
+                self.sweep()
+            elif waiter.result():
+                # The count was handed over just as the wait ended, so it's
+                # passed on to the next waiter.
+                self.release()
+            if isinstance(exc, asyncio.TimeoutError):
+                raise self.Timeout
+            raise
+        
+        if not result:
+            raise self.WaitCancelled
+    
+    @asyncio.coroutine
+    def acquire_many(self, n=None, timeout=None):
+        
+        # See zenqueue.utils.async.Semaphore.acquire_many().
+        taken = 0
+        if self.__count <= 0:
+            yield From(self.acquire(timeout=timeout))
+            taken = 1
+        
+        if n is None:
+            extra = self.__count
+        else:
+            extra = min(n - taken, self.__count)
+        extra = max(extra, 0)
+        self.__count -= extra
+        raise Return(taken + extra)
+    
+    def release(self):
+        # The count goes to the first waiter which is still waiting, or back
+        # into the semaphore if there isn't one.
+        while self.waiters:
+            waiter = self.waiters.pop()
+            if not waiter.done():
+                self.__waiting -= 1
+                waiter.set_result(True)
+                return
+        self.__count += 1
+    
+    def release_many(self, n):
+        # The same as calling release() n times.
+        while n and self.waiters:
+            waiter = self.waiters.pop()
+            if not waiter.done():
+                self.__waiting -= 1
+                waiter.set_result(True)
+                n -= 1
+        self.__count += n
+    
+    def sweep(self):
+        # See zenqueue.utils.async.Semaphore.sweep().
+        if len(self.waiters) > 2 * self.__waiting + 64:
+            self.waiters = deque(waiter for waiter in self.waiters
+                                 if not waiter.done())
+    
+    def cancel_all(self):
+        while self.waiters:
+            waiter = self.waiters.pop()
+            if not waiter.done():
+                waiter.set_result(False)
+        self.__waiting = 0
+    
+    @property
+    def count(self):
+        return self.__count
+    
+    @property
+    def waiting(self):
+        return self.__waiting
+
+
+class Lock(Semaphore):
+    
+    def __init__(self):
+        super(Lock, self).__init__(initial=1)
+    
+    @property
+    def in_use(self):
+        return (self.count == 0)
+
+
+# Streams can't be wrapped with makefile(), so the native protocol needs its
+# own helpers for reading requests and responses.
+
+STREAM_LIMIT = 2 ** 24 # The longest line a stream will read, in bytes.
+
+
+@asyncio.coroutine
+def read_line(reader):
+    # Returns None if the connection was closed.
+    line = yield From(reader.readline())
+    if not line:
+        raise Return(None)
+    raise Return(line.rstrip('\r\n'))
+
+
+@asyncio.coroutine
+def read_frame(reader, max_length=framing.MAX_FRAME):
+    # See zenqueue.utils.framing.read_frame().
+    try:
+        header = yield From(reader.readexactly(framing.LENGTH.size))
+        length = framing.check_length(framing.LENGTH.unpack(header)[0],
+                                      max_length)
+        payload = yield From(reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        raise Return(None)
+    raise Return(payload)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from collections import deque
+import signal
+import sys
 
 from eventlet import api
 from eventlet import coros
@@ -23,6 +25,11 @@ class Semaphore(object):
     release() increases the count. If a coroutine attempts to acquire() a
     semaphore with a count of zero, the coroutine will yield until another
     coroutine release()s it.
+    
+    Waiting coroutines are woken in the order they started waiting, and the
+    count is handed straight to the one being woken, so nothing else can take
+    it first. A waiter which times out leaves its event in the queue as a
+    tombstone rather than searching the queue for it, so giving up is O(1).
     """
     
     class WaitCancelled(Exception): pass
@@ -31,6 +38,7 @@ class Semaphore(object):
     def __init__(self, initial=0):
         self.coro_queue = deque()
         self.__count = initial
+        self.__waiting = 0 # Waiters in coro_queue which aren't tombstones.
     
     def __enter__(self):
         self.acquire()
@@ -42,45 +50,109 @@ class Semaphore(object):
     
     def acquire(self, timeout=None):
         
-        if self.__count <= 0:
-            ready_event = coros.event()
-            self.coro_queue.appendleft(ready_event)
-            
-            timer = DummyTimer()
-            if timeout is not None:
-                timer = api.exc_after(timeout, self.Timeout)
-            
+        if self.__count > 0:
+            self.__count -= 1
+            return
+        
+        ready_event = coros.event()
+        self.coro_queue.appendleft(ready_event)
+        self.__waiting += 1
+        
+        timer = DummyTimer()
+        if timeout is not None:
+            timer = api.exc_after(timeout, self.Timeout)
+        
+        try:
             try:
                 result = ready_event.wait()
-            except self.Timeout:
-                if ready_event in self.coro_queue:
-                    self.coro_queue.remove(ready_event)
-                raise
-            else:
+            finally:
                 timer.cancel()
-                
-            if not result:
-                raise self.WaitCancelled
+        except:
+            exc_info = sys.exc_info()
+            if ready_event.ready():
+                # The count was handed over just as the wait ended, so it's
+                # passed on to the next waiter.
+                if ready_event.wait():
+                    self.release()
+            else:
+                # An event which has been sent is a tombstone; release() skips
+                # over it, so the waiter will never be woken.
+                ready_event.send(False)
+                self.__waiting -= 1
+                self.sweep()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+        if not result:
+            raise self.WaitCancelled
+    
+    def acquire_many(self, n=None, timeout=None):
         
-        self.__count -= 1
+        # Takes as much of the count as is available, up to n (or all of it if
+        # n is None), and returns how much was taken. This only blocks if none
+        # is available, and then only until one can be acquired.
+        taken = 0
+        if self.__count <= 0:
+            self.acquire(timeout=timeout)
+            taken = 1
+        
+        if n is None:
+            extra = self.__count
+        else:
+            extra = min(n - taken, self.__count)
+        extra = max(extra, 0)
+        self.__count -= extra
+        return taken + extra
     
     def release(self):
+        # The count goes to the first live waiter, or back into the semaphore
+        # if there isn't one.
+        while self.coro_queue:
+            ready_event = self.coro_queue.pop()
+            if not ready_event.ready():
+                self.__waiting -= 1
+                ready_event.send(True)
+                api.sleep(0)
+                return
         self.__count += 1
     
-        if self.coro_queue:
+    def release_many(self, n):
+        # The same as calling release() n times, except that every waiting
+        # coroutine which can be is woken before yielding, and only once.
+        woken = 0
+        while self.coro_queue and woken < n:
             ready_event = self.coro_queue.pop()
-            ready_event.send(True)
+            if not ready_event.ready():
+                self.__waiting -= 1
+                ready_event.send(True)
+                woken += 1
+        self.__count += n - woken
+        if woken:
             api.sleep(0)
     
+    def sweep(self):
+        # Tombstones are normally dropped by release(), but if waiters keep
+        # timing out with nothing being released they would pile up. They're
+        # swept out once they outnumber the live waiters, which keeps the cost
+        # amortized O(1) per timeout.
+        if len(self.coro_queue) > 2 * self.__waiting + 64:
+            self.coro_queue = deque(ready_event
+                for ready_event in self.coro_queue if not ready_event.ready())
+    
     def cancel_all(self):
         while self.coro_queue:
             ready_event = self.coro_queue.pop()
-            ready_event.send(False)
+            if not ready_event.ready():
+                ready_event.send(False)
+        self.__waiting = 0
         api.sleep(0)
     
     @property
     def count(self):
         return self.__count
+    
+    @property
+    def waiting(self):
+        return self.__waiting
 
 
 class Lock(Semaphore):
@@ -103,4 +175,15 @@ def callcc(function):
     def callback(value):
         continuation.send(value)
     function(callback)
-    return continuation.next()
\ No newline at end of file
+    return continuation.next()
+
+
+def exit_on_signal(signum):
+    # Makes the signal raise SystemExit in the calling (main) coroutine, so
+    # that a server unwinds as it would on a keyboard interrupt. Raising it in
+    # the handler itself would hit whichever coroutine happened to be running,
+    # and a client's handler would just drop the connection.
+    main = api.getcurrent()
+    def handler(signum, frame):
+        api.get_hub().schedule_call_global(0, main.throw, SystemExit)
+    signal.signal(signum, handler)
@@ -0,0 +1,358 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time the threaded semaphore which sync queues are built on.
+
+The semaphore is timed against the one it replaced (kept here unchanged as
+`EventSemaphore`, which parked each waiting thread on a fresh
+`threading.Event`): uncontended, with two threads handing the count back and
+forth, and with several producer and consumer threads hammering on it. Before
+that, each run soaks it under contention as a sanity check on the figures;
+the hand-off and timeout behaviour themselves are tested in
+tests/test_semaphore.py.
+"""
+
+from collections import deque
+import optparse
+import random
+import threading
+import time
+
+from zenqueue.utils import sync
+from zenqueue.utils.sync import with_lock
+
+
+option_parser = optparse.OptionParser(
+    usage='python -m zenqueue.utils.benchmark [options]', version='0.2')
+
+option_parser.add_option('-n', '--num-operations', metavar='COUNT',
+    default=100000, type='int',
+    help='Acquire/release COUNT times per run [default %default]')
+
+option_parser.add_option('-p', '--producers', metavar='COUNT', default=4,
+    type='int',
+    help='Release from COUNT threads at once [default %default]')
+
+option_parser.add_option('-c', '--consumers', metavar='COUNT', default=4,
+    type='int',
+    help='Acquire from COUNT threads at once [default %default]')
+
+option_parser.add_option('-s', '--skip-soak', action='store_true',
+    default=False,
+    help='Only time the semaphores, without soaking them first')
+
+
+class EventWaiter(object):
+    
+    """A thread waiting on a semaphore."""
+    
+    __slots__ = ('event', 'result', 'abandoned')
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None # True once woken, False if cancelled.
+        self.abandoned = False # Set when the waiter times out.
+
+
+class EventSemaphore(object):
+    
+    """
+    The previous sync semaphore, for comparison.
+    
+    This is `zenqueue.utils.sync.Semaphore` (and its `Waiter`) as it was
+    before waiters were parked on reusable locks, copied unchanged but for the
+    names: each waiting thread gets a fresh `threading.Event`.
+    """
+    
+    class WaitCancelled(Exception): pass
+    class Timeout(Exception): pass
+    
+    def __init__(self, initial=0):
+        self.evt_queue = deque()
+        self._lock = threading.Lock()
+        self.__count = initial
+        self.__waiting = 0 # Waiters in evt_queue which haven't been abandoned.
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+    
+    def acquire(self, timeout=None):
+        
+        self._lock.acquire()
+        try:
+            if self.__count > 0:
+                self.__count -= 1
+                return
+            waiter = EventWaiter()
+            self.evt_queue.appendleft(waiter)
+            self.__waiting += 1
+        finally:
+            self._lock.release()
+        
+        # A timeout of None implies eternal blocking.
+        waiter.event.wait(timeout)
+        
+        self._lock.acquire()
+        try:
+            # The result is only ever set with the lock held, so if it still
+            # isn't, the waiter can be abandoned without a race.
+            if waiter.result is None:
+                waiter.abandoned = True
+                self.__waiting -= 1
+                self.sweep()
+                raise self.Timeout
+        finally:
+            self._lock.release()
+        
+        if not waiter.result:
+            raise self.WaitCancelled
+    
+    def acquire_many(self, n=None, timeout=None):
+        
+        # See zenqueue.utils.async.Semaphore.acquire_many().
+        if not self.try_acquire():
+            self.acquire(timeout=timeout)
+        
+        self._lock.acquire()
+        try:
+            if n is None:
+                extra = self.__count
+            else:
+                extra = max(min(n - 1, self.__count), 0)
+            self.__count -= extra
+        finally:
+            self._lock.release()
+        return 1 + extra
+    
+    @with_lock
+    def try_acquire(self):
+        if self.__count > 0:
+            self.__count -= 1
+            return True
+        return False
+    
+    @with_lock
+    def release(self):
+        while self.evt_queue:
+            waiter = self.evt_queue.pop()
+            if not waiter.abandoned:
+                self.__waiting -= 1
+                waiter.result = True
+                waiter.event.set()
+                return
+        self.__count += 1
+    
+    @with_lock
+    def release_many(self, n):
+        # The same as calling release() n times.
+        while n and self.evt_queue:
+            waiter = self.evt_queue.pop()
+            if not waiter.abandoned:
+                self.__waiting -= 1
+                waiter.result = True
+                waiter.event.set()
+                n -= 1
+        self.__count += n
+    
+    def sweep(self):
+        # Must be called with the lock held. See the async Semaphore's sweep().
+        if len(self.evt_queue) > 2 * self.__waiting + 64:
+            self.evt_queue = deque(waiter for waiter in self.evt_queue
+                                   if not waiter.abandoned)
+    
+    @with_lock
+    def cancel_all(self):
+        while self.evt_queue:
+            waiter = self.evt_queue.pop()
+            if not waiter.abandoned:
+                waiter.result = False
+                waiter.event.set()
+        self.__waiting = 0
+    
+    @property
+    def count(self):
+        return self.__count
+    
+    @property
+    def waiting(self):
+        return self.__waiting
+
+
+IMPLEMENTATIONS = [
+    ('sync.Semaphore', sync.Semaphore),
+    ('EventSemaphore (previous)', EventSemaphore),
+]
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def split(total, parts):
+    # Divides `total` into `parts` counts which add back up to it.
+    return [total // parts + (i < total % parts) for i in xrange(parts)]
+
+
+def soak(semaphore_class, operations, producers, consumers):
+    
+    """
+    Check that no count is lost or made up under random contention.
+    
+    Consumers acquire with short, random timeouts while the producers release,
+    so that waiters are abandoned and woken at the same time. Every release
+    must then be accounted for by exactly one successful acquire, or still be
+    left on the semaphore.
+    """
+    
+    semaphore = semaphore_class(initial=0)
+    acquired = [0] * consumers
+    done = threading.Event()
+    
+    def produce(count):
+        for i in xrange(count):
+            semaphore.release()
+            if not i % 64:
+                time.sleep(0)
+    
+    def consume(index):
+        rand = random.Random(index)
+        while not done.isSet():
+            try:
+                semaphore.acquire(timeout=rand.random() * 0.002)
+            except semaphore.Timeout:
+                continue
+            acquired[index] += 1
+    
+    consumer_threads = [threading.Thread(target=consume, args=(i,))
+                        for i in xrange(consumers)]
+    for thread in consumer_threads:
+        thread.setDaemon(True)
+        thread.start()
+    run_threads([lambda count=count: produce(count)
+                 for count in split(operations, producers)])
+    
+    # Let the consumers take whatever they can before stopping them.
+    deadline = time.time() + 5
+    while sum(acquired) < operations and time.time() < deadline:
+        time.sleep(0.01)
+    done.set()
+    for thread in consumer_threads:
+        thread.join()
+    
+    assert sum(acquired) + semaphore.count == operations, (
+        'Released %d, but acquired %d with %d left' % (
+            operations, sum(acquired), semaphore.count))
+    assert semaphore.waiting == 0, (
+        '%d waiters left behind' % (semaphore.waiting,))
+    
+    # Waiters which are still blocked must be woken by cancel_all().
+    if hasattr(semaphore, 'cancel_all'):
+        while semaphore.count:
+            semaphore.acquire()
+        cancelled = []
+        def wait():
+            try:
+                semaphore.acquire()
+            except semaphore.WaitCancelled:
+                cancelled.append(True)
+        waiters = [threading.Thread(target=wait) for i in xrange(consumers)]
+        for thread in waiters:
+            thread.start()
+        while semaphore.waiting < consumers:
+            time.sleep(0.001)
+        semaphore.cancel_all()
+        for thread in waiters:
+            thread.join()
+        assert len(cancelled) == consumers, 'Waiters were not cancelled'
+
+
+def time_uncontended(semaphore_class, operations):
+    semaphore = semaphore_class(initial=1)
+    start_time = time.time()
+    for i in xrange(operations):
+        semaphore.acquire()
+        semaphore.release()
+    return time.time() - start_time
+
+
+def time_contended(semaphore_class, operations, producers, consumers):
+    # Consumers start out waiting, so most counts are handed straight over.
+    semaphore = semaphore_class(initial=0)
+    
+    def produce(count):
+        for i in xrange(count):
+            semaphore.release()
+    
+    def consume(count):
+        for i in xrange(count):
+            semaphore.acquire()
+    
+    targets = [lambda count=count: consume(count)
+               for count in split(operations, consumers)]
+    targets.extend(lambda count=count: produce(count)
+                   for count in split(operations, producers))
+    start_time = time.time()
+    run_threads(targets)
+    return time.time() - start_time
+
+
+def time_handoff(semaphore_class, operations):
+    # Two threads take turns, so that every acquire has to wait to be woken.
+    ping, pong = semaphore_class(initial=0), semaphore_class(initial=0)
+    
+    def serve():
+        for i in xrange(operations):
+            ping.acquire()
+            pong.release()
+    
+    def volley():
+        for i in xrange(operations):
+            ping.release()
+            pong.acquire()
+    
+    start_time = time.time()
+    run_threads([serve, volley])
+    return time.time() - start_time
+
+
+def main():
+    options, args = option_parser.parse_args()
+    operations = options.num_operations
+    
+    for name, semaphore_class in IMPLEMENTATIONS:
+        print name
+        
+        if not options.skip_soak:
+            soak(semaphore_class, operations, options.producers,
+                 options.consumers)
+            print '  Soak passed'
+        
+        time_taken = time_uncontended(semaphore_class, operations)
+        print '  Uncontended: %0.4f seconds (%0.1f operations/second)' % (
+            time_taken, operations / time_taken)
+        
+        time_taken = time_handoff(semaphore_class, operations)
+        print '  Hand-off: %0.4f seconds (%0.1f operations/second)' % (
+            time_taken, operations / time_taken)
+        
+        time_taken = time_contended(semaphore_class, operations,
+                                    options.producers, options.consumers)
+        print '  Contended (%d producers, %d consumers): %0.4f seconds ' \
+            '(%0.1f operations/second)' % (options.producers,
+                                            options.consumers, time_taken,
+                                            operations / time_taken)
+
+
+if __name__ == '__main__':
+    main()
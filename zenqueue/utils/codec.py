@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Codecs turn values into byte strings and back. The JSON codec is what the
+# JSON protocols (the native protocol's default, and HTTP) are written in, and
+# any codec can also be given to a client to encode the values it pushes, so
+# that the server only ever stores opaque byte strings. With the binary
+# protocol, the server then passes those through untouched, without decoding
+# and re-encoding what's inside them.
+#
+# New codecs are added with register(), and looked up by name with get().
+
+from zenqueue import json
+from zenqueue.utils import framing
+
+
+class Codec(object):
+    
+    name = NotImplemented
+    # Codecs whose output isn't text can't be carried by the JSON protocols.
+    binary = False
+    
+    def encode(self, value):
+        raise NotImplementedError
+    
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    
+    # The encoder and decoder are built once, rather than on every call, and
+    # the output is as compact as it can be.
+    name = 'json'
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    decoder = json.JSONDecoder()
+    
+    def encode(self, value):
+        return self.encoder.encode(value)
+    
+    def decode(self, data):
+        return self.decoder.decode(data)
+
+
+class BinaryCodec(Codec):
+    
+    # The compact tagged encoding the binary protocol uses (see framing).
+    name = 'binary'
+    binary = True
+    
+    def encode(self, value):
+        return framing.encode(value)
+    
+    def decode(self, data):
+        return framing.decode(data)
+
+
+class RawCodec(Codec):
+    
+    # Values are byte strings already, and are passed through as they are.
+    name = 'raw'
+    binary = True
+    
+    def encode(self, value):
+        if not isinstance(value, str):
+            raise TypeError('The raw codec only takes byte strings, not %r' % (
+                type(value),))
+        return value
+    
+    def decode(self, data):
+        return data
+
+
+CODECS = {}
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+    return codec
+
+
+def get(codec):
+    # Accepts a codec, or the name of a registered one.
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError('Unknown codec: %r' % (codec,))
+
+
+JSON = register(JSONCodec())
+register(BinaryCodec())
+register(RawCodec())
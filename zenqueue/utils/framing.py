@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# This module implements the binary variant of the native protocol. Instead of
+# CR/LF-terminated lines of JSON, every request and response is sent as a
+# frame: a four-byte big-endian length followed by that many bytes of payload.
+#
+# A request payload is a one-byte action code, followed by the positional
+# arguments (as an encoded list) and the keyword arguments (as an encoded map).
+# A response payload is a one-byte status code followed by the encoded result.
+# Actions and statuses which aren't in the tables below are sent with a code
+# of zero, followed by their encoded name.
+#
+# Values are encoded with a single tag byte, followed by a fixed-size body or
+# by a four-byte length and that many bytes. Byte strings are passed through
+# verbatim, so large or binary payloads never need escaping.
+
+import struct
+
+
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+
+MIN_INT, MAX_INT = -(2 ** 63), (2 ** 63) - 1
+
+# The longest frame the servers will read. The length comes first, so a longer
+# one is refused before any of its payload is read (or room made for it).
+MAX_FRAME = 64 * 1024 * 1024
+
+# New entries must only ever be appended to these tables, since the position of
+# each entry determines its code on the wire.
+ACTIONS = ['push', 'pull', 'push_many', 'pull_many', 'quit', 'exit',
+    'shutdown', 'protocol', 'ack', 'nack', 'extend', 'subscribe', 'credit',
+    'unsubscribe', 'stats', 'batch']
+STATUSES = ['success', 'error:action', 'error:request', 'error:timeout',
+    'error:unknown', 'error:full', 'items']
+
+ACTION_CODES = dict((action, chr(i + 1)) for i, action in enumerate(ACTIONS))
+STATUS_CODES = dict((status, chr(i + 1)) for i, status in enumerate(STATUSES))
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def encode(value):
+    parts = []
+    _encode(value, parts.append)
+    return ''.join(parts)
+
+
+def _encode(value, write):
+    # `bool` is a subclass of `int`, so it has to be checked for first.
+    if value is None:
+        write('N')
+    elif value is True:
+        write('T')
+    elif value is False:
+        write('F')
+    elif isinstance(value, str):
+        write('b' + LENGTH.pack(len(value)))
+        write(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        write('u' + LENGTH.pack(len(value)))
+        write(value)
+    elif isinstance(value, (int, long)):
+        if MIN_INT <= value <= MAX_INT:
+            write('i' + INT.pack(value))
+        else:
+            value = str(value)
+            write('l' + LENGTH.pack(len(value)) + value)
+    elif isinstance(value, float):
+        write('d' + FLOAT.pack(value))
+    elif isinstance(value, (list, tuple)):
+        write('a' + LENGTH.pack(len(value)))
+        for item in value:
+            _encode(item, write)
+    elif isinstance(value, dict):
+        write('m' + LENGTH.pack(len(value)))
+        for key, item in value.iteritems():
+            _encode(key, write)
+            _encode(item, write)
+    else:
+        raise TypeError('Cannot encode %r' % (value,))
+
+
+def decode(data):
+    value, offset = _decode(data, 0)
+    if offset != len(data):
+        raise ValueError('Trailing data after encoded value')
+    return value
+
+
+def _decode(data, offset):
+    try:
+        return DECODERS[data[offset]](data, offset + 1)
+    except KeyError:
+        raise ValueError('Unknown type tag %r at offset %d' % (
+            data[offset], offset))
+    except (IndexError, struct.error):
+        raise ValueError('Truncated value at offset %d' % (offset,))
+
+
+def _decode_bytes(data, offset):
+    length = LENGTH.unpack_from(data, offset)[0]
+    start = offset + LENGTH.size
+    end = start + length
+    if end > len(data):
+        raise IndexError
+    return data[start:end], end
+
+
+def _decode_unicode(data, offset):
+    value, offset = _decode_bytes(data, offset)
+    return value.decode('utf-8'), offset
+
+
+def _decode_long(data, offset):
+    value, offset = _decode_bytes(data, offset)
+    return long(value), offset
+
+
+def _decode_list(data, offset):
+    count = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    result = []
+    for i in xrange(count):
+        item, offset = _decode(data, offset)
+        result.append(item)
+    return result, offset
+
+
+def _decode_map(data, offset):
+    count = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    result = {}
+    for i in xrange(count):
+        key, offset = _decode(data, offset)
+        result[key], offset = _decode(data, offset)
+    return result, offset
+
+
+DECODERS = {
+    'N': lambda data, offset: (None, offset),
+    'T': lambda data, offset: (True, offset),
+    'F': lambda data, offset: (False, offset),
+    'b': _decode_bytes,
+    'u': _decode_unicode,
+    'i': lambda data, offset: (INT.unpack_from(data, offset)[0],
+                               offset + INT.size),
+    'l': _decode_long,
+    'd': lambda data, offset: (FLOAT.unpack_from(data, offset)[0],
+                               offset + FLOAT.size),
+    'a': _decode_list,
+    'm': _decode_map,
+}
+
+
+def _encode_name(name, codes):
+    try:
+        return codes[name]
+    except KeyError:
+        return '\x00' + encode(name)
+
+
+def _decode_name(data, table):
+    if not data:
+        raise ValueError('Empty frame')
+    code = ord(data[0])
+    if code == 0:
+        return _decode(data, 1)
+    try:
+        return table[code - 1], 1
+    except IndexError:
+        raise ValueError('Unknown code %d' % (code,))
+
+
+def encode_request(action, args, kwargs):
+    parts = [_encode_name(action, ACTION_CODES)]
+    _encode(list(args), parts.append)
+    _encode(kwargs, parts.append)
+    return ''.join(parts)
+
+
+def decode_request(data):
+    action, offset = _decode_name(data, ACTIONS)
+    args, offset = _decode(data, offset)
+    kwargs, offset = _decode(data, offset)
+    if offset != len(data):
+        raise ValueError('Trailing data after request')
+    if not (isinstance(args, list) and isinstance(kwargs, dict)):
+        raise ValueError('Malformed request')
+    
+    # Keyword argument names must be byte strings to be used with **kwargs.
+    for key in kwargs.keys():
+        kwargs[str(key)] = kwargs.pop(key)
+    
+    return action, args, kwargs
+
+
+def encode_response(status, result):
+    return _encode_name(status, STATUS_CODES) + encode(result)
+
+
+def decode_response(data):
+    status, offset = _decode_name(data, STATUSES)
+    result, offset = _decode(data, offset)
+    if offset != len(data):
+        raise ValueError('Trailing data after response')
+    return status, result
+
+
+def frame(payload):
+    return LENGTH.pack(len(payload)) + payload
+
+
+def write_frame(writer, payload):
+    writer.write(frame(payload))
+
+
+def read_frame(reader, max_length=MAX_FRAME):
+    # Returns None if the connection was closed, even if that happened halfway
+    # through a frame. Clients, which trust the server, pass a `max_length` of
+    # None to read frames of any length.
+    header = reader.read(LENGTH.size)
+    if len(header) < LENGTH.size:
+        return None
+    length = check_length(LENGTH.unpack(header)[0], max_length)
+    payload = reader.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+
+def check_length(length, max_length):
+    if max_length is not None and length > max_length:
+        raise FrameTooLarge('Frame of %d bytes is longer than %d' % (
+            length, max_length))
+    return length
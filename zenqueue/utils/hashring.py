@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import hashlib
+import struct
+
+
+DEFAULT_REPLICAS = 160 # Points on the ring for each node.
+
+
+class HashRing(object):
+    
+    """
+    A consistent hash ring, mapping keys onto a changing set of nodes.
+    
+    Every node is placed at `replicas` pseudo-random points around the ring,
+    and a key belongs to the node at the first point after the key's own hash.
+    Adding or removing a node only moves the keys which fall next to its
+    points, which is about 1/N of them for N nodes, and the rest stay put.
+    Hashes are taken from MD5 rather than hash(), so that every process
+    agrees on where a key lives.
+    """
+    
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self.nodes = set()
+        self.points = {} # Maps each point on the ring to its node.
+        self.hashes = [] # The points, in order around the ring.
+        for node in nodes:
+            self.add(node)
+    
+    def __len__(self):
+        return len(self.nodes)
+    
+    def __contains__(self, node):
+        return node in self.nodes
+    
+    def __iter__(self):
+        return iter(self.nodes)
+    
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in xrange(self.replicas):
+            point = ring_hash('%s-%d' % (node, i))
+            # On the rare collision, the node which got there first keeps it.
+            if point not in self.points:
+                self.points[point] = node
+        self.hashes = sorted(self.points)
+    
+    def remove(self, node):
+        self.nodes.remove(node)
+        for point, owner in self.points.items():
+            if owner == node:
+                del self.points[point]
+        self.hashes = sorted(self.points)
+    
+    def get(self, key):
+        """Return the node which `key` belongs to."""
+        
+        if not self.hashes:
+            raise LookupError('No nodes on the ring')
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.points[self.hashes[index]]
+    
+    def get_nodes(self, key, count):
+        """Return up to `count` distinct nodes for `key`, in ring order."""
+        
+        if not self.hashes:
+            raise LookupError('No nodes on the ring')
+        count = min(count, len(self.nodes))
+        nodes = []
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        for offset in xrange(len(self.hashes)):
+            node = self.points[self.hashes[(index + offset) % len(self.hashes)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+def ring_hash(key):
+    # Keys which aren't strings (such as ints) are hashed by their str().
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    elif not isinstance(key, str):
+        key = str(key)
+    return struct.unpack('>I', hashlib.md5(key).digest()[:4])[0]
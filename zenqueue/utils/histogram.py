@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+
+DEFAULT_DIGITS = 2 # Significant decimal digits kept for every value.
+
+
+class Histogram(object):
+    
+    """
+    A histogram of non-negative integers, in the style of HdrHistogram.
+    
+    Values are counted in buckets whose width grows with the size of the
+    value, so that every value is kept to `digits` significant decimal digits
+    (a relative error of under 1%, by default) however large it is. This
+    takes a fixed, small amount of memory no matter how many values are
+    recorded, and histograms from several threads can simply be merged.
+    """
+    
+    def __init__(self, digits=DEFAULT_DIGITS):
+        self.digits = digits
+        # Values below sub_bucket_count are counted exactly. Above that, each
+        # doubling of the value range is split into sub_bucket_half buckets.
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+        self.sub_bucket_count = 2 ** self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count // 2
+        
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+    
+    def __len__(self):
+        return self.total
+    
+    def index(self, value):
+        # A value with a bit_length() of n is in [2 ** (n - 1), 2 ** n), and
+        # every such range above the exact ones is split the same way.
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return (shift * self.sub_bucket_half) + (value >> shift)
+    
+    def highest_equivalent(self, index):
+        # The largest value which would have been counted at `index`.
+        if index < self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_half - 1
+        sub_bucket = index - shift * self.sub_bucket_half
+        return ((sub_bucket + 1) << shift) - 1
+    
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            raise ValueError('Histograms only hold non-negative values')
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def merge(self, other):
+        if other.digits != self.digits:
+            raise ValueError('Cannot merge histograms of different precision')
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+    
+    def percentile(self, percentile):
+        """The value which `percentile` percent of values are at or below."""
+        
+        if not self.total:
+            return None
+        wanted = max(1, int(math.ceil(self.total * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                # Never report more than the largest value actually recorded.
+                return min(self.highest_equivalent(index), self.max)
+        return self.max
+    
+    def mean(self):
+        if not self.total:
+            return None
+        return self.sum / float(self.total)
+    
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        # A dictionary of the usual statistics, ready to be dumped as JSON.
+        result = {'count': self.total, 'min': self.min, 'max': self.max,
+                  'mean': self.mean()}
+        for percentile in percentiles:
+            result['p%s' % (str(percentile).replace('.', ''),)] = (
+                self.percentile(percentile))
+        return result
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import heapq
+
+
+class PriorityDeque(object):
+    
+    """
+    A stand-in for `collections.deque` which keeps items in priority levels.
+    
+    Each level is an ordinary deque, and `pop()` always takes from the highest
+    non-empty level, so items come out highest priority first and in FIFO order
+    within a level. Only the operations queues actually use are provided, and
+    those which add items take an optional priority. Finding the highest level
+    is O(1); adding or removing a whole level is O(log L), for L levels.
+    """
+    
+    def __init__(self, iterable=(), priority=0):
+        self.levels = {}
+        self.heap = [] # Negated priorities, so the highest is at the top.
+        self.length = 0
+        self.extendleft(iterable, priority)
+    
+    def __len__(self):
+        return self.length
+    
+    def __iter__(self):
+        # Like a deque, this runs from the last item to be popped to the next.
+        for priority in sorted(self.levels):
+            for value in self.levels[priority]:
+                yield value
+    
+    def level(self, priority):
+        try:
+            return self.levels[priority]
+        except KeyError:
+            level = self.levels[priority] = deque()
+            heapq.heappush(self.heap, -priority)
+            return level
+    
+    def appendleft(self, value, priority=0):
+        self.level(priority).appendleft(value)
+        self.length += 1
+    
+    def extendleft(self, values, priority=0):
+        level = self.level(priority)
+        before = len(level)
+        level.extendleft(values)
+        self.length += len(level) - before
+        if not level:
+            self.remove_level(priority)
+    
+    def append(self, value, priority=None):
+        # Appending puts an item at the front of its level, to be popped next
+        # from there. Without a priority, it goes at the very front, in the
+        # highest level there is.
+        if priority is None:
+            if self.heap:
+                priority = -self.heap[0]
+            else:
+                priority = 0
+        self.level(priority).append(value)
+        self.length += 1
+    
+    def pop(self):
+        return self.pop_with_priority()[0]
+    
+    def pop_with_priority(self):
+        # Returns the next item along with the priority it had.
+        if not self.heap:
+            raise IndexError('pop from an empty deque')
+        priority = -self.heap[0]
+        level = self.levels[priority]
+        value = level.pop()
+        self.length -= 1
+        if not level:
+            self.remove_level(priority)
+        return value, priority
+    
+    def remove_level(self, priority):
+        del self.levels[priority]
+        if -self.heap[0] == priority:
+            heapq.heappop(self.heap)
+        else:
+            self.heap.remove(-priority)
+            heapq.heapify(self.heap)
+    
+    def clear(self):
+        self.levels.clear()
+        del self.heap[:]
+        self.length = 0
@@ -4,6 +4,7 @@ from collections import deque
 from functools import wraps
 
 import threading
+import time
 
 
 def with_lock(method):
@@ -68,9 +69,58 @@ class Event(object):
         raise self.WaitCancelled
 
 
+def wait_for_lock(lock, timeout):
+    """Acquire a lock, blocking for at most `timeout` seconds (or forever)."""
+    
+    if timeout is None:
+        return lock.acquire()
+    
+    # Python 2 locks can't be acquired with a timeout, so this polls with an
+    # increasing delay, just as threading.Condition.wait() does.
+    endtime = time.time() + timeout
+    delay = 0.0005
+    while True:
+        if lock.acquire(False):
+            return True
+        remaining = endtime - time.time()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
+class Waiter(object):
+    
+    """A thread waiting on a semaphore."""
+    
+    __slots__ = ('lock', 'result', 'abandoned')
+    
+    def __init__(self):
+        # The lock is held for as long as the waiter is idle, and released to
+        # wake the thread parked on it.
+        self.lock = threading.Lock()
+        self.lock.acquire()
+        self.reset()
+    
+    def reset(self):
+        self.result = None # True once woken, False if cancelled.
+        self.abandoned = False # Set when the waiter times out.
+
+
 class Semaphore(object):
     
-    """A semaphore with queueing which records the threads which acquire it."""
+    """
+    A semaphore with queueing which records the threads which acquire it.
+    
+    All of the semaphore's state is guarded by a single lock, so when the count
+    is positive an acquire is just a decrement with it held, and allocates
+    nothing. Otherwise the thread parks on a waiter of its own, and waiters are
+    woken in the order they started waiting, with the count handed straight to
+    the one being woken. A thread which times out marks its waiter as
+    abandoned, which release() skips over, rather than searching the queue for
+    it. Waiters are kept for reuse once they're done with, so a busy semaphore
+    doesn't allocate on the contended path either.
+    """
     
     class WaitCancelled(Exception): pass
     class Timeout(Exception): pass
@@ -79,6 +129,8 @@ class Semaphore(object):
         self.evt_queue = deque()
         self._lock = threading.Lock()
         self.__count = initial
+        self.__waiting = 0 # Waiters in evt_queue which haven't been abandoned.
+        self.__spare = [] # Idle waiters, ready to be reused.
     
     def __enter__(self):
         self.acquire()
@@ -90,39 +142,118 @@ class Semaphore(object):
     
     def acquire(self, timeout=None):
         
-        if self.__count <= 0:
-            ready_event = Event()
-            self.evt_queue.appendleft(ready_event)
-            
-            try:
-                result = ready_event.wait(timeout=timeout)
-            except ready_event.Timeout:
-                if ready_event in self.evt_queue:
-                    self.evt_queue.remove(ready_event)
+        self._lock.acquire()
+        if self.__count > 0:
+            self.__count -= 1
+            self._lock.release()
+            return
+        try:
+            if self.__spare:
+                waiter = self.__spare.pop()
+            else:
+                waiter = Waiter()
+            self.evt_queue.appendleft(waiter)
+            self.__waiting += 1
+        finally:
+            self._lock.release()
+        
+        # A timeout of None implies eternal blocking.
+        parked = wait_for_lock(waiter.lock, timeout)
+        
+        self._lock.acquire()
+        try:
+            result = waiter.result
+            # The result is only ever set with the lock held, so if it still
+            # isn't, the waiter can be abandoned without a race. It goes back
+            # to the spares once release() has taken it off the queue.
+            if result is None:
+                waiter.abandoned = True
+                self.__waiting -= 1
+                self.sweep()
                 raise self.Timeout
-            except ready_event.WaitCancelled:
-                if ready_event in self.evt_queue:
-                    self.evt_queue.remove(ready_event)
-                raise self.WaitCancelled
+            # The waiter may have been woken just after the wait timed out, in
+            # which case its lock needs taking again before it's reused.
+            if not parked:
+                waiter.lock.acquire()
+            waiter.reset()
+            self.__spare.append(waiter)
+        finally:
+            self._lock.release()
+        
+        if not result:
+            raise self.WaitCancelled
+    
+    def acquire_many(self, n=None, timeout=None):
         
-        self.__count -= 1
+        # See zenqueue.utils.async.Semaphore.acquire_many().
+        self.acquire(timeout=timeout)
+        
+        self._lock.acquire()
+        try:
+            if n is None:
+                extra = self.__count
+            else:
+                extra = max(min(n - 1, self.__count), 0)
+            self.__count -= extra
+        finally:
+            self._lock.release()
+        return 1 + extra
+    
+    @with_lock
+    def try_acquire(self):
+        if self.__count > 0:
+            self.__count -= 1
+            return True
+        return False
     
     def release(self):
-        self.__count += 1
+        self._lock.acquire()
+        try:
+            if not (self.evt_queue and self.wake(True)):
+                self.__count += 1
+        finally:
+            self._lock.release()
     
-        if self.evt_queue:
-            ready_event = self.evt_queue.pop()
-            ready_event.send(True)
+    @with_lock
+    def release_many(self, n):
+        # The same as calling release() n times.
+        while n and self.wake(True):
+            n -= 1
+        self.__count += n
+    
+    def wake(self, result):
+        # Must be called with the lock held. Wakes the longest-waiting thread
+        # (if there is one), returning whether there was.
+        while self.evt_queue:
+            waiter = self.evt_queue.pop()
+            if waiter.abandoned:
+                waiter.reset()
+                self.__spare.append(waiter)
+                continue
+            self.__waiting -= 1
+            waiter.result = result
+            waiter.lock.release()
+            return True
+        return False
+    
+    def sweep(self):
+        # Must be called with the lock held. See the async Semaphore's sweep().
+        if len(self.evt_queue) > 2 * self.__waiting + 64:
+            self.evt_queue = deque(waiter for waiter in self.evt_queue
+                                   if not waiter.abandoned)
     
     @with_lock
     def cancel_all(self):
-        while self.evt_queue:
-            ready_event = self.evt_queue.pop()
-            ready_event.cancel_all()
+        while self.wake(False):
+            pass
     
     @property
     def count(self):
         return self.__count
+    
+    @property
+    def waiting(self):
+        return self.__waiting
 
 
 class Lock(Semaphore):
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+
+class TimerWheel(object):
+    
+    """
+    A hashed timing wheel, for keeping track of a large number of deadlines.
+    
+    Time is divided into ticks of `resolution` seconds, and each key is kept in
+    the slot for the tick its deadline falls in (modulo the number of slots).
+    Scheduling and cancelling are O(1), and `expire()` only looks at the slots
+    for the ticks which have passed since it was last called, rather than at
+    every key. Deadlines are rounded up to the next tick, so keys may expire up
+    to `resolution` seconds late, but never early.
+    """
+    
+    def __init__(self, resolution=0.1, size=512):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [{} for i in xrange(size)]
+        self.ticks = {} # Maps each key to the tick it's due at.
+        # The last tick which expire() has dealt with.
+        self.current_tick = int(time.time() // resolution)
+    
+    def __len__(self):
+        return len(self.ticks)
+    
+    def __contains__(self, key):
+        return key in self.ticks
+    
+    def tick_for(self, when):
+        return int(math.ceil(when / self.resolution))
+    
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        # Anything due in a tick which has already been dealt with goes in the
+        # next one instead, so that it isn't missed.
+        tick = max(self.tick_for(deadline), self.current_tick + 1)
+        self.slots[tick % self.size][key] = tick
+        self.ticks[key] = tick
+    
+    def cancel(self, key):
+        tick = self.ticks.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % self.size][key]
+    
+    def expire(self, now=None):
+        """Remove and return the keys whose deadlines have passed."""
+        
+        if now is None:
+            now = time.time()
+        target = int(now // self.resolution)
+        if target <= self.current_tick:
+            return []
+        
+        # Once a full revolution has passed, every slot has been covered.
+        last = min(target, self.current_tick + self.size)
+        expired = []
+        for tick in xrange(self.current_tick + 1, last + 1):
+            slot = self.slots[tick % self.size]
+            if not slot:
+                continue
+            # A slot also holds keys due in later revolutions of the wheel.
+            due = [key for key, key_tick in slot.iteritems()
+                   if key_tick <= target]
+            for key in due:
+                del slot[key]
+                del self.ticks[key]
+            expired.extend(due)
+        
+        self.current_tick = target
+        return expired